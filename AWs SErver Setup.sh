@@ -32,5 +32,7 @@ sudo nano /etc/fstab
 #add this line
 /dev/xvdf       /healthdata     ext4    defaults,nofail         0 0
 
-# From the script directory, run to output
-python applehealthdataeventsqlite.py /healthdata/export.xml
+# From the script directory, run to output. export.zip from the phone can
+# be used as-is (output goes to /healthdata/export/); there is no need to
+# unpack export.xml first.
+python applehealthdataeventsqlite.py /healthdata/export.zip
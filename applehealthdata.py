@@ -14,9 +14,13 @@ import os
 import re
 import sys
 
-from xml.etree import ElementTree
 from collections import Counter, OrderedDict
 
+import columnstore
+import csvpool
+import healthexport
+import rowcodec
+
 __version__ = '1.3'
 
 RECORD_FIELDS = OrderedDict((
@@ -65,6 +69,12 @@ FIELDS = {
 }
 
 
+# Output formats for HealthDataExtractor.extract
+OUTPUT_FORMATS = ('csv', 'columns', 'memory')
+
+# Statistics gathered while streaming through an export
+STATS = ('n_nodes', 'tags', 'fields', 'record_types', 'other_types')
+
 PREFIX_RE = re.compile('^HK.*TypeIdentifier(.+)$')
 ABBREVIATE = True
 VERBOSE = True
@@ -98,12 +108,53 @@ def format_value(value, datatype):
         raise KeyError('Unexpected format value: %s' % datatype)
 
 
+def csv_string(value):
+    """
+    format_value(value, 's'), as a row codec converter.
+    """
+    if value is None:
+        return ''
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def csv_plain(value):
+    """
+    format_value(value, 'n') or format_value(value, 'd').
+    """
+    return '' if value is None else value
+
+
+CSV_CONVERTERS = {
+    's': csv_string,
+    'n': csv_plain,
+    'd': csv_plain,
+}
+
+# A compiled row codec for each tag, giving its CSV line
+ROW_CODECS = dict(
+    (tag, rowcodec.compile_codec(
+        rowcodec.codec_fields([(field, field, datatype)
+                               for (field, datatype) in fields.items()],
+                              CSV_CONVERTERS),
+        separator=',', terminator='\n'))
+    for (tag, fields) in FIELDS.items())
+
+
+# Abbreviations already worked out, by the string abbreviated; exports
+# have only a few dozen distinct types among millions of records
+ABBREVIATIONS = {}
+
 def abbreviate(s, enabled=ABBREVIATE):
     """
     Abbreviate particularly verbose strings based on a regular expression
     """
-    m = re.match(PREFIX_RE, s)
-    return m.group(1) if enabled and m else s
+    if not enabled:
+        return s
+    short = ABBREVIATIONS.get(s)
+    if short is None:
+        m = re.match(PREFIX_RE, s)
+        short = ABBREVIATIONS[s] = m.group(1) if m else s
+    return short
 
 
 def encode(s):
@@ -121,42 +172,75 @@ class HealthDataExtractor(object):
     Extract health data from Apple Health App's XML export, export.xml.
 
     Inputs:
-        path:      Relative or absolute path to export.xml
+        path:      Relative or absolute path to export.xml, or to the
+                   export.zip from the phone, or to export.xml.gz or
+                   export.xml.bz2, which are read without unpacking
+        output_dir: Directory for the output; see below for the default
         verbose:   Set to False for less verbose output
+        parser:    Parser backend, 'iterparse' (the default) or 'scan';
+                   see healthexport.scan_elements
+        kinds:     If set, only records of these kinds (Record types,
+                   such as 'VO2Max', or 'Workout' or 'ActivitySummary')
+                   are read
+        start, end: If either is set, only records with start <=
+                   startDate < end are read; see healthexport.epoch_seconds
+                   for the forms they can take
+
+    With kinds, start or end set, only the parts of an export.xml that
+    its sidecar index (see healthexport.ExportIndex) says can hold the
+    records are read, building the index the first time.
 
     Outputs:
         Writes a CSV file for each record type found, in the same
-        directory as the input export.xml. Reports each file written
-        unless verbose has been set to False.
+        directory as the input export.xml (or for a compressed export,
+        a directory named after it alongside it). Reports each file
+        written unless verbose has been set to False.
+
+        With extract(output_format='columns'), writes a column store
+        (see columnstore.py) to a columns directory there instead,
+        with a subdirectory for each record type.
+
+    The export is streamed rather than loaded, with each top-level node
+    (and its MetadataEntry children) discarded once it has been counted
+    and written, so memory use does not grow with the size of the export.
+    Counting and writing happen in the same pass: extract() collects the
+    statistics as it goes, and reading any of the statistics before
+    extracting (n_nodes, tags, fields, record_types, other_types) runs a
+    pass that just counts, unless the export has an up-to-date sidecar
+    index, which has the counts already.
     """
-    def __init__(self, path, verbose=VERBOSE):
+    def __init__(self, path, verbose=VERBOSE, output_dir=None,
+                 parser='iterparse', kinds=None, start=None, end=None):
         self.in_path = path
+        self.parser = parser
+        self.kinds = kinds
+        self.start = start
+        self.end = end
+        self.selective = not (kinds is None and start is None and end is None)
         self.verbose = verbose
-        self.directory = os.path.abspath(os.path.split(path)[0])
-        with open(path) as f:
-            self.report('Reading data from %s . . . ' % path, end='')
-            self.data = ElementTree.parse(f)
-            self.report('done')
-        self.root = self.data._root
-        self.nodes = self.root.getchildren()
-        self.n_nodes = len(self.nodes)
-        self.abbreviate_types()
-        self.collect_stats()
+        self.directory = output_dir or healthexport.output_directory(path)
+        self.files = csvpool.CSVWriterPool()
+        self.paths = []
+        self.store = None
+        self.stats_collected = False
+
+    def __getattr__(self, name):
+        if name in STATS and not self.__dict__.get('stats_collected'):
+            self.collect_stats()
+            return getattr(self, name)
+        raise AttributeError(name)
 
     def report(self, msg, end='\n'):
         if self.verbose:
             print(msg, end=end)
             sys.stdout.flush()
 
-    def count_tags_and_fields(self):
-        self.tags = Counter()
-        self.fields = Counter()
-        for record in self.nodes:
-            self.tags[record.tag] += 1
-            for k in record.keys():
-                self.fields[k] += 1
+    def count_tags_and_fields(self, record):
+        self.tags[record.tag] += 1
+        for k in record.keys():
+            self.fields[k] += 1
 
-    def count_record_types(self):
+    def count_record_types(self, record):
         """
         Counts occurrences of each type of (conceptual) "record" in the data.
 
@@ -172,63 +256,132 @@ class HealthDataExtractor(object):
         all Workout entries to a single file, and all ActivitySummary
         entries to another single file.
         """
+        if record.tag == 'Record':
+            self.record_types[record.attrib['type']] += 1
+        elif record.tag in ('ActivitySummary', 'Workout'):
+            self.other_types[record.tag] += 1
+        elif record.tag in ('Export', 'Me'):
+            pass
+        else:
+            self.report('Unexpected node of type %s.' % record.tag)
+
+    def collect_stats(self):
+        """
+        Count nodes, tags, fields and record types without writing, or
+        take the counts from the export's sidecar index, if it has an
+        up-to-date one.
+        """
+        index = None
+        if not self.selective:
+            index = healthexport.load_index(self.in_path)
+        if index is None:
+            self.stream(write=False)
+            return
+        self.n_nodes = index.n_nodes
+        self.tags = Counter(index.tags)
+        self.fields = Counter(index.fields)
+        self.record_types = Counter()
+        for (kind, n) in index.types.items():
+            self.record_types[abbreviate(kind)] += n
+        self.other_types = Counter(dict((tag, index.tags[tag])
+                                        for tag in ('ActivitySummary',
+                                                    'Workout')
+                                        if tag in index.tags))
+        self.stats_collected = True
+
+    def stream(self, write):
+        """
+        Make a single pass through the export, counting every top-level
+        node and, if write is set, writing each record to its CSV file.
+        """
+        self.n_nodes = 0
+        self.tags = Counter()
+        self.fields = Counter()
         self.record_types = Counter()
         self.other_types = Counter()
-        for record in self.nodes:
-            if record.tag == 'Record':
-                self.record_types[record.attrib['type']] += 1
-            elif record.tag in ('ActivitySummary', 'Workout'):
-                self.other_types[record.tag] += 1
-            elif record.tag in ('Export', 'Me'):
-                pass
+        with healthexport.open_export(self.in_path) as f:
+            self.report('Reading data from %s . . . ' % self.in_path, end='')
+            if self.selective:
+                nodes = healthexport.select_elements(self.in_path, self.kinds,
+                                                     self.start, self.end,
+                                                     self.parser)
             else:
-                self.report('Unexpected node of type %s.' % record.tag)
+                nodes = healthexport.iter_elements(f, self.parser,
+                                                   nested=False)
+            for node in nodes:
+                self.n_nodes += 1
+                self.count_tags_and_fields(node)
+                self.abbreviate_types(node)
+                self.count_record_types(node)
+                if write:
+                    self.write_records(node)
+            self.report('done')
+        self.stats_collected = True
 
-    def collect_stats(self):
-        self.count_record_types()
-        self.count_tags_and_fields()
+    def open_for_writing(self, kind):
+        path = os.path.join(self.directory, '%s.csv' % abbreviate(kind))
+        headerType = (kind if kind in ('Workout', 'ActivitySummary')
+                           else 'Record')
+        self.files.add(kind, path, ','.join(FIELDS[headerType].keys()) + '\n')
+        self.paths.append(path)
+        self.report('Opening %s for writing' % path)
 
-    def open_for_writing(self):
-        self.handles = {}
-        self.paths = []
-        for kind in (list(self.record_types) + list(self.other_types)):
-            path = os.path.join(self.directory, '%s.csv' % abbreviate(kind))
-            f = open(path, 'w')
-            headerType = (kind if kind in ('Workout', 'ActivitySummary')
-                               else 'Record')
-            f.write(','.join(FIELDS[headerType].keys()) + '\n')
-            self.handles[kind] = f
-            self.report('Opening %s for writing' % path)
-
-    def abbreviate_types(self):
+    def abbreviate_types(self, node):
         """
         Shorten types by removing common boilerplate text.
         """
-        for node in self.nodes:
-            if node.tag == 'Record':
-                if 'type' in node.attrib:
-                    node.attrib['type'] = abbreviate(node.attrib['type'])
-
-    def write_records(self):
-        kinds = FIELDS.keys()
-        for node in self.nodes:
-            if node.tag in kinds:
-                attributes = node.attrib
-                kind = attributes['type'] if node.tag == 'Record' else node.tag
-                values = [format_value(attributes.get(field), datatype)
-                          for (field, datatype) in FIELDS[node.tag].items()]
-                line = encode(','.join(values) + '\n')
-                self.handles[kind].write(line)
+        if node.tag == 'Record':
+            if 'type' in node.attrib:
+                node.attrib['type'] = abbreviate(node.attrib['type'])
+
+    def write_records(self, node):
+        if node.tag in FIELDS:
+            attributes = node.attrib
+            kind = attributes['type'] if node.tag == 'Record' else node.tag
+            if self.store is not None:
+                # the columns intern strings, so drop the per-record
+                # pointer that makes every device description distinct
+                if 'device' in attributes and ABBREVIATE:
+                    attributes['device'] = healthexport.abbreviate_device(
+                        attributes['device'])
+                self.store.write(kind, FIELDS[node.tag], attributes)
+                return
+            line = encode(ROW_CODECS[node.tag](attributes))
+            if kind not in self.files:
+                self.open_for_writing(kind)
+            self.files.write(kind, line)
 
     def close_files(self):
-        for (kind, f) in self.handles.items():
-            f.close()
+        self.files.close()
+        for kind in self.files.paths:
             self.report('Written %s data.' % abbreviate(kind))
+        self.files = csvpool.CSVWriterPool()
 
-    def extract(self):
-        self.open_for_writing()
-        self.write_records()
+    def extract(self, output_format='csv'):
+        """
+        Write the records out as CSV files ('csv'), or to a column store
+        in a columns directory ('columns'), or load them into memory
+        ('memory'), returning a columnstore.MemoryColumnStore.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise KeyError('Unexpected output format: %s' % output_format)
+        self.files = csvpool.CSVWriterPool()
+        self.paths = []
+        dataset = None
+        if output_format == 'columns':
+            path = os.path.join(self.directory, 'columns')
+            self.report('Writing column store to %s' % path)
+            self.store = columnstore.ColumnStoreWriter(path)
+        elif output_format == 'memory':
+            self.store = dataset = columnstore.MemoryColumnStore()
+        try:
+            self.stream(write=True)
+        finally:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
         self.close_files()
+        return dataset
 
     def report_stats(self):
         print('\nTags:\n%s\n' % format_freqs(self.tags))
@@ -237,10 +390,38 @@ class HealthDataExtractor(object):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('USAGE: python applehealthdata.py /path/to/export.xml',
+    args = sys.argv[1:]
+    output_format = 'csv'
+    if '--columns' in args:
+        args.remove('--columns')
+        output_format = 'columns'
+    index = '--index' in args
+    if index:
+        args.remove('--index')
+    kinds = None
+    if '--types' in args and args.index('--types') + 1 < len(args):
+        i = args.index('--types')
+        kinds = args[i + 1].split(',')
+        del args[i:i + 2]
+    bounds = {}
+    for bound in ('start', 'end'):
+        flag = '--' + bound
+        if flag in args and args.index(flag) + 1 < len(args):
+            i = args.index(flag)
+            bounds[bound] = args[i + 1]
+            del args[i:i + 2]
+    if len(args) != 1:
+        print('USAGE: python applehealthdata.py [--columns] [--index] '
+              '[--types VO2Max,...] [--start 2016-04-01] [--end 2016-05-01] '
+              '/path/to/export.xml '
+              '(or export.zip, export.xml.gz, export.xml.bz2)',
               file=sys.stderr)
         sys.exit(1)
-    data = HealthDataExtractor(sys.argv[1])
+    if index:
+        # build (or refresh) the sidecar index, and report from it
+        healthexport.export_index(args[0])
+        HealthDataExtractor(args[0]).report_stats()
+        sys.exit(0)
+    data = HealthDataExtractor(args[0], kinds=kinds, **bounds)
+    data.extract(output_format)
     data.report_stats()
-    data.extract()
@@ -14,8 +14,11 @@ import os
 import re
 import sys
 
-from xml.etree import ElementTree
-from collections import Counter, OrderedDict
+from collections import OrderedDict
+
+import csvpool
+import healthexport
+import rowcodec
 
 __version__ = '1.3'
 
@@ -98,12 +101,53 @@ def format_value(value, datatype):
         raise KeyError('Unexpected format value: %s' % datatype)
 
 
+def csv_string(value):
+    """
+    format_value(value, 's'), as a row codec converter.
+    """
+    if value is None:
+        return ''
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def csv_plain(value):
+    """
+    format_value(value, 'n') or format_value(value, 'd').
+    """
+    return '' if value is None else value
+
+
+CSV_CONVERTERS = {
+    's': csv_string,
+    'n': csv_plain,
+    'd': csv_plain,
+}
+
+# A compiled row codec for each tag, giving its CSV line
+ROW_CODECS = dict(
+    (tag, rowcodec.compile_codec(
+        rowcodec.codec_fields([(field, field, datatype)
+                               for (field, datatype) in fields.items()],
+                              CSV_CONVERTERS),
+        separator=',', terminator='\n'))
+    for (tag, fields) in FIELDS.items())
+
+
+# Abbreviations already worked out, by the string abbreviated; exports
+# have only a few dozen distinct types among millions of records
+ABBREVIATIONS = {}
+
 def abbreviate(s, enabled=ABBREVIATE):
     """
     Abbreviate particularly verbose strings based on a regular expression
     """
-    m = re.match(PREFIX_RE, s)
-    return m.group(1) if enabled and m else s
+    if not enabled:
+        return s
+    short = ABBREVIATIONS.get(s)
+    if short is None:
+        m = re.match(PREFIX_RE, s)
+        short = ABBREVIATIONS[s] = m.group(1) if m else s
+    return short
 
 
 def encode(s):
@@ -114,92 +158,137 @@ def encode(s):
     """
     return s.encode('UTF-8') if sys.version_info.major < 3 else s
 
+def record_lines(elements):
+    """
+    Yield (kind, line) for each record element in elements, where line
+    is the CSV line to be written to the file for kind.
+    """
+    for node in elements:
+        if node.tag in FIELDS:
+            attributes = node.attrib
+            if node.tag == 'Record' and 'type' in attributes:
+                attributes['type'] = abbreviate(attributes['type'])
+            kind = attributes['type'] if node.tag == 'Record' else node.tag
+            yield (kind, encode(ROW_CODECS[node.tag](attributes)))
+
+
+def parse_range_lines(path, start, end, parser='iterparse'):
+    """
+    Worker for parallel extraction: the CSV lines for one byte range.
+    """
+    return list(record_lines(healthexport.iter_range(path, start, end,
+                                                     parser)))
+
+
 class HealthDataExtractorEV(object):
     """
     Extract health data from Apple Health App's XML export, export.xml.
 
     Inputs:
-        path:      Relative or absolute path to export.xml
+        path:      Relative or absolute path to export.xml, or to the
+                   export.zip from the phone, or to export.xml.gz or
+                   export.xml.bz2, which are read without unpacking
+        output_dir: Directory for the output; see below for the default
         verbose:   Set to False for less verbose output
+        jobs:      Number of processes parsing the export. With more
+                   than one, byte ranges of the file are parsed in
+                   parallel and their lines written in file order, so
+                   the CSV files are the same as for a serial run.
+                   Compressed exports are always parsed serially.
+        parser:    Parser backend, 'iterparse' (the default) or 'scan',
+                   which pulls empty Records straight out of the text
+                   of the export; see healthexport.scan_elements
+        pipeline:  Set to True to parse in one thread, format lines in
+                   another, and write them in a third that owns the
+                   file handles, with bounded queues between them
 
     Outputs:
         Writes a CSV file for each record type found, in the same
-        directory as the input export.xml. Reports each file written
-        unless verbose has been set to False.
+        directory as the input export.xml (or for a compressed export,
+        a directory named after it alongside it). Reports each file
+        written unless verbose has been set to False.
     """
-    def __init__(self, path, verbose=VERBOSE):
-        self.handles = {}
+    def __init__(self, path, verbose=VERBOSE, jobs=1, output_dir=None,
+                 parser='iterparse', pipeline=False):
+        self.files = csvpool.CSVWriterPool()
         self.paths = []
         self.in_path = path
         self.verbose = verbose
-        self.directory = os.path.abspath(os.path.split(path)[0])
-        with open(path) as f:
+        self.directory = output_dir or healthexport.output_directory(path)
+        if jobs > 1 and healthexport.is_compressed(path):
+            self.report('Compressed exports are parsed serially')
+            jobs = 1
+        with healthexport.open_export(path) as f:
             self.report('Reading data from %s . . . ' % path, end='')
             #self.data = ElementTree.iterparse(f)
             self.report('done')
 
-            # get an iterable
-            context = ElementTree.iterparse(f, events=("start", "end"))
-
-            # turn it into an iterator
-            context = iter(context)
-
-            # get the root element
-            event, root = next(context)
-
-            for event, element in context:
-                # element is a whole element
-                if event == "end":
-                    self.abbreviate_types(element)
-                    self.write_records(element)
+            if jobs > 1:
+                lines = (line for batch in healthexport.parallel_map_ranges(
+                             path, parse_range_lines, jobs, (parser,))
+                         for line in batch)
+            elif pipeline:
+                lines = record_lines(healthexport.threaded(
+                    healthexport.iter_elements(f, parser)))
+            else:
+                lines = record_lines(healthexport.iter_elements(f, parser))
 
-                root.clear()
+            if pipeline:
+                self.write_pipelined(lines)
+            else:
+                for (kind, line) in lines:
+                    self.write_line(kind, line)
 
         #self.root = self.data._root
         #self.nodes = self.root.getchildren()
         #self.n_nodes = len(self.nodes)
         #self.abbreviate_types()
     
-    def abbreviate_types(self, node):
-        """
-        Shorten types by removing common boilerplate text.
-        """
-        if node.tag == 'Record':
-            if 'type' in node.attrib:
-                node.attrib['type'] = abbreviate(node.attrib['type'])
-
-    
     def report(self, msg, end='\n'):
         if self.verbose:
             print(msg, end=end)
             sys.stdout.flush()
 
-    def write_records(self, node):
-        kinds = FIELDS.keys()
-        if node.tag in kinds:
-            attributes = node.attrib
-            kind = attributes['type'] if node.tag == 'Record' else node.tag
-            values = [format_value(attributes.get(field), datatype)
-                        for (field, datatype) in FIELDS[node.tag].items()]
-            line = encode(','.join(values) + '\n')
-            if kind in self.handles:
-                self.handles[kind].write(line)
-            else:
-                self.open_for_writing(kind)
-                self.handles[kind].write(line)
-               
+    def write_line(self, kind, line):
+        if kind not in self.files:
+            self.open_for_writing(kind)
+        self.files.write(kind, line)
+
+    def write_lines(self, lines):
+        for (kind, line) in lines:
+            self.write_line(kind, line)
+
+    def write_pipelined(self, lines):
+        """
+        Write lines from a WriterThread, handing them over in batches.
+        """
+        writer = healthexport.WriterThread()
+        try:
+            batch = []
+            for item in lines:
+                batch.append(item)
+                if len(batch) >= healthexport.PIPELINE_BATCH:
+                    writer.submit(self.write_lines, batch)
+                    batch = []
+            writer.submit(self.write_lines, batch)
+        finally:
+            writer.close()
+
     def open_for_writing(self, kind):
         path = os.path.join(self.directory, '%s.csv' % abbreviate(kind))
-        f = open(path, 'w')
         headerType = (kind if kind in ('Workout', 'ActivitySummary')
                             else 'Record')
-        f.write(','.join(FIELDS[headerType].keys()) + '\n')
-        self.handles[kind] = f
+        self.files.add(kind, path, ','.join(FIELDS[headerType].keys()) + '\n')
+        self.paths.append(path)
         self.report('Opening %s for writing' % path)
     
     def close_files(self):
-        for (kind, f) in self.handles.items():
-            f.close()
+        """
+        Write out the lines still buffered; the CSV files are only
+        complete once this has been called.
+        """
+        self.files.close()
+        for kind in self.files.paths:
             self.report('Written %s data.' % abbreviate(kind))
 
 # class HealthDataExtractor(object):
@@ -323,11 +412,27 @@ class HealthDataExtractorEV(object):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('USAGE: python applehealthdata.py /path/to/export.xml',
+    args = sys.argv[1:]
+    jobs = 1
+    if '--jobs' in args and args.index('--jobs') + 1 < len(args):
+        i = args.index('--jobs')
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    pipeline = '--pipeline' in args
+    if pipeline:
+        args.remove('--pipeline')
+    parser = 'iterparse'
+    if '--parser' in args and args.index('--parser') + 1 < len(args):
+        i = args.index('--parser')
+        parser = args[i + 1]
+        del args[i:i + 2]
+    if len(args) != 1 or parser not in healthexport.PARSERS:
+        print('USAGE: python applehealthdataevent.py [--jobs N] '
+              '[--parser iterparse|scan] [--pipeline] /path/to/export.xml',
               file=sys.stderr)
         sys.exit(1)
-    data = HealthDataExtractorEV(sys.argv[1])
+    data = HealthDataExtractorEV(args[0], jobs=jobs, parser=parser,
+                                 pipeline=pipeline)
     data.close_files()
 #    data.report_stats()
 #    data.extract()
@@ -10,14 +10,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import functools
+import json
+import multiprocessing
 import os
 import re
 import sys
 import sqlite3
 
-from xml.etree import ElementTree
-from collections import Counter, OrderedDict
-from datetime import datetime
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+import dedup
+import healthexport
+import loadmetrics
+import rowcodec
 
 __version__ = '1.3'
 
@@ -31,6 +38,7 @@ LOOKUP_FIELDS = OrderedDict((
     ('durationUnit', 'unit'),
     ('totalDistanceUnit', 'unit'),
     ('totalEnergyBurnedUnit', 'unit'),
+    ('metadataKey', 'metadataKey'),
 ))
 
 RECORD_FIELDS = OrderedDict((
@@ -93,6 +101,45 @@ WORKOUT_VERSIONS = {
     '1': WORKOUT_FIELDS
 }
 
+CORRELATION_FIELDS = OrderedDict((
+    ('sourceName', 's'),
+    ('sourceVersion', 's'),
+    ('device', 's'),
+    ('type', 's'),
+    ('creationDate', 'd'),
+    ('startDate', 'd'),
+    ('endDate', 'd'),
+))
+
+CORRELATION_VERSIONS = {
+    '1': CORRELATION_FIELDS
+}
+
+# Children of a Workout, each stored in its own table with the rowid of
+# its workout in a leading workout column. A WorkoutRoute's path is
+# taken from its FileReference.
+WORKOUT_EVENT_FIELDS = OrderedDict((
+    ('type', 's'),
+    ('date', 'd'),
+    ('duration', 'n'),
+    ('durationUnit', 's'),
+))
+
+WORKOUT_ROUTE_FIELDS = OrderedDict((
+    ('sourceName', 's'),
+    ('sourceVersion', 's'),
+    ('device', 's'),
+    ('creationDate', 'd'),
+    ('startDate', 'd'),
+    ('endDate', 'd'),
+    ('path', 's'),
+))
+
+CHILD_TABLES = OrderedDict((
+    ('WorkoutEvent', ('workout', WORKOUT_EVENT_FIELDS)),
+    ('WorkoutRoute', ('workout', WORKOUT_ROUTE_FIELDS)),
+))
+
 RECORD_TYPES = {
     'ActiveEnergyBurned': RECORD_FIELDS,
     'AppleExerciseTime': RECORD_FIELDS,
@@ -116,6 +163,7 @@ FIELDS = {
     'Record': RECORD_TYPES,
     'ActivitySummary': ACTIVITY_SUMMARY_VERSIONS,
     'Workout': WORKOUT_VERSIONS,
+    'Correlation': CORRELATION_VERSIONS,
 }
 
 CONSTANTS = {
@@ -124,13 +172,116 @@ CONSTANTS = {
     'HKCategoryValueSleepAnalysisInBed': '1',
 }
 
-LOOKUP_VALUES = {}
-
 PREFIX_RE = re.compile('^HK.*TypeIdentifier(.+)$')
-DEVICE_RE = re.compile('^<<HK.*>, (.+)>$')
 ABBREVIATE = True
 VERBOSE = True
 
+# Rows buffered per table before being flushed with executemany
+BATCH_SIZE = 10000
+# Records between commits (and progress reports) during a load
+COMMIT_INTERVAL = 100000
+
+# Pragmas applied for the duration of a bulk load and restored afterwards.
+# page_size only takes effect on a database with no tables yet.
+LOAD_PRAGMAS = OrderedDict((
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-262144'),  # negative means KiB, so 256MB
+    ('temp_store', 'MEMORY'),
+))
+PAGE_SIZE = 16384
+
+# Columns indexed once a load has finished: the first of the time
+# columns found in each table, and any of the lookup columns that
+# queries filter on. Lookup (z*) tables get a unique index on value.
+TIME_INDEX_COLUMNS = ('startDateUtc', 'startDate', 'dateComponents')
+INDEXED_LOOKUPS = ('sourceName', 'device', 'workoutActivityType')
+
+# Table holding the per-kind high-water marks used by incremental loads
+LOAD_STATE_TABLE = 'LoadState'
+# Side table for the MetadataEntry children of records, each row linked
+# to its record by the record's kind (interned with the types) and its
+# rowid in the kind's table, with the key interned too
+METADATA_TABLE = 'Metadata'
+METADATA_COLUMNS = [
+    ('type', 'type', 's'),
+    ('record', 'record', 'n'),
+    ('metadataKey', 'metadataKey', 's'),
+    ('value', 'value', 's'),
+]
+# Links from each Correlation (by rowid) to its member records, by their
+# kind (interned with the types) and rowid in the kind's table
+CORRELATION_MEMBER_TABLE = 'CorrelationRecord'
+CORRELATION_MEMBER_COLUMNS = [
+    ('correlation', 'correlation', 'n'),
+    ('type', 'type', 's'),
+    ('record', 'record', 'n'),
+]
+# Kinds whose records can be members of a Correlation (blood pressure
+# and food are the only correlation types HealthKit has)
+CORRELATED_TYPES_RE = re.compile('^(BloodPressure|Dietary)')
+# Track points of the workout routes, keyed by workout rowid and time
+ROUTE_POINT_TABLE = 'RoutePoint'
+# Calendar attributes of each DATE_KEY_SECONDS bucket in the data's
+# range, keyed by date key; see DateDimension
+DATE_DIMENSION_TABLE = 'DateDimension'
+# Tables holding rows that belong to records in other tables, rather than
+# records of their own, with the column linking each row to its parent
+CHILD_INDEXES = OrderedDict((
+    (METADATA_TABLE, 'record'),
+    (CORRELATION_MEMBER_TABLE, 'correlation'),
+    ('WorkoutEvent', 'workout'),
+    ('WorkoutRoute', 'workout'),
+))
+ROUTE_POINT_COLUMNS = ('timeUtc', 'latitude', 'longitude', 'elevation',
+                       'speed', 'course', 'horizontalAccuracy',
+                       'verticalAccuracy')
+SIDE_TABLES = ((LOAD_STATE_TABLE, ROUTE_POINT_TABLE, DATE_DIMENSION_TABLE)
+               + tuple(CHILD_INDEXES))
+# Attributes identifying a record among those sharing a creationDate
+FINGERPRINT_FIELDS = ('startDate', 'endDate', 'value', 'sourceName',
+                      'device', 'duration', 'dateComponents')
+
+# How timestamps are stored: as integer UTC epoch seconds and offset
+# columns, as the original text, or both
+DATE_FORMATS = ('epoch', 'text', 'both')
+# Timestamp fields that are split into epoch columns
+TIMESTAMP_FIELDS = ('creationDate', 'startDate', 'endDate', 'date')
+# Column suffix and type code for each part of a split timestamp:
+# 'u' for UTC epoch seconds, 'o' for the offset from UTC in seconds
+EPOCH_COLUMNS = (('Utc', 'u'), ('Offset', 'o'))
+# Fields that also get an integer <field>Key column, whatever the date
+# format, holding the number of the DATE_KEY_SECONDS bucket of local
+# (wall-clock) time they fall in, which is the key of DateDimension
+DATE_KEY_FIELDS = ('startDate', 'dateComponents')
+DATE_KEY_SECONDS = 300
+# DateDimension has every day between the days with data, except across
+# gaps of more than this many days, so that a stray date (a device clock
+# reset to 1970, say) adds its own day and not the decades in between
+DATE_GAP_DAYS = 366
+
+# Rollup tables kept during a load, and the length of their buckets in
+# seconds. Buckets are in local (wall-clock) time, as the startDate
+# appeared on the phone.
+ROLLUP_PERIODS = OrderedDict((
+    ('Rollup5Minute', 300),
+    ('RollupHour', 3600),
+    ('RollupDay', 86400),
+))
+# The fields aggregated for each tag, and the attribute (if any) that
+# splits a kind's aggregates into separate contexts
+ROLLUP_FIELDS = {
+    'Record': ('value',),
+    'Workout': ('duration', 'totalDistance', 'totalEnergyBurned'),
+}
+ROLLUP_CONTEXTS = {
+    'HeartRate': 'motionContext',
+    'Workout': 'workoutActivityType',
+}
+
+# Tables keyed by their primary key alone
+WITHOUT_ROWID_TABLES = tuple(ROLLUP_PERIODS) + (ROUTE_POINT_TABLE,)
+
 def format_freqs(counter):
     """
     Format a counter object for display.
@@ -166,6 +317,85 @@ def format_value(value, datatype):
     else:
         raise KeyError('Unexpected format value: %s' % datatype)
 
+def sql_value(value, datatype):
+    """
+    Convert a value for use as a bound SQLite parameter.
+
+    Unlike format_value, no quoting or escaping is done, since the
+    value is never spliced into the SQL text.
+
+    datatype should be
+        's' for string
+        'n' for number
+        'd' for datetime
+        'u' for a datetime's UTC epoch seconds
+        'o' for a datetime's offset from UTC in seconds
+        'k' for a datetime's date key; see date_key_value
+    """
+    if value is None:
+        return None
+    elif datatype in ('s', 'd'):
+        return value
+    elif datatype == 'n':
+        # Handle weird constant value for sleep analysis
+        if value in CONSTANTS:
+            return CONSTANTS[value]
+        return value if len(value) else '0'
+    elif datatype == 'u':
+        return healthexport.timestamp_parts(value)[0] if value else None
+    elif datatype == 'o':
+        return healthexport.timestamp_parts(value)[1] if value else None
+    elif datatype == 'k':
+        return date_key_value(value)
+    else:
+        raise KeyError('Unexpected format value: %s' % datatype)
+
+def number_value(value):
+    """
+    sql_value(value, 'n') for a value that isn't None.
+    """
+    return CONSTANTS.get(value, value) or '0'
+
+def utc_seconds(value):
+    return healthexport.timestamp_parts(value)[0] if value else None
+
+def utc_offset(value):
+    return healthexport.timestamp_parts(value)[1] if value else None
+
+def date_key_value(value):
+    """
+    The number of the DATE_KEY_SECONDS bucket of local time since the
+    epoch that a timestamp (or a bare date, at its midnight) falls in.
+    """
+    if not value:
+        return None
+    (utc, offset) = healthexport.timestamp_parts(value)
+    return (utc + offset) // DATE_KEY_SECONDS
+
+# Converters for sql_value's datatypes, for compiling row codecs;
+# None passes a value through unchanged. Missing attributes are ''.
+SQL_CONVERTERS = {
+    's': None,
+    'd': None,
+    'n': number_value,
+    'u': utc_seconds,
+    'o': utc_offset,
+    'k': date_key_value,
+}
+
+def date_key(value):
+    """
+    Convert an export timestamp such as '2016-04-01 12:34:56 +0100' to
+    UTC seconds since the epoch, for comparing dates across timezones.
+    """
+    return healthexport.timestamp_parts(value)[0]
+
+def fingerprint(attributes):
+    """
+    Identify a record by the attributes most likely to distinguish it.
+    """
+    return '|'.join(attributes.get(field, '') for field in FINGERPRINT_FIELDS)
+
 def dtype(datatype):
     """
     Format a data type in dictionary, return the sqlite datatype.
@@ -176,6 +406,8 @@ def dtype(datatype):
         's' for string (escaped)
         'n' for number
         'd' for datetime
+        'u', 'o', 'k' for a datetime's UTC epoch seconds, offset and
+        date key
     """
     if datatype == 's':  # string
         return 'text'
@@ -183,15 +415,51 @@ def dtype(datatype):
         return 'numeric'
     elif datatype == 'd':  # number or date
         return 'text'
+    elif datatype in ('u', 'o', 'k'):  # parts of a date
+        return 'integer'
     else:
         raise KeyError('Unexpected format value: %s' % datatype)
 
+def date_columns(fields, dates):
+    """
+    The columns a field plan is stored in, as a list of
+    (column, field, datatype) triples.
+
+    With dates 'epoch', each of TIMESTAMP_FIELDS is stored as integer
+    <field>Utc and <field>Offset columns in place of its text, so that
+    queries can bucket and compare times without parsing strings;
+    'both' keeps the text column as well, and 'text' stores only that.
+    Each of DATE_KEY_FIELDS is followed by its <field>Key column.
+    """
+    columns = []
+    for (field, datatype) in fields.items():
+        if field in TIMESTAMP_FIELDS and dates != 'text':
+            if dates == 'both':
+                columns.append((field, field, datatype))
+            for (suffix, part) in EPOCH_COLUMNS:
+                columns.append((field + suffix, field, part))
+        else:
+            columns.append((field, field, datatype))
+        if field in DATE_KEY_FIELDS:
+            columns.append((field + 'Key', field, 'k'))
+    return columns
+
+# Abbreviations already worked out, by (string, regular expression);
+# exports have only a few dozen distinct types. Devices, which differ
+# record to record, are abbreviated by healthexport.abbreviate_device.
+ABBREVIATIONS = {}
+
 def abbreviate(s, reg, enabled=ABBREVIATE):
     """
     Abbreviate particularly verbose strings based on a regular expression
     """
-    m = re.match(reg, s)
-    return m.group(1) if enabled and m else s
+    if not enabled:
+        return s
+    short = ABBREVIATIONS.get((s, reg))
+    if short is None:
+        m = re.match(reg, s)
+        short = ABBREVIATIONS[(s, reg)] = m.group(1) if m else s
+    return short
 
 
 def encode(s):
@@ -202,138 +470,1210 @@ def encode(s):
     """
     return s.encode('UTF-8') if sys.version_info.major < 3 else s
 
+def abbreviate_types(node):
+    """
+    Shorten types by removing common boilerplate text.
+    """
+    if node.tag in ('Record', 'Correlation'):
+        if 'type' in node.attrib:
+            node.attrib['type'] = abbreviate(node.attrib['type'], PREFIX_RE)
+        if 'device' in node.attrib and ABBREVIATE:
+            node.attrib['device'] = healthexport.abbreviate_device(
+                node.attrib['device'])
+
+def element_children(element):
+    """
+    The (tag, attributes) pairs of the children of a record element, or
+    None if it has none, copying any heart rate motion context from its
+    MetadataEntry into its attributes on the way. The Records inside a
+    Correlation have their types abbreviated, and a WorkoutRoute gets
+    the path of its FileReference as a path attribute.
+    """
+    children = None
+    for elem in element:
+        tag = elem.tag
+        if tag == 'MetadataEntry':
+            if elem.attrib['key'] == "HKMetadataKeyHeartRateMotionContext":
+                element.attrib['motionContext'] = elem.attrib['value']
+        elif tag == 'Record':
+            abbreviate_types(elem)
+        elif tag == 'WorkoutRoute':
+            for ref in elem:
+                if ref.tag == 'FileReference':
+                    elem.attrib['path'] = ref.attrib.get('path')
+        if children is None:
+            children = []
+        children.append((tag, elem.attrib))
+    return children
+
+def prepare_records(elements):
+    """
+    Yield (tag, attributes, children) for each top-level record element
+    in elements, with types abbreviated; see element_children.
+    """
+    for element in elements:
+        if element.tag in FIELDS:
+            abbreviate_types(element)
+            yield (element.tag, element.attrib,
+                   element_children(element) if len(element) else None)
+
+def prepare_records_timed(elements, metrics):
+    """
+    prepare_records, adding the time spent abbreviating types and
+    going through children to the stages of metrics.
+    """
+    stages = metrics.stages
+    clock = loadmetrics.clock
+    for element in elements:
+        if element.tag in FIELDS:
+            start = clock()
+            abbreviate_types(element)
+            abbreviated = clock()
+            children = element_children(element) if len(element) else None
+            stages['abbreviate'] += abbreviated - start
+            stages['metadata'] += clock() - abbreviated
+            yield (element.tag, element.attrib, children)
+
+def parse_range_records(path, start, end, parser='iterparse'):
+    """
+    Worker for parallel loads: the prepared records in one byte range.
+    """
+    return list(prepare_records(healthexport.iter_range(path, start, end,
+                                                        parser,
+                                                        nested=False)))
+
+def parse_route(job):
+    """
+    Worker for loading workout routes: given (export path, workout
+    rowid, route path), return (workout rowid, route path, list of
+    track points), with None for the points if the file is missing.
+    """
+    (path, workout, name) = job
+    try:
+        with healthexport.open_export_file(path, name) as f:
+            return (workout, name, list(healthexport.route_points(f)))
+    except (IOError, OSError):
+        return (workout, name, None)
+
+class LookupDimension(object):
+    """
+    Interns the values of one lookup dimension as integer ids.
+
+    Values are held in a dict, so interning is a single hash lookup
+    however many distinct values there are. Values seen for the first
+    time are kept in self.new until write() appends them to the
+    dimension's z* table in one executemany.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.table = 'z' + name
+        self.ids = {}
+        self.next_id = 0
+        self.new = []
+
+    def intern(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = self.next_id
+            self.next_id += 1
+            self.new.append((i, value))
+        return i
+
+    def load(self, c):
+        """
+        Seed the dimension from its existing z* table.
+        """
+        c.execute('SELECT value, name FROM {}'.format(self.table))
+        for (i, value) in c.fetchall():
+            self.ids[value] = int(i)
+            self.next_id = max(self.next_id, int(i) + 1)
+
+    def write(self, c):
+        c.execute('CREATE TABLE IF NOT EXISTS {} (value TEXT, name TEXT)'
+                  .format(self.table))
+        c.executemany('INSERT INTO {} (value, name) VALUES (?, ?)'
+                      .format(self.table), self.new)
+        self.new = []
+
+
+class SchemaRegistry(object):
+    """
+    In-memory catalog of the tables in the output database.
+
+    sqlite_master is read once, when the registry is created. After
+    that, the table for each kind is created (or widened with any
+    missing columns) the first time a record of that kind is seen,
+    and its field plan and INSERT statement are cached, so the catalog
+    is never queried during the load.
+
+    Record types not listed in RECORD_TYPES get an inferred field plan
+    rather than raising KeyError; see infer_fields. dates is one of
+    DATE_FORMATS, and sets the columns timestamps go in; see date_columns.
+
+    With rowids set, each record's INSERT takes its rowid as a final
+    parameter, numbered by next_rowid from the largest already in its
+    table, so that other rows can refer to it as soon as it is queued.
+    """
+    def __init__(self, c, dates='epoch', rowids=False):
+        if dates not in DATE_FORMATS:
+            raise KeyError('Unexpected date format: %s' % dates)
+        self.dates = dates
+        self.explicit_rowids = rowids
+        self.tables = OrderedDict()
+        self.plans = {}
+        self.inserts = {}
+        self.rowids = {}
+        c.execute('SELECT name FROM sqlite_master WHERE type = \'table\' '
+                  'AND name NOT LIKE \'sqlite_%\'')
+        for (name,) in c.fetchall():
+            c.execute('PRAGMA table_info({})'.format(name))
+            self.tables[name] = [row[1] for row in c.fetchall()]
+            if rowids and name not in WITHOUT_ROWID_TABLES:
+                c.execute('SELECT MAX(rowid) FROM {}'.format(name))
+                self.rowids[name] = c.fetchone()[0] or 0
+
+    def fields(self, tag, version, kind, attributes, c):
+        """
+        Return the column plan for kind, as (column, field, datatype)
+        triples, creating its table on first sight.
+        """
+        columns = self.plans.get(kind)
+        if columns is None:
+            fields = FIELDS[tag].get(version)
+            if fields is None:
+                fields = self.infer_fields(tag, attributes)
+            columns = date_columns(fields, self.dates)
+            self.register(kind, columns, c, self.explicit_rowids)
+        return columns
+
+    def register(self, kind, columns, c, rowids=False):
+        """
+        Create (or widen) the table for kind, and cache its plan and
+        INSERT statement, which takes the rowid last if rowids is set.
+        """
+        self.ensure_table(kind, columns, c)
+        self.plans[kind] = columns
+        names = [column[0] for column in columns] + (['rowid'] if rowids
+                                                     else [])
+        self.inserts[kind] = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            kind, ', '.join(names), ', '.join('?' * len(names)))
+
+    def next_rowid(self, kind):
+        rowid = self.rowids[kind] = self.rowids.get(kind, 0) + 1
+        return rowid
+
+    def infer_fields(self, tag, attributes):
+        """
+        Field plan for a kind with no entry in FIELDS: the standard fields
+        for its tag, followed by any other attributes of the first element
+        seen, which are stored as strings.
+        """
+        base = RECORD_FIELDS if tag == 'Record' else FIELDS[tag]['1']
+        fields = OrderedDict(base)
+        for name in attributes:
+            if name not in fields:
+                fields[name] = 's'
+        return fields
+
+    def ensure_table(self, kind, plan, c):
+        columns = self.tables.get(kind)
+        if columns is None:
+            fl = ', '.join('{} {}'.format(key, dtype(value))
+                           for (key, field, value) in plan)
+            c.execute('CREATE TABLE {} ({})'.format(kind, fl))
+            self.tables[kind] = [key for (key, field, value) in plan]
+        else:
+            for (key, field, value) in plan:
+                if key not in columns:
+                    c.execute('ALTER TABLE {} ADD COLUMN {} {}'
+                              .format(kind, key, dtype(value)))
+                    if value == 'k':
+                        self.fill_date_keys(kind, key, field, columns, c)
+                    columns.append(key)
+
+    def fill_date_keys(self, kind, key, field, columns, c):
+        """
+        Work out a date key column added to a table loaded before there
+        were date keys, from the text of field if the table has it (read
+        as local time), or else from its UTC and offset columns.
+        """
+        if field in columns:
+            local = 'CAST(strftime(\'%s\', substr({}, 1, 19)) AS INTEGER)'.format(
+                field)
+        elif field + 'Utc' in columns and field + 'Offset' in columns:
+            local = '({0}Utc + {0}Offset)'.format(field)
+        else:
+            return
+        # floored, as date_key_value does, for times before 1970
+        c.execute('UPDATE {0} SET {1} = ({2} - ({2} % {3} + {3}) % {3}) / {3}'
+                  .format(kind, key, local, DATE_KEY_SECONDS))
+
+
+class HighWaterMarks(object):
+    """
+    Per-kind high-water marks for incremental loads.
+
+    For each kind, the mark is the latest creationDate loaded (as UTC
+    epoch seconds, falling back to startDate for elements without a
+    creationDate) together with the fingerprints of the records loaded
+    at exactly that time. A record is treated as already loaded if it
+    was created before the mark, or at the mark with a known fingerprint.
+
+    Apple exports are full history, so this assumes that records are
+    never added to HealthKit with a creationDate earlier than those
+    in the previous export.
+    """
+    def __init__(self):
+        self.previous = {}
+        self.marks = {}
+
+    def load(self, c):
+        c.execute('SELECT kind, creationDate, fingerprints FROM {}'
+                  .format(LOAD_STATE_TABLE))
+        for (kind, key, fingerprints) in c.fetchall():
+            self.previous[kind] = (key, frozenset(json.loads(fingerprints)))
+            self.marks[kind] = (key, set(self.previous[kind][1]), [])
+
+    def seen(self, kind, attributes):
+        """
+        Return True if the record was loaded by an earlier run; otherwise
+        advance the mark for kind to include it and return False.
+
+        Records are checked against the marks as they were at the start
+        of the run, since an export is not in creationDate order.
+        Fingerprints of the records at the new marks are only worked out
+        when the marks are written.
+        """
+        date = attributes.get('creationDate') or attributes.get('startDate')
+        key = date_key(date) if date else 0
+        previous = self.previous.get(kind)
+        if previous is not None:
+            if key < previous[0]:
+                return True
+            elif key == previous[0] and fingerprint(attributes) in previous[1]:
+                return True
+        mark = self.marks.get(kind)
+        if mark is None or key > mark[0]:
+            self.marks[kind] = (key, set(), [attributes])
+        elif key == mark[0]:
+            mark[2].append(attributes)
+        return False
+
+    def write(self, c):
+        c.execute('CREATE TABLE IF NOT EXISTS {} (kind TEXT PRIMARY KEY, '
+                  'creationDate INTEGER, fingerprints TEXT)'
+                  .format(LOAD_STATE_TABLE))
+        c.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?, ?)'
+                      .format(LOAD_STATE_TABLE),
+                      ((kind, key, json.dumps(sorted(
+                            fingerprints.union(fingerprint(attributes)
+                                               for attributes in latest))))
+                       for (kind, (key, fingerprints, latest))
+                       in self.marks.items()))
+
+
+class Rollups(object):
+    """
+    Running aggregates (count, sum, minimum, maximum and mean) for each
+    kind, per 5-minute, hourly and daily bucket of startDate.
+
+    Each numeric field in ROLLUP_FIELDS is aggregated separately, and
+    kinds in ROLLUP_CONTEXTS are split by an attribute as well (HeartRate
+    by motionContext, Workout by workoutActivityType). Values that aren't
+    numbers (other than the CONSTANTS) are left out.
+
+    Only the finest buckets are kept while streaming; the longer periods
+    are rolled up from them when they are written. write() merges the
+    aggregates into the ROLLUP_PERIODS tables, adding to any buckets
+    already there, so that an incremental load (which only sees new
+    records) keeps the tables up to date.
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.seconds = min(ROLLUP_PERIODS.values())
+
+    def add(self, tag, kind, attributes):
+        fields = ROLLUP_FIELDS.get(tag)
+        date = attributes.get('startDate')
+        if fields is None or not date:
+            return
+        (utc, offset) = healthexport.timestamp_parts(date)
+        local = utc + offset
+        bucket = local - local % self.seconds
+        context = attributes.get(ROLLUP_CONTEXTS.get(kind), '')
+        for field in fields:
+            value = attributes.get(field)
+            if not value:
+                continue
+            try:
+                value = float(CONSTANTS.get(value, value))
+            except ValueError:
+                continue
+            key = (kind, field, context, bucket)
+            aggregate = self.buckets.get(key)
+            if aggregate is None:
+                self.buckets[key] = [1, value, value, value]
+            else:
+                aggregate[0] += 1
+                aggregate[1] += value
+                if value < aggregate[2]:
+                    aggregate[2] = value
+                elif value > aggregate[3]:
+                    aggregate[3] = value
+
+    def rollup(self, seconds):
+        """
+        The aggregates for buckets of the given length.
+        """
+        if seconds == self.seconds:
+            return self.buckets
+        buckets = {}
+        for ((kind, field, context, bucket), aggregate) in self.buckets.items():
+            key = (kind, field, context, bucket - bucket % seconds)
+            total = buckets.get(key)
+            if total is None:
+                buckets[key] = list(aggregate)
+            else:
+                total[0] += aggregate[0]
+                total[1] += aggregate[1]
+                total[2] = min(total[2], aggregate[2])
+                total[3] = max(total[3], aggregate[3])
+        return buckets
+
+    def write(self, c):
+        for (table, seconds) in ROLLUP_PERIODS.items():
+            c.execute('CREATE TABLE IF NOT EXISTS {} (kind TEXT, '
+                      'field TEXT, context TEXT, bucket INTEGER, '
+                      'n INTEGER, total REAL, minimum REAL, maximum REAL, '
+                      'mean REAL, '
+                      'PRIMARY KEY (kind, field, context, bucket)) '
+                      'WITHOUT ROWID'.format(table))
+            c.executemany('INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                          'ON CONFLICT (kind, field, context, bucket) '
+                          'DO UPDATE SET n = n + excluded.n, '
+                          'total = total + excluded.total, '
+                          'minimum = min(minimum, excluded.minimum), '
+                          'maximum = max(maximum, excluded.maximum), '
+                          'mean = (total + excluded.total) '
+                          '/ (n + excluded.n)'.format(table),
+                          (key + (n, total, minimum, maximum, total / n)
+                           for (key, (n, total, minimum, maximum))
+                           in self.rollup(seconds).items()))
+        self.buckets = {}
+
+
+class DateDimension(object):
+    """
+    Writes DATE_DIMENSION_TABLE, with a row of calendar attributes for
+    each DATE_KEY_SECONDS bucket of local time on every day from the
+    first day of the data to the last, keyed by date key (see
+    date_key_value).
+
+    Records join it on their <field>Key columns (startDateKey, or an
+    ActivitySummary's dateComponentsKey), and the rollup tables on
+    bucket / DATE_KEY_SECONDS, both by integer equality on its primary
+    key. HourKey and DayKey are the keys of the first bucket of the
+    hour and day, for joining at those grains; the other columns are
+    those the SQL in 'cleanup script.sql' used to generate.
+
+    The days are those in the key columns of every table and all the
+    days between them, so days without any samples are there too, for
+    reports driven from the calendar. The exception is a gap of more
+    than DATE_GAP_DAYS, which is left out, so an outlying date adds
+    only its own day. Rows are made a day at a time, and only for days
+    the table doesn't have yet, so an incremental load extends it.
+    """
+    COLUMNS = (
+        ('DateKey', 'INTEGER PRIMARY KEY'), ('HourKey', 'INTEGER'),
+        ('DayKey', 'INTEGER'), ('CalendarDateInterval', 'TEXT'),
+        ('CalendarDateIntervalEnd', 'TEXT'), ('CalendarDateHour', 'TEXT'),
+        ('CalendarDate', 'TEXT'), ('DayNumber', 'TEXT'),
+        ('DayOfWeek', 'TEXT'), ('DayOfWeekNum', 'TEXT'),
+        ('DayOfWeekAbbr', 'TEXT'), ('HourNumber', 'TEXT'),
+        ('MinuteNumber', 'TEXT'), ('DayOfMonth', 'TEXT'),
+        ('IsWeekend', 'INTEGER'), ('IsWeekday', 'INTEGER'),
+        ('MonthNumber', 'TEXT'), ('MonthName', 'TEXT'), ('MonthAbbr', 'TEXT'),
+        ('YearNumber', 'TEXT'), ('YearMonth', 'TEXT'), ('YearWeek', 'TEXT'),
+    )
+    DAYS = ('Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday',
+            'Friday', 'Saturday')
+    MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July',
+              'August', 'September', 'October', 'November', 'December')
+    EPOCH = date(1970, 1, 1)
+
+    def __init__(self):
+        self.per_day = 86400 // DATE_KEY_SECONDS
+        self.per_hour = 3600 // DATE_KEY_SECONDS
+
+    def time_rows(self):
+        """
+        (i, start, finish, hour, HourNumber, MinuteNumber) for the ith
+        bucket of a day, with the times as ' HH:MM:SS'.
+        """
+        for i in range(self.per_day):
+            seconds = i * DATE_KEY_SECONDS
+            end = seconds + DATE_KEY_SECONDS - 1
+            (hour, minute) = (seconds // 3600, seconds % 3600 // 60)
+            yield (i, ' %02d:%02d:%02d' % (hour, minute, seconds % 60),
+                   ' %02d:%02d:%02d' % (end // 3600, end % 3600 // 60,
+                                        end % 60),
+                   ' %02d:00:00' % hour, '%02d' % hour, '%02d' % minute)
+
+    def day_row(self, day):
+        """
+        The day number, its date as text, and the columns from DayNumber
+        to DayOfWeekAbbr and from DayOfMonth on, for the day with the
+        given number since the epoch.
+        """
+        d = self.EPOCH + timedelta(days=day)
+        weekday = (d.weekday() + 1) % 7  # Sunday is 0, as with %w
+        weekend = 1 if weekday in (0, 6) else 0
+        month = '%02d' % d.month
+        year = '%04d' % d.year
+        name = self.DAYS[weekday]
+        return (day, d.isoformat(), '%d' % weekday, name,
+                '%02d-%s' % (weekday, name), name[:3], '%02d' % d.day,
+                weekend, 1 - weekend, month, self.MONTHS[d.month - 1],
+                self.MONTHS[d.month - 1][:3], year, year + '-' + month,
+                year + '-' + d.strftime('%W'))
+
+    def data_days(self, c):
+        """
+        The set of day numbers (days since the epoch) with a date key in
+        any table.
+        """
+        c.execute('SELECT name FROM sqlite_master WHERE type = \'table\' '
+                  'AND name NOT LIKE \'sqlite_%\' AND name != ?',
+                  (DATE_DIMENSION_TABLE,))
+        days = set()
+        for (table,) in c.fetchall():
+            c.execute('PRAGMA table_info({})'.format(table))
+            keys = [row[1] for row in c.fetchall()
+                    if row[1][:-3] in DATE_KEY_FIELDS
+                    and row[1].endswith('Key')]
+            for key in keys:
+                # SQLite's / truncates towards zero, so subtract the
+                # (non-negative) remainder first for keys before 1970
+                c.execute('SELECT DISTINCT ({0} - ({0} % {1} + {1}) % {1}) '
+                          '/ {1} FROM {2} WHERE {0} IS NOT NULL'
+                          .format(key, self.per_day, table))
+                days.update(day for (day,) in c.fetchall())
+        return days
+
+    def fill_days(self, days):
+        """
+        The sorted list of days, with the days between any two of them
+        added, unless they are more than DATE_GAP_DAYS apart.
+        """
+        filled = []
+        for day in sorted(days):
+            if filled and 1 < day - filled[-1] <= DATE_GAP_DAYS:
+                filled.extend(range(filled[-1] + 1, day))
+            filled.append(day)
+        return filled
+
+    def write(self, c):
+        """
+        Add the rows for any days (see fill_days) that the table doesn't
+        have yet, creating it if need be. Returns the number of rows
+        added.
+
+        The rows for the days and for the times of day are put in two
+        temp tables, and the rows of the dimension made by SQLite from
+        their cross join, which is several times quicker than binding
+        each row from Python.
+        """
+        c.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            DATE_DIMENSION_TABLE, ', '.join('%s %s' % column
+                                            for column in self.COLUMNS)))
+        days = self.data_days(c)
+        if not days:
+            return 0
+        c.execute('SELECT DayKey / {} FROM {} WHERE DateKey = DayKey'
+                  .format(self.per_day, DATE_DIMENSION_TABLE))
+        have = set(day for (day,) in c.fetchall())
+        days = [day for day in self.fill_days(days | have)
+                if day not in have]
+        if not days:
+            return 0
+        day_columns = [name for (name, datatype)
+                       in self.COLUMNS[7:11] + self.COLUMNS[13:]]
+        c.execute('CREATE TEMP TABLE date_day (day INTEGER PRIMARY KEY, '
+                  'date TEXT, {})'.format(', '.join(day_columns)))
+        c.executemany('INSERT INTO temp.date_day VALUES ({})'
+                      .format(', '.join('?' * (len(day_columns) + 2))),
+                      [self.day_row(day) for day in days])
+        c.execute('CREATE TEMP TABLE date_time (i INTEGER PRIMARY KEY, '
+                  'start TEXT, finish TEXT, hour TEXT, HourNumber TEXT, '
+                  'MinuteNumber TEXT)')
+        c.executemany('INSERT INTO temp.date_time VALUES (?, ?, ?, ?, ?, ?)',
+                      list(self.time_rows()))
+        day_key = 'd.day * {}'.format(self.per_day)
+        c.execute('INSERT INTO {} SELECT {} + t.i, {} + t.i - t.i % {}, {}, '
+                  'd.date || t.start, d.date || t.finish, d.date || t.hour, '
+                  'd.date || \' 00:00:00\', {}, t.HourNumber, t.MinuteNumber, '
+                  '{} FROM temp.date_day d CROSS JOIN temp.date_time t '
+                  'ORDER BY d.day, t.i'.format(
+                      DATE_DIMENSION_TABLE, day_key, day_key, self.per_hour,
+                      day_key, ', '.join('d.' + name
+                                         for name in day_columns[:4]),
+                      ', '.join('d.' + name for name in day_columns[4:])))
+        c.execute('DROP TABLE temp.date_day')
+        c.execute('DROP TABLE temp.date_time')
+        return len(days) * self.per_day
+
+
+class CorrelationMembers(object):
+    """
+    Matches the Records inside each Correlation to the records loaded
+    for them, so that members are linked without being loaded twice.
+
+    Exports repeat the members of a Correlation as top-level Records
+    (see the comment in the export's DTD), and those are loaded like any
+    other. The rowid of each top-level record of a kind that can be a
+    member (CORRELATED_TYPES_RE) is kept by fingerprint, so a member
+    coming after its record is matched straight away; one coming before
+    waits for its record. Members still waiting at the end of the load
+    have no top-level copy, and are loaded from the Correlation instead.
+
+    self.kinds holds the kinds to pass to record(), so that checking a
+    record costs a set lookup unless it might be a member.
+    """
+    def __init__(self):
+        self.kinds = set()
+        self.rowids = {}
+        self.waiting = OrderedDict()
+
+    def add_kind(self, kind):
+        if CORRELATED_TYPES_RE.match(kind):
+            self.kinds.add(kind)
+
+    def record(self, kind, attributes, rowid):
+        """
+        Note a top-level record of one of self.kinds, returning the
+        (correlation, kind, rowid) links of any members waiting for it.
+        """
+        key = (kind, fingerprint(attributes))
+        self.rowids[key] = rowid
+        waiting = self.waiting.pop(key, None)
+        if waiting is None:
+            return []
+        return [(correlation, kind, rowid) for correlation in waiting[1]]
+
+    def member(self, correlation, attributes):
+        """
+        The (correlation, kind, rowid) link for a Record inside the
+        Correlation with the given rowid, or None if its record hasn't
+        been seen yet.
+        """
+        kind = attributes['type']
+        key = (kind, fingerprint(attributes))
+        rowid = self.rowids.get(key)
+        if rowid is not None:
+            return (correlation, kind, rowid)
+        self.kinds.add(kind)
+        waiting = self.waiting.get(key)
+        if waiting is None:
+            waiting = self.waiting[key] = (attributes, [])
+        waiting[1].append(correlation)
+        return None
+
+    def unmatched(self):
+        """
+        The attributes of each member whose record never turned up.
+        Loading these as records links them, via record().
+        """
+        return [attributes for (attributes, correlations)
+                in self.waiting.values()]
+
+
+class QueuedCursor(object):
+    """
+    Stands in for the cursor during a pipelined load, handing each
+    statement over to be run on the real cursor by a WriterThread.
+    Statements that return rows can't be queued.
+    """
+    def __init__(self, writer, c):
+        self.writer = writer
+        self.c = c
+
+    def execute(self, sql, parameters=()):
+        self.writer.submit(self.c.execute, sql, parameters)
+
+    def executemany(self, sql, rows):
+        self.writer.submit(self.c.executemany, sql, rows)
+
+
 class HealthDataExtractorEV(object):
     """
     Extract health data from Apple Health App's XML export, export.xml.
 
     Inputs:
-        path:      Relative or absolute path to export.xml
-        verbose:   Set to False for less verbose output
+        path:       Relative or absolute path to export.xml, or to the
+                    export.zip from the phone, or to export.xml.gz or
+                    export.xml.bz2, which are read without unpacking
+        verbose:    Set to False for less verbose output
+        batch_size: Number of rows buffered per table before they are
+                    written with a single executemany
+        incremental: Add only records newer than those already in
+                    export.sqlite (see HighWaterMarks), rather than
+                    replacing the database
+        jobs:       Number of processes parsing the export. With more
+                    than one, the file is split into byte ranges that
+                    are parsed in parallel and loaded in file order, so
+                    the database is the same as for a serial load.
+                    Compressed exports are always parsed serially.
+        output_dir: Directory for export.sqlite; see below for the default
+        parser:     Parser backend, 'iterparse' (the default) or 'scan',
+                    which pulls empty Records straight out of the text
+                    of the export; see healthexport.scan_elements
+        dates:      How creationDate, startDate and endDate are stored:
+                    'epoch' (the default) for integer <field>Utc and
+                    <field>Offset columns, 'text' for the original
+                    strings, or 'both'
+        rollups:    Set to False to skip the rollup tables
+        date_dimension: Set to False to skip writing DateDimension
+        indexes:    Set to False to skip building indexes and running
+                    ANALYZE after the load
+        vacuum:     Set to True to rewrite export.sqlite with VACUUM INTO
+                    once it is loaded, compacting it and setting its
+                    page size to page_size
+        page_size:  Page size for a new (or vacuumed) database
+        metadata:   Set to True to keep the MetadataEntry children of
+                    records in the Metadata table, as (type, record,
+                    metadataKey, value) rows, where record is the
+                    record's rowid in its own table
+        routes:     Set to False to skip the GPX files of workout routes
+        route_jobs: Number of processes parsing route files; by default,
+                    one per CPU
+        canonical:  Set to True to write de-duplicated <kind>Canonical
+                    tables for the kinds in dedup.DEDUP_TYPES once the
+                    load is done; see dedup.py
+        priority:   Sources for the canonical tables, most trusted first
+        kinds, start, end: Load only records of the given kinds, or
+                    with start <= startDate < end, reading only the parts
+                    of the export its sidecar index says can hold them;
+                    see applehealthdata.HealthDataExtractor. Such loads
+                    are serial.
+        metrics:    A path to append JSON lines of progress and per-stage
+                    timings to, a callable to pass them to, or a
+                    loadmetrics.LoadMetrics; see loadmetrics.py. Timing
+                    the stages costs a little, so it is off by default.
+        profile:    A path to write a hot-path report to, from a
+                    sampling profiler run over the load
+        pipeline:   Set to True to parse, transform and write in
+                    separate threads, with bounded queues between them,
+                    so that parsing carries on while SQLite writes and
+                    commits; see load
 
     Outputs:
-        Writes a CSV file for each record type found, in the same
-        directory as the input export.xml. Reports each file written
-        unless verbose has been set to False.
+        Writes a table for each record type found to export.sqlite, in
+        the same directory as the input export.xml (or for a compressed
+        export, a directory named after it alongside it), along with a
+        z* lookup table for each lookup dimension, and the
+        Rollup5Minute, RollupHour and RollupDay tables of aggregates
+        (see Rollups), which dashboards can read instead of the samples,
+        and DateDimension, which both join on integer date keys (see
+        DateDimension).
+
+        Correlations go in a Correlation table, with a CorrelationRecord
+        row linking each to each of its members (see CorrelationMembers).
+        The WorkoutEvent and WorkoutRoute children of workouts go in
+        tables of those names, linked to the workout's rowid, and the
+        track points in each route's GPX file go in RoutePoint (see
+        load_routes).
     """
-    def __init__(self, path, verbose=VERBOSE):
+    def __init__(self, path, verbose=VERBOSE, batch_size=BATCH_SIZE,
+                 incremental=False, jobs=1, output_dir=None,
+                 parser='iterparse', dates='epoch', rollups=True,
+                 indexes=True, vacuum=False, page_size=PAGE_SIZE,
+                 metrics=None, profile=None, pipeline=False,
+                 metadata=False, routes=True, route_jobs=None,
+                 canonical=False, priority=dedup.SOURCE_PRIORITY,
+                 kinds=None, start=None, end=None, date_dimension=True):
         self.handles = {}
         self.paths = []
         self.in_path = path
         self.verbose = verbose
-        self.directory = os.path.abspath(os.path.split(path)[0])
-        self.tl = []
+        self.batch_size = batch_size
+        self.directory = output_dir or healthexport.output_directory(path)
+        self.incremental = incremental
+        if jobs > 1 and healthexport.is_compressed(path):
+            self.report('Compressed exports are parsed serially')
+            jobs = 1
+        self.selection = (kinds, start, end)
+        if kinds is not None or start is not None or end is not None:
+            jobs = 1
+        else:
+            self.selection = None
+        self.jobs = jobs
+        self.pending = {}
+        self.codecs = {}
+        self.n_records = 0
+        self.n_skipped = 0
+        self.page_size = page_size
+        self.timings = OrderedDict()
+        self.pipeline = pipeline
+        self.metadata = metadata
+        self.members = CorrelationMembers()
+        self.routes = [] if routes else None
+        self.route_jobs = route_jobs or multiprocessing.cpu_count()
 
-        conn = sqlite3.connect(os.path.join(self.directory, 'export.sqlite'))
+        db_path = os.path.join(self.directory, 'export.sqlite')
+        if os.path.exists(db_path) and not incremental:
+            self.report('Replacing %s' % db_path)
+            os.remove(db_path)
+        conn = sqlite3.connect(db_path, check_same_thread=not pipeline)
         c = conn.cursor()
+        self.schema = SchemaRegistry(c, dates, rowids=True)
+        saved_pragmas = self.set_load_pragmas(c)
+        self.load_lookups(c)
+        self.marks = HighWaterMarks()
+        self.rollups = Rollups() if rollups else None
+        if LOAD_STATE_TABLE in self.schema.tables:
+            self.marks.load(c)
+        self.metrics = None
+        if metrics is not None:
+            self.metrics = (metrics if isinstance(metrics, loadmetrics.LoadMetrics)
+                            else loadmetrics.LoadMetrics(metrics))
+        profiler = loadmetrics.SamplingProfiler() if profile else None
         starttime = datetime.now()
-        with open(path) as f:
-            self.report('Reading data from %s . . . ' % path, end='')
-            #self.data = ElementTree.iterparse(f)
-            self.report('done')
+        if profiler is not None:
+            profiler.start()
+        try:
+            self.load(path, parser, conn, c, starttime)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                profiler.report(profile)
+                self.report('Profile written to %s' % profile)
+        self.timings['load'] = self.seconds_since(starttime)
 
-            # get an iterable
-            context = ElementTree.iterparse(f, events=("start", "end"))
-
-            # turn it into an iterator
-            context = iter(context)
-
-            # get the root element
-            event, root = next(context)
-            
-            cnt = 1
-            for event, element in context:
-                # element is a whole element
-                if event == "end":
-                    for elem in element:
-                        if elem.tag == 'MetadataEntry' and elem.attrib['key'] == "HKMetadataKeyHeartRateMotionContext":
-                            element.attrib['motionContext'] = elem.attrib['value']
-                    self.abbreviate_types(element)
-                    self.write_records(element, c)
-                    # commit every 10,000 rows
-                    if cnt % 10000 == 0:
-                        conn.commit()
-                        diff = datetime.now() - starttime
-                        self.report(str(cnt) + "-" + str(diff.seconds) + ": " + str(round(diff.seconds/cnt)))
-
-                cnt = cnt + 1
-                root.clear()
-
-            # dump the lookup lists to tables
-            self.lookup_output(c)
+        if canonical:
+            deduping = datetime.now()
+            dedup.Deduplicator(conn, priority, self.verbose).run()
+            self.timings['canonical'] = self.seconds_since(deduping)
+        if date_dimension:
+            dating = datetime.now()
+            DateDimension().write(c)
+            conn.commit()
+            self.timings['dates'] = self.seconds_since(dating)
+        if indexes:
+            self.build_indexes(c)
             conn.commit()
-        
+        self.restore_pragmas(c, saved_pragmas)
+        if vacuum:
+            self.vacuum(c, db_path)
         conn.close()
+        if self.metrics is not None:
+            self.metrics.stages['index'] += sum(
+                self.timings.get(step, 0) for step in ('index', 'analyze',
+                                                       'vacuum'))
+            self.metrics.finish()
+        self.report_rate(starttime)
+        self.report(', '.join('%s %.1fs' % item
+                              for item in self.timings.items()))
+        if self.n_skipped:
+            self.report('%d records were already loaded' % self.n_skipped)
         #self.root = self.data._root
         #self.nodes = self.root.getchildren()
         #self.n_nodes = len(self.nodes)
         #self.abbreviate_types()
-    
-    def abbreviate_types(self, node):
+
+    def load(self, path, parser, conn, c, starttime):
         """
-        Shorten types by removing common boilerplate text.
+        Read the records from the export and write them to the database.
+
+        In a pipelined load, the export is parsed in one thread, the
+        records are formatted and interned in this one, and the batched
+        INSERTs and commits run in a third, which has the connection to
+        itself until the records are all written.
         """
-        if node.tag == 'Record':
-            if 'type' in node.attrib:
-                node.attrib['type'] = abbreviate(node.attrib['type'], PREFIX_RE)
-            if 'device' in node.attrib:
-                node.attrib['device'] = abbreviate(node.attrib['device'], DEVICE_RE)
+        metrics = self.metrics
+        with healthexport.open_export(path) as f:
+            self.report('Reading data from %s . . . ' % path, end='')
+            #self.data = ElementTree.iterparse(f)
+            self.report('done')
+
+            if self.selection is not None:
+                elements = healthexport.select_elements(
+                    path, *self.selection, parser=parser)
+            else:
+                elements = healthexport.iter_elements(f, parser, nested=False)
+            if metrics is not None:
+                metrics.total_bytes = healthexport.export_size(path)
+                metrics.position = (f.tell if self.jobs == 1
+                                    and self.selection is None else None)
+                metrics.start(path)
+            if self.jobs > 1:
+                records = (record for batch in healthexport.parallel_map_ranges(
+                               path, parse_range_records, self.jobs, (parser,))
+                           for record in batch)
+            elif metrics is not None:
+                records = prepare_records_timed(loadmetrics.timed(
+                    elements, metrics, 'parse'), metrics)
+            else:
+                records = prepare_records(elements)
+            if metrics is not None:
+                write_records = self.write_records_timed
+            else:
+                write_records = self.write_records
+
+            writer = None
+            cursor = c
+            commit = conn.commit
+            if self.pipeline:
+                records = healthexport.threaded(records)
+                writer = healthexport.WriterThread()
+                cursor = QueuedCursor(writer, c)
+                commit = functools.partial(writer.submit, conn.commit)
+            try:
+                for (tag, attributes, children) in records:
+                    if self.already_loaded(tag, attributes):
+                        self.n_skipped += 1
+                        continue
+                    write_records(tag, attributes, cursor, children)
+                    self.n_records += 1
+                    # commit every COMMIT_INTERVAL records
+                    if self.n_records % COMMIT_INTERVAL == 0:
+                        commit()
+                        self.report_rate(starttime)
+                if metrics is not None:
+                    metrics.position = None
+                for attributes in self.members.unmatched():
+                    if not self.already_loaded('Record', attributes):
+                        write_records('Record', attributes, cursor)
+                        self.n_records += 1
+
+                writing = loadmetrics.clock()
+                self.flush_all(cursor)
+            finally:
+                if writer is not None:
+                    writer.close()
+            if self.routes:
+                self.load_routes(path, c)
+
+            # dump the lookup lists to tables
+            self.lookup_output(c)
+            if self.rollups is not None:
+                rolling = loadmetrics.clock()
+                self.rollups.write(c)
+                if metrics is not None:
+                    metrics.stages['rollup'] += loadmetrics.clock() - rolling
+                    writing += loadmetrics.clock() - rolling
+            self.marks.write(c)
+            conn.commit()
+            if metrics is not None:
+                metrics.stages['write'] += loadmetrics.clock() - writing
 
-    
     def report(self, msg, end='\n'):
         if self.verbose:
             print(msg, end=end)
             sys.stdout.flush()
 
-    def write_records(self, node, c):
-        kinds = FIELDS.keys()
-        if node.tag in kinds:
-            attributes = node.attrib
-            kind = attributes['type'] if node.tag == 'Record' else node.tag
-            version = attributes['type'] if node.tag == 'Record' else "1"
-
-            values = [self.lookup(field,format_value(attributes.get(field,''), datatype),c)
-                        for (field, datatype) in FIELDS[node.tag][version].items()]
- 
-            line = encode(','.join(values))
-            if kind in self.tl:
-                self.write_record(kind, line, c)
-            else:
-                self.open_for_writing(node.tag, version, kind, c)
-                self.tl = self.table_list(c)
-                self.write_record(kind, line, c)
-    
-    def lookup(self, field, value, c):
-        if LOOKUP_FIELDS.get(field) is None:
-            return value
-        else:
-            if LOOKUP_VALUES.get(LOOKUP_FIELDS[field]) is None:
-                LOOKUP_VALUES[LOOKUP_FIELDS[field]] = []
+    def seconds_since(self, starttime):
+        return (datetime.now() - starttime).total_seconds()
 
-            if value.replace("'","") in LOOKUP_VALUES[LOOKUP_FIELDS[field]]:
-                return format_value(str(LOOKUP_VALUES[LOOKUP_FIELDS[field]].index(value.replace("'",""))),'s')
-            else:
-                LOOKUP_VALUES[LOOKUP_FIELDS[field]].append(value.replace("'",""))
-                return format_value(str(LOOKUP_VALUES[LOOKUP_FIELDS[field]].index(value.replace("'",""))),'s')
+    def report_rate(self, starttime):
+        seconds = self.seconds_since(starttime)
+        self.report('%d records in %.1fs: %.0f records/sec'
+                    % (self.n_records, seconds,
+                       self.n_records / seconds if seconds else 0))
+
+    def set_load_pragmas(self, c):
+        """
+        Switch the connection to bulk-load settings, returning the
+        previous values so that restore_pragmas can put them back.
+        """
+        saved = OrderedDict()
+        for (pragma, value) in LOAD_PRAGMAS.items():
+            c.execute('PRAGMA {}'.format(pragma))
+            saved[pragma] = c.fetchone()[0]
+            c.execute('PRAGMA {} = {}'.format(pragma, value))
+        if not self.schema.tables:
+            c.execute('PRAGMA page_size = {}'.format(self.page_size))
+        return saved
 
-#            names = self.table_list(c)
-#            if 'lookup' + field in names:
-#                value = self.lookup_lov('lookup' + field, value, c)
-#            else:
-#                self.lookup_create('lookup' + field, c)
-#                value = self.lookup_lov('lookup' + field, value, c)
-#            return format_value(str(value),'s')
+    def restore_pragmas(self, c, saved):
+        for (pragma, value) in saved.items():
+            c.execute('PRAGMA {} = {}'.format(pragma, value))
 
-    def lookup_create(self, table, c):
-        c.execute('CREATE TABLE {} (value TEXT, name TEXT)' .format(table))
+    def index_columns(self, table, columns):
+        """
+        The columns of table to index, and whether the index is unique.
+        """
+        if table in self.lookup_tables:
+            return [('value', True)]
+        elif table == LOAD_STATE_TABLE or table in WITHOUT_ROWID_TABLES:
+            return []  # keyed already
+        elif table in CHILD_INDEXES:
+            return [(CHILD_INDEXES[table], False)]
+        times = [column for column in TIME_INDEX_COLUMNS if column in columns]
+        return [(column, False)
+                for column in times[:1] + [column for column in INDEXED_LOOKUPS
+                                           if column in columns]]
+
+    def build_indexes(self, c):
+        """
+        Index the tables once they are loaded (rather than maintaining
+        the indexes row by row during the load), then run ANALYZE so
+        that the query planner has statistics to choose them with.
+        Indexes from an earlier load are kept.
+        """
+        starttime = datetime.now()
+        c.execute('SELECT name FROM sqlite_master WHERE type = \'table\' '
+                  'AND name NOT LIKE \'sqlite_%\'')
+        for (table,) in c.fetchall():
+            c.execute('PRAGMA table_info({})'.format(table))
+            columns = [row[1] for row in c.fetchall()]
+            for (column, unique) in self.index_columns(table, columns):
+                c.execute('CREATE {}INDEX IF NOT EXISTS ix_{}_{} ON {} ({})'
+                          .format('UNIQUE ' if unique else '',
+                                  table, column, table, column))
+        self.timings['index'] = self.seconds_since(starttime)
+        starttime = datetime.now()
+        c.execute('ANALYZE')
+        self.timings['analyze'] = self.seconds_since(starttime)
+
+    def vacuum(self, c, db_path):
+        """
+        Replace the database at db_path with a compacted copy written
+        by VACUUM INTO, with pages of self.page_size bytes.
+        """
+        starttime = datetime.now()
+        vacuumed = db_path + '.vacuum'
+        if os.path.exists(vacuumed):
+            os.remove(vacuumed)
+        c.execute('PRAGMA page_size = {}'.format(self.page_size))
+        c.execute('VACUUM INTO ?', (vacuumed,))
+        c.connection.close()
+        os.remove(db_path)
+        os.rename(vacuumed, db_path)
+        self.timings['vacuum'] = self.seconds_since(starttime)
+
+    def already_loaded(self, tag, attributes):
+        """
+        Check (and advance) the high-water mark for a record.
+        """
+        kind = attributes['type'] if tag == 'Record' else tag
+        return self.marks.seen(kind, attributes)
+
+    def write_records(self, tag, attributes, c, children=None):
+        """
+        Queue a record, and any children it has, for insertion.
+        """
+        kind = attributes['type'] if tag == 'Record' else tag
+        encode = self.codecs.get(kind)
+        if encode is None:
+            encode = self.compile_codec(tag, kind, attributes, c)
+
+        values = encode(attributes)
+        rowid = self.schema.next_rowid(kind)
+        values.append(rowid)
+        self.write_record(kind, values, c)
+        if children:
+            self.write_children(kind, rowid, children, c)
+        if kind in self.members.kinds:
+            self.write_members(self.members.record(kind, attributes, rowid),
+                               c)
+        if self.rollups is not None:
+            self.rollups.add(tag, kind, attributes)
+
+    def compile_codec(self, tag, kind, attributes, c):
+        """
+        Compile the row codec for kind, which converts each field with
+        sql_value and interns those with lookups, creating the table for
+        kind if necessary.
+        """
+        version = attributes['type'] if tag == 'Record' else "1"
+        columns = self.schema.fields(tag, version, kind, attributes, c)
+        self.codecs[kind] = self.compile_columns(columns)
+        self.members.add_kind(kind)
+        return self.codecs[kind]
+
+    def compile_columns(self, columns):
+        return rowcodec.compile_codec(
+            rowcodec.codec_fields(columns, SQL_CONVERTERS,
+                                  dict((column, dimension.intern)
+                                       for (column, dimension)
+                                       in self.field_lookups.items())),
+            default='')
+
+    def write_records_timed(self, tag, attributes, c, children=None):
+        """
+        write_records, recording the time spent in each stage, and the
+        record, in self.metrics. To time formatting and interning
+        separately, this goes through the field plan a field at a time
+        rather than using the compiled codec.
+        """
+        stages = self.metrics.stages
+        clock = loadmetrics.clock
+        start = clock()
+        kind = attributes['type'] if tag == 'Record' else tag
+        version = attributes['type'] if tag == 'Record' else "1"
+        if kind not in self.codecs:
+            self.compile_codec(tag, kind, attributes, c)
+
+        columns = self.schema.fields(tag, version, kind, attributes, c)
+        formatted = [sql_value(attributes.get(field, ''), datatype)
+                     for (column, field, datatype) in columns]
+        formatting = clock()
+        values = [self.lookup(column, value)
+                  for ((column, field, datatype), value)
+                  in zip(columns, formatted)]
+        looking_up = clock()
+        rowid = self.schema.next_rowid(kind)
+        values.append(rowid)
+        self.write_record(kind, values, c)
+        if children:
+            self.write_children(kind, rowid, children, c)
+        if kind in self.members.kinds:
+            self.write_members(self.members.record(kind, attributes, rowid),
+                               c)
+        writing = clock()
+        if self.rollups is not None:
+            self.rollups.add(tag, kind, attributes)
+        stages['format'] += formatting - start
+        stages['lookup'] += looking_up - formatting
+        stages['write'] += writing - looking_up
+        stages['rollup'] += clock() - writing
+        self.metrics.add(kind)
+
+    def write_children(self, kind, rowid, children, c):
+        """
+        Queue the rows for the children of the record with the given
+        rowid in kind's table: its metadata, if that is being kept, the
+        links to its members if it is a Correlation, and rows in
+        CHILD_TABLES for those with a table of their own, noting any
+        route files to load.
+        """
+        metadata = []
+        links = []
+        for (tag, attributes) in children:
+            if tag == 'MetadataEntry':
+                if self.metadata:
+                    metadata.append((attributes.get('key'),
+                                     attributes.get('value')))
+            elif tag == 'Record':
+                link = self.members.member(rowid, attributes)
+                if link is not None:
+                    links.append(link)
+            elif tag in CHILD_TABLES:
+                self.write_child(tag, rowid, attributes, c)
+                if (tag == 'WorkoutRoute' and attributes.get('path')
+                        and self.routes is not None):
+                    self.routes.append((rowid, attributes['path']))
+        if metadata:
+            self.write_metadata(kind, rowid, metadata, c)
+        if links:
+            self.write_members(links, c)
+
+    def write_child(self, tag, parent, attributes, c):
+        """
+        Queue a row of tag's table in CHILD_TABLES, linked to the record
+        with rowid parent.
+        """
+        encode = self.codecs.get(tag)
+        if encode is None:
+            (parent_column, fields) = CHILD_TABLES[tag]
+            columns = date_columns(fields, self.schema.dates)
+            self.schema.register(tag, [(parent_column, parent_column, 'n')]
+                                 + columns, c)
+            encode = self.codecs[tag] = self.compile_columns(columns)
+        self.write_record(tag, [parent] + encode(attributes), c)
+
+    def write_members(self, links, c):
+        """
+        Queue a row of CORRELATION_MEMBER_TABLE for each
+        (correlation, kind, rowid) link, with kind interned.
+        """
+        if CORRELATION_MEMBER_TABLE not in self.schema.inserts:
+            self.schema.register(CORRELATION_MEMBER_TABLE,
+                                 CORRELATION_MEMBER_COLUMNS, c)
+        types = self.field_lookups['type']
+        for (correlation, kind, rowid) in links:
+            self.write_record(CORRELATION_MEMBER_TABLE,
+                              [correlation, types.intern(kind), rowid], c)
+
+    def write_metadata(self, kind, rowid, metadata, c):
+        """
+        Queue a row of METADATA_TABLE for each (key, value) pair in
+        metadata, linked to the record with the given rowid in kind's
+        table, with kind and key interned.
+        """
+        if METADATA_TABLE not in self.schema.inserts:
+            self.schema.register(METADATA_TABLE, METADATA_COLUMNS, c)
+        kind_id = self.field_lookups['type'].intern(kind)
+        keys = self.field_lookups['metadataKey']
+        for (key, value) in metadata:
+            self.write_record(METADATA_TABLE,
+                              [kind_id, rowid, keys.intern(key), value], c)
+
+    def load_routes(self, path, c):
+        """
+        Parse the GPX files of the workout routes found during the load
+        in a pool of self.route_jobs processes, and write their track
+        points to ROUTE_POINT_TABLE. The table is keyed by workout rowid
+        and UTC time, so the points of a workout are stored together, in
+        time order, without a separate index; a point at the same time
+        as one already there is dropped.
+        """
+        starttime = datetime.now()
+        c.execute('CREATE TABLE IF NOT EXISTS {} (workout INTEGER, {}, '
+                  'PRIMARY KEY (workout, timeUtc)) WITHOUT ROWID'
+                  .format(ROUTE_POINT_TABLE,
+                          ', '.join('{} {}'.format(column, 'INTEGER'
+                                                   if column == 'timeUtc'
+                                                   else 'REAL')
+                                    for column in ROUTE_POINT_COLUMNS)))
+        insert = 'INSERT OR IGNORE INTO {} VALUES ({})'.format(
+            ROUTE_POINT_TABLE, ', '.join('?' * (len(ROUTE_POINT_COLUMNS) + 1)))
+        jobs = [(path, workout, name) for (workout, name) in self.routes]
+        n_points = 0
+        missing = []
+        for (workout, name, points) in healthexport.parallel_map(
+                parse_route, jobs, min(self.route_jobs, len(jobs))):
+            if points is None:
+                missing.append(name)
+                continue
+            c.executemany(insert, [(workout,) + point for point in points])
+            n_points += len(points)
+        self.timings['routes'] = self.seconds_since(starttime)
+        self.report('%d route points from %d files'
+                    % (n_points, len(jobs) - len(missing)))
+        if missing:
+            self.report('%d route files were missing, including %s'
+                        % (len(missing), missing[0]))
+        self.routes = []
+
+    def lookup(self, field, value):
+        dimension = self.field_lookups.get(field)
+        if dimension is None:
+            return value
+        else:
+            return dimension.intern(value)
+
+    def load_lookups(self, c):
+        """
+        Create a LookupDimension for each lookup dimension, seeded from
+        any z* table already in the database so that ids are stable
+        across runs.
+        """
+        names = self.schema.tables
+        self.lookups = OrderedDict()
+        for name in LOOKUP_FIELDS.values():
+            if name not in self.lookups:
+                self.lookups[name] = LookupDimension(name)
+                if self.lookups[name].table in names:
+                    self.lookups[name].load(c)
+        self.field_lookups = dict((field, self.lookups[name])
+                                  for (field, name) in LOOKUP_FIELDS.items())
+        self.lookup_tables = set(dimension.table
+                                 for dimension in self.lookups.values())
 
     def lookup_output(self, c):
-        for lst in LOOKUP_VALUES:
-            self.lookup_create('z' + lst,c)
-        
-            for value in LOOKUP_VALUES[lst]:
-                # Insert the missing value
-                script = 'INSERT INTO {} (value, name) VALUES ({}, {})' .format('z' + lst, format_value(str(LOOKUP_VALUES[lst].index(value)),'s'), format_value(value,'s'))
-                c.execute(script)
+        for dimension in self.lookups.values():
+            dimension.write(c)
 
     # def lookup_table(self, table, value, c):
     #     script = 'SELECT value, name FROM {} WHERE name = {}' .format(table, value)
@@ -342,30 +1682,129 @@ class HealthDataExtractorEV(object):
     #     for row in rows:
     #         if row[1] == value.replace("'",""):
     #             return row[0]
-        
+
     #     # Insert the missing value
     #     script = 'INSERT INTO {} (name) VALUES ({})' .format(table, value)
     #     c.execute(script)
     #     return self.lookup_lov(table, value, c)
 
-    def table_list(self, c):
-        c.execute('SELECT name FROM sqlite_master WHERE type =\'table\' AND name NOT LIKE \'sqlite_%\';')
-        names = [tup[0] for tup in c.fetchall()]
-        return names
+    def write_record(self, kind, values, c):
+        rows = self.pending.get(kind)
+        if rows is None:
+            rows = self.pending[kind] = []
+        rows.append(values)
+        if len(rows) >= self.batch_size:
+            self.flush(kind, c)
 
-    def open_for_writing(self, tag, version, kind, c):
-        fl = ', '.join('{} {}'.format(key, dtype(value)) for key, value in FIELDS[tag][version].items())
-        c.execute('CREATE TABLE {} ({})' .format(kind, fl))
+    def flush(self, kind, c):
+        """
+        Write the rows buffered for kind with a single prepared statement.
+        """
+        rows = self.pending[kind]
+        if rows:
+            c.executemany(self.schema.inserts[kind], rows)
+            self.pending[kind] = []
 
-    def write_record(self, kind, line, c):
-        script = 'INSERT INTO {} VALUES ({})' .format(kind, line)
-        c.execute(script)
+    def flush_all(self, c):
+        for kind in self.pending:
+            self.flush(kind, c)
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('USAGE: python applehealthdata.py /path/to/export.xml',
+    args = sys.argv[1:]
+    incremental = '--incremental' in args
+    if incremental:
+        args.remove('--incremental')
+    jobs = 1
+    if '--jobs' in args and args.index('--jobs') + 1 < len(args):
+        i = args.index('--jobs')
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    parser = 'iterparse'
+    if '--parser' in args and args.index('--parser') + 1 < len(args):
+        i = args.index('--parser')
+        parser = args[i + 1]
+        del args[i:i + 2]
+    dates = 'epoch'
+    if '--dates' in args and args.index('--dates') + 1 < len(args):
+        i = args.index('--dates')
+        dates = args[i + 1]
+        del args[i:i + 2]
+    vacuum = '--vacuum' in args
+    if vacuum:
+        args.remove('--vacuum')
+    metrics = None
+    if '--metrics' in args and args.index('--metrics') + 1 < len(args):
+        i = args.index('--metrics')
+        metrics = args[i + 1]
+        del args[i:i + 2]
+    profile = '--profile' in args
+    if profile:
+        args.remove('--profile')
+    pipeline = '--pipeline' in args
+    if pipeline:
+        args.remove('--pipeline')
+    metadata = '--metadata' in args
+    if metadata:
+        args.remove('--metadata')
+    canonical = '--canonical' in args
+    if canonical:
+        args.remove('--canonical')
+    priority = dedup.SOURCE_PRIORITY
+    if '--priority' in args and args.index('--priority') + 1 < len(args):
+        i = args.index('--priority')
+        priority = args[i + 1].split(',')
+        del args[i:i + 2]
+    kinds = None
+    if '--types' in args and args.index('--types') + 1 < len(args):
+        i = args.index('--types')
+        kinds = args[i + 1].split(',')
+        del args[i:i + 2]
+    bounds = {}
+    for bound in ('start', 'end'):
+        flag = '--' + bound
+        if flag in args and args.index(flag) + 1 < len(args):
+            i = args.index(flag)
+            bounds[bound] = args[i + 1]
+            del args[i:i + 2]
+    routes = '--no-routes' not in args
+    if not routes:
+        args.remove('--no-routes')
+    date_dimension = '--no-date-dimension' not in args
+    if not date_dimension:
+        args.remove('--no-date-dimension')
+    route_jobs = None
+    if '--route-jobs' in args and args.index('--route-jobs') + 1 < len(args):
+        i = args.index('--route-jobs')
+        route_jobs = int(args[i + 1])
+        del args[i:i + 2]
+    page_size = PAGE_SIZE
+    if '--page-size' in args and args.index('--page-size') + 1 < len(args):
+        i = args.index('--page-size')
+        page_size = int(args[i + 1])
+        del args[i:i + 2]
+    if (len(args) != 1 or parser not in healthexport.PARSERS
+            or dates not in DATE_FORMATS):
+        print('USAGE: python applehealthdataeventsqlite.py [--incremental] '
+              '[--jobs N] [--parser iterparse|scan] '
+              '[--dates epoch|text|both] [--vacuum] [--page-size N] '
+              '[--metrics metrics.jsonl] [--profile] [--pipeline] '
+              '[--metadata] [--no-routes] [--route-jobs N] '
+              '[--no-date-dimension] '
+              '[--canonical] [--priority Watch,iPhone] '
+              '[--types VO2Max,...] [--start 2016-04-01] [--end 2016-05-01] '
+              '/path/to/export.xml',
               file=sys.stderr)
         sys.exit(1)
-    data = HealthDataExtractorEV(sys.argv[1])
+    data = HealthDataExtractorEV(args[0], incremental=incremental, jobs=jobs,
+                                 parser=parser, dates=dates, vacuum=vacuum,
+                                 page_size=page_size, metrics=metrics,
+                                 profile=os.path.join(
+                                     healthexport.output_directory(args[0]),
+                                     'profile.txt') if profile else None,
+                                 pipeline=pipeline, metadata=metadata,
+                                 routes=routes, route_jobs=route_jobs,
+                                 canonical=canonical, priority=priority,
+                                 kinds=kinds, date_dimension=date_dimension,
+                                 **bounds)
 #    data.report_stats()
 #    data.extract()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark.py: Time the extractors on synthetic exports of various sizes.
+
+For each size, an export is generated with makeexport.py (and kept in the
+data directory for later runs), then each extractor is run on it in a
+fresh process, recording wall time, records per second and peak RSS.
+The results are saved as JSON, along with the git revision, so that runs
+from different revisions can be compared.
+
+Usage:
+    python benchmark.py [--sizes 10000,100000,1G] [--extractors csv,sqlite]
+                        [--jobs 1,2,4,8] [--data DIR]
+                        [--output results.json] [--compare earlier.json]
+    python benchmark.py --codecs [N]
+
+Sizes are numbers of records, or sizes in bytes with a K, M or G suffix.
+
+--jobs runs the extractors that can parse in parallel (csv-ev and
+sqlite) once for each number of worker processes, recording the wall
+time for each and its speedup over one job, to show how loading scales
+with cores. The csv extractor only runs with one job.
+
+--codecs times the compiled row codecs (see rowcodec.py) for each field
+plan against the field-at-a-time format_value and sql_value path,
+converting N rows (100000 by default) with each.
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+import makeexport
+import rowcodec
+
+from loadmetrics import peak_rss_mb
+
+EXTRACTORS = ('csv', 'csv-ev', 'sqlite')
+# Extractors taking jobs=, for the number of processes parsing the export
+PARALLEL_EXTRACTORS = ('csv-ev', 'sqlite')
+JOBS = (1,)
+CODEC_PLANS = ('RECORD_FIELDS', 'RECORD_FIELDS_HR', 'WORKOUT_FIELDS',
+               'ACTIVITY_SUMMARY_FIELDS')
+# A typical value for each datatype, for the codec benchmark
+SAMPLE_VALUES = {'s': 'NJR Apple\xa0Watch', 'd': '2016-04-01 12:34:56 +0100',
+                 'n': '72'}
+SIZES = ('10000', '100000', '1000000')
+DATA_DIR = 'benchdata'
+
+
+def run_extractor(name, path, output_dir, jobs=1):
+    """
+    Run the named extractor on the export at path, writing to output_dir,
+    with jobs processes parsing it (see PARALLEL_EXTRACTORS).
+    """
+    if name not in PARALLEL_EXTRACTORS and jobs != 1:
+        raise ValueError('The %s extractor runs with one job only' % name)
+    if name == 'csv':
+        from applehealthdata import HealthDataExtractor
+        HealthDataExtractor(path, verbose=False, output_dir=output_dir).extract()
+    elif name == 'csv-ev':
+        from applehealthdataevent import HealthDataExtractorEV
+        HealthDataExtractorEV(path, verbose=False, jobs=jobs,
+                              output_dir=output_dir).close_files()
+    elif name == 'sqlite':
+        from applehealthdataeventsqlite import HealthDataExtractorEV
+        HealthDataExtractorEV(path, verbose=False, jobs=jobs,
+                              output_dir=output_dir)
+    else:
+        raise KeyError('Unexpected extractor: %s' % name)
+
+
+def measure(name, path, jobs=1):
+    """
+    Run an extractor in this process, in a scratch output directory,
+    returning the wall time and peak RSS.
+    """
+    output_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        start = time.time()
+        run_extractor(name, path, output_dir, jobs)
+        seconds = time.time() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+
+
+def measure_in_subprocess(name, path, jobs=1):
+    """
+    Measure an extractor in a fresh interpreter, so that its peak RSS
+    is its own.
+    """
+    output = subprocess.check_output([sys.executable,
+                                      os.path.abspath(__file__),
+                                      '--measure', name, path, str(jobs)])
+    return json.loads(output.decode('UTF-8').strip().splitlines()[-1])
+
+
+def size_label(size):
+    return size if size[-1:].upper() in makeexport.SIZE_SUFFIXES else (
+        '%srecords' % size)
+
+
+def synthetic_export(size, data_dir):
+    """
+    Path to a synthetic export of the given size in data_dir, generating
+    it if necessary, and the number of top-level elements in it.
+    """
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    path = os.path.join(data_dir, 'export-%s.xml' % size_label(size))
+    counts_path = path + '.json'
+    if not (os.path.exists(path) and os.path.exists(counts_path)):
+        if size[-1:].upper() in makeexport.SIZE_SUFFIXES:
+            generator = makeexport.ExportGenerator(
+                size=makeexport.parse_size(size))
+        else:
+            generator = makeexport.ExportGenerator(n_records=int(size))
+        print('Generating %s . . . ' % path, end='')
+        sys.stdout.flush()
+        counts = generator.write(path)
+        print('done')
+        with io.open(counts_path, 'w', encoding='UTF-8') as f:
+            f.write(json.dumps(counts))
+    with io.open(counts_path, encoding='UTF-8') as f:
+        counts = json.load(f)
+    return (path, sum(counts.values()))
+
+
+def git_revision():
+    try:
+        output = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT)
+        return output.decode('UTF-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=SIZES, extractors=EXTRACTORS, data_dir=DATA_DIR,
+                   jobs=JOBS):
+    """
+    Benchmark each extractor on an export of each size, with each number
+    of jobs for those that take one, returning the results as a dict
+    ready to be saved as JSON.
+    """
+    results = []
+    for size in sizes:
+        (path, n_records) = synthetic_export(size, data_dir)
+        n_bytes = os.path.getsize(path)
+        for name in extractors:
+            single = None
+            for n_jobs in (jobs if name in PARALLEL_EXTRACTORS else [1]):
+                result = OrderedDict((('extractor', name), ('size', size),
+                                      ('jobs', n_jobs),
+                                      ('records', n_records),
+                                      ('bytes', n_bytes)))
+                result.update(measure_in_subprocess(name, path, n_jobs))
+                result['records_per_sec'] = n_records / result['seconds']
+                if n_jobs == 1:
+                    single = result['seconds']
+                if single is not None:
+                    result['speedup'] = single / result['seconds']
+                print('%-8s %12s %3d jobs %10d records %8.2fs '
+                      '%10.0f records/sec %8s MB peak'
+                      % (name, size_label(size), n_jobs, n_records,
+                         result['seconds'], result['records_per_sec'],
+                         '%.0f' % result['peak_rss_mb']
+                         if result['peak_rss_mb'] else '?'))
+                results.append(result)
+    return OrderedDict((
+        ('revision', git_revision()),
+        ('date', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', multiprocessing.cpu_count()),
+        ('results', results),
+    ))
+
+
+def rows_per_sec(convert, rows):
+    start = time.time()
+    for attributes in rows:
+        convert(attributes)
+    return len(rows) / (time.time() - start)
+
+
+def codec_benchmark(n_rows=100000):
+    """
+    Rows per second converting each field plan for CSV and SQLite,
+    field at a time and with a compiled codec.
+    """
+    import applehealthdata
+    import applehealthdataeventsqlite as sqlite
+
+    results = []
+    for name in CODEC_PLANS:
+        fields = getattr(sqlite, name)
+        rows = [dict((field, SAMPLE_VALUES[datatype])
+                     for (field, datatype) in fields.items())
+                for i in range(n_rows)]
+        plan = [(field, field, datatype)
+                for (field, datatype) in fields.items()]
+
+        def csv_fields(attributes):
+            return ','.join([applehealthdata.format_value(
+                                attributes.get(field), datatype)
+                             for (field, datatype) in fields.items()]) + '\n'
+
+        csv_codec = rowcodec.compile_codec(
+            rowcodec.codec_fields(plan, applehealthdata.CSV_CONVERTERS),
+            separator=',', terminator='\n')
+
+        columns = sqlite.date_columns(fields, 'epoch')
+        lookups = dict((field, sqlite.LookupDimension(dimension))
+                       for (field, dimension) in sqlite.LOOKUP_FIELDS.items())
+
+        def sql_fields(attributes):
+            values = []
+            for (column, field, datatype) in columns:
+                value = sqlite.sql_value(attributes.get(field, ''), datatype)
+                dimension = lookups.get(column)
+                values.append(value if dimension is None
+                              else dimension.intern(value))
+            return values
+
+        sql_codec = rowcodec.compile_codec(
+            rowcodec.codec_fields(columns, sqlite.SQL_CONVERTERS,
+                                  dict((column, dimension.intern)
+                                       for (column, dimension)
+                                       in lookups.items())),
+            default='')
+
+        for (sink, by_field, codec) in (('csv', csv_fields, csv_codec),
+                                        ('sqlite', sql_fields, sql_codec)):
+            assert by_field(rows[0]) == codec(rows[0])
+            before = rows_per_sec(by_field, rows)
+            after = rows_per_sec(codec, rows)
+            print('%-24s %-7s %10.0f -> %10.0f rows/sec (x%.2f)'
+                  % (name, sink, before, after, after / before))
+            results.append(OrderedDict((('plan', name), ('sink', sink),
+                                        ('field_at_a_time', before),
+                                        ('codec', after))))
+    return results
+
+
+def compare(earlier, later):
+    """
+    Print the ratio of times between two sets of results.
+    """
+    before = dict(((r['extractor'], r['size'], r.get('jobs', 1)), r)
+                  for r in earlier['results'])
+    print('Comparing %s with %s' % (later['revision'], earlier['revision']))
+    for r in later['results']:
+        jobs = r.get('jobs', 1)
+        old = before.get((r['extractor'], r['size'], jobs))
+        if old:
+            print('%-8s %12s %3d jobs %8.2fs -> %8.2fs (x%.2f)'
+                  % (r['extractor'], size_label(r['size']), jobs,
+                     old['seconds'], r['seconds'],
+                     old['seconds'] / r['seconds']))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] == ['--measure'] and len(args) in (3, 4):
+        print(json.dumps(measure(args[1], args[2],
+                                 *[int(arg) for arg in args[3:]])))
+        sys.exit(0)
+    if args[:1] == ['--codecs'] and len(args) <= 2:
+        codec_benchmark(*[int(arg) for arg in args[1:]])
+        sys.exit(0)
+    options = {}
+    for flag in ('--sizes', '--extractors', '--jobs', '--data', '--output',
+                 '--compare'):
+        if flag in args and args.index(flag) + 1 < len(args):
+            i = args.index(flag)
+            options[flag] = args[i + 1]
+            del args[i:i + 2]
+    if args:
+        print('USAGE: python benchmark.py [--sizes 10000,100000,1G] '
+              '[--extractors %s] [--jobs 1,2,4,8] [--data DIR] '
+              '[--output results.json] [--compare earlier.json]\n'
+              '       python benchmark.py --codecs [N]' % ','.join(EXTRACTORS),
+              file=sys.stderr)
+        sys.exit(1)
+    results = run_benchmarks(
+        sizes=options.get('--sizes', ','.join(SIZES)).split(','),
+        extractors=options.get('--extractors',
+                               ','.join(EXTRACTORS)).split(','),
+        data_dir=options.get('--data', DATA_DIR),
+        jobs=[int(n) for n in options.get('--jobs', ','.join(
+            '%d' % n for n in JOBS)).split(',')])
+    output = options.get('--output',
+                         'benchmark-%s.json' % (results['revision'] or 'run'))
+    with io.open(output, 'w', encoding='UTF-8') as f:
+        f.write(json.dumps(results, indent=2))
+    print('Results written to %s' % output)
+    if '--compare' in options:
+        with io.open(options['--compare'], encoding='UTF-8') as f:
+            compare(json.load(f), results)
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+cohort.py: Load the exports of many people (or many exports of one
+person) into a single SQLite store, cohort.sqlite:
+
+    python cohort.py [--jobs N] [--output cohort.sqlite] [--metadata]
+                     [--no-routes] [--canonical] [--dates epoch|text|both]
+                     [alice=]/path/to/export.zip [bob=]/path/to/export.xml ...
+
+Each export is loaded into a staging database of its own by
+applehealthdataeventsqlite.py, in a pool of N processes (one per CPU by
+default), and merged into the store as soon as it is done, while the
+others are still loading. The store has the tables a single load has,
+with an export column added to each, and an ExportFile table giving
+each export's id, person and path. The person is the name before the =,
+if there is one, or else the name of the directory holding the export.
+
+Lookup ids are shared across exports, so each z* table has one row per
+distinct name in the cohort, and rowids are renumbered as they are
+merged, so the Metadata, CorrelationRecord, WorkoutEvent, WorkoutRoute
+and RoutePoint rows still point at the right records. DateDimension is
+shared too, and covers the dates of all the exports. Loading an export
+that is already in the store (by path) replaces it.
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+from collections import OrderedDict
+from datetime import datetime
+from xml.etree import ElementTree
+
+import dedup
+import healthexport
+
+from applehealthdataeventsqlite import (CHILD_INDEXES, CORRELATION_MEMBER_TABLE,
+                                        DATE_DIMENSION_TABLE, DATE_FORMATS,
+                                        DateDimension, HealthDataExtractorEV,
+                                        INDEXED_LOOKUPS, LOAD_PRAGMAS,
+                                        LOAD_STATE_TABLE, LOOKUP_FIELDS,
+                                        LookupDimension, METADATA_TABLE,
+                                        ROUTE_POINT_TABLE, TIME_INDEX_COLUMNS,
+                                        WITHOUT_ROWID_TABLES)
+
+VERBOSE = True
+
+# Table with a row for each export in the store
+EXPORT_TABLE = 'ExportFile'
+# Column added to every other table, holding the export's id
+EXPORT_COLUMN = 'export'
+# Columns holding the rowid of a row in another table, by (table,
+# column): the table referred to, or None where it is the table of the
+# row's type
+ROWID_COLUMNS = {
+    (METADATA_TABLE, 'record'): None,
+    (CORRELATION_MEMBER_TABLE, 'correlation'): 'Correlation',
+    (CORRELATION_MEMBER_TABLE, 'record'): None,
+    ('WorkoutEvent', 'workout'): 'Workout',
+    ('WorkoutRoute', 'workout'): 'Workout',
+    (ROUTE_POINT_TABLE, 'workout'): 'Workout',
+}
+DIMENSIONS = tuple(OrderedDict.fromkeys(LOOKUP_FIELDS.values()))
+DIMENSION_TABLES = tuple('z' + name for name in DIMENSIONS)
+# Errors that fail one export without stopping the others
+LOAD_ERRORS = (IOError, OSError, ElementTree.ParseError, sqlite3.Error)
+
+
+def person_name(path):
+    """
+    The default name of the person whose export is at path: the name of
+    the directory holding it, or holding apple_health_export if that is
+    where it is.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if os.path.basename(directory) == 'apple_health_export':
+        directory = os.path.dirname(directory)
+    return os.path.basename(directory)
+
+
+def stage_export(job):
+    """
+    Worker for cohort loads: given (export id, export path, staging
+    directory, extractor options), load the export into export.sqlite
+    in the staging directory, returning (export id, path to the staged
+    database, number of records, seconds taken, error), with the error
+    None if the load worked.
+    """
+    (export, path, directory, options) = job
+    starttime = datetime.now()
+    try:
+        data = HealthDataExtractorEV(path, verbose=False, output_dir=directory,
+                                     indexes=False, route_jobs=1,
+                                     date_dimension=False, **options)
+    except LOAD_ERRORS as e:
+        return (export, None, 0, 0, '%s: %s' % (type(e).__name__, e))
+    return (export, os.path.join(directory, 'export.sqlite'), data.n_records,
+            (datetime.now() - starttime).total_seconds(), None)
+
+
+class Cohort(object):
+    """
+    A store holding the exports of a cohort.
+
+    Inputs:
+        path:       Path to the store, created if it doesn't exist
+        verbose:    Set to False for less output
+
+    The dimensions are held as LookupDimensions, seeded from the store,
+    so each staged database's names are interned in memory and only new
+    names are written.
+    """
+    def __init__(self, path, verbose=VERBOSE):
+        self.path = path
+        self.verbose = verbose
+        self.conn = sqlite3.connect(path)
+        c = self.conn.cursor()
+        for (pragma, value) in LOAD_PRAGMAS.items():
+            c.execute('PRAGMA {} = {}'.format(pragma, value))
+        c.execute('CREATE TABLE IF NOT EXISTS {} ({} INTEGER PRIMARY KEY, '
+                  'person TEXT, path TEXT UNIQUE, records INTEGER, '
+                  'loaded TEXT)'.format(EXPORT_TABLE, EXPORT_COLUMN))
+        self.tables = self.read_tables('main', c)
+        self.dimensions = OrderedDict()
+        for name in DIMENSIONS:
+            dimension = self.dimensions[name] = LookupDimension(name)
+            if dimension.table in self.tables:
+                dimension.load(c)
+        self.timings = OrderedDict((('load', 0), ('merge', 0), ('dates', 0),
+                                    ('index', 0)))
+
+    def report(self, msg):
+        if self.verbose:
+            print(msg)
+            sys.stdout.flush()
+
+    def close(self):
+        self.conn.close()
+
+    def read_tables(self, schema, c):
+        """
+        OrderedDict from the name of each table in schema ('main' or
+        'stage') to the rows of its PRAGMA table_info.
+        """
+        tables = OrderedDict()
+        c.execute('SELECT name FROM {}.sqlite_master WHERE type = \'table\' '
+                  'AND name NOT LIKE \'sqlite_%\''.format(schema))
+        for (name,) in c.fetchall():
+            c.execute('PRAGMA {}.table_info({})'.format(schema, name))
+            tables[name] = c.fetchall()
+        return tables
+
+    def register(self, path, person=None):
+        """
+        The id of the export at path, adding it to EXPORT_TABLE if it
+        isn't there already.
+        """
+        path = os.path.abspath(path)
+        person = person or person_name(path)
+        c = self.conn.cursor()
+        c.execute('SELECT {} FROM {} WHERE path = ?'
+                  .format(EXPORT_COLUMN, EXPORT_TABLE), (path,))
+        row = c.fetchone()
+        if row is not None:
+            c.execute('UPDATE {} SET person = ? WHERE {} = ?'
+                      .format(EXPORT_TABLE, EXPORT_COLUMN), (person, row[0]))
+            export = row[0]
+        else:
+            c.execute('INSERT INTO {} (person, path) VALUES (?, ?)'
+                      .format(EXPORT_TABLE), (person, path))
+            export = c.lastrowid
+        self.conn.commit()
+        return export
+
+    def load(self, exports, jobs=None, **options):
+        """
+        Load each of exports, a list of paths or (person, path) pairs,
+        in a pool of jobs processes (by default, one per CPU), merging
+        each into the store as it finishes, then extend DateDimension
+        and index the store.
+        options are passed on to HealthDataExtractorEV.
+
+        Returns a dict from export id to the number of records loaded,
+        leaving out any export that failed to load.
+        """
+        starttime = datetime.now()
+        staging = tempfile.mkdtemp(
+            prefix='staging', dir=os.path.dirname(os.path.abspath(self.path)))
+        work = []
+        for item in exports:
+            (person, path) = ((None, item)
+                              if isinstance(item, healthexport.string_types)
+                              else item)
+            export = self.register(path, person)
+            if any(export == job[0] for job in work):
+                continue
+            work.append((export, path, os.path.join(staging, '%d' % export),
+                         options))
+            os.mkdir(work[-1][2])
+        paths = dict((export, path) for (export, path, d, o) in work)
+        loaded = {}
+        jobs = min(jobs or multiprocessing.cpu_count(), len(work))
+        try:
+            for (export, db_path, n_records, seconds, error) in (
+                    healthexport.parallel_map(stage_export, work, jobs)):
+                if error is not None:
+                    self.report('%s failed to load: %s'
+                                % (paths[export], error))
+                    continue
+                merging = datetime.now()
+                self.merge(export, db_path, n_records)
+                shutil.rmtree(os.path.dirname(db_path))
+                merged = (datetime.now() - merging).total_seconds()
+                self.timings['merge'] += merged
+                loaded[export] = n_records
+                self.report('%s (export %d): %d records loaded in %.1fs, '
+                            'merged in %.1fs' % (paths[export], export,
+                                                 n_records, seconds, merged))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        self.timings['load'] = ((datetime.now() - starttime).total_seconds()
+                                - self.timings['merge'])
+        dating = datetime.now()
+        DateDimension().write(self.conn.cursor())
+        self.conn.commit()
+        self.tables = self.read_tables('main', self.conn.cursor())
+        self.timings['dates'] = (datetime.now() - dating).total_seconds()
+        self.build_indexes()
+        n_records = sum(loaded.values())
+        seconds = (datetime.now() - starttime).total_seconds()
+        self.report('%d records from %d exports in %.1fs: %.0f records/sec'
+                    % (n_records, len(loaded), seconds,
+                       n_records / seconds if seconds else 0))
+        self.report(', '.join('%s %.1fs' % item
+                              for item in self.timings.items()))
+        return loaded
+
+    def merge(self, export, db_path, n_records=None):
+        """
+        Copy the tables of the staged database at db_path into the store
+        as export, replacing any rows the store has for it already.
+        """
+        c = self.conn.cursor()
+        c.execute('ATTACH DATABASE ? AS stage', (db_path,))
+        try:
+            stage = self.read_tables('stage', c)
+            self.delete_export(export, c)
+            self.map_dimensions(stage, c)
+            offsets = {}
+            for table in stage:
+                if table in self.tables and table not in WITHOUT_ROWID_TABLES:
+                    c.execute('SELECT MAX(rowid) FROM main.{}'.format(table))
+                    offsets[table] = c.fetchone()[0] or 0
+            c.execute('CREATE TEMP TABLE kind_offset (old TEXT PRIMARY KEY, '
+                      'offset INTEGER)')
+            if 'ztype' in stage:
+                c.execute('SELECT value, name FROM stage.ztype')
+                c.executemany('INSERT INTO temp.kind_offset VALUES (?, ?)',
+                              [(value, offsets.get(name, 0))
+                               for (value, name) in c.fetchall()])
+            for (table, info) in stage.items():
+                if (table not in DIMENSION_TABLES
+                        and table not in (LOAD_STATE_TABLE,
+                                          DATE_DIMENSION_TABLE)):
+                    self.merge_table(export, table, info, offsets, c)
+            c.execute('UPDATE {} SET records = ?, loaded = ? WHERE {} = ?'
+                      .format(EXPORT_TABLE, EXPORT_COLUMN),
+                      (n_records, datetime.now().isoformat(' ')[:19],
+                       export))
+            self.conn.commit()
+        finally:
+            self.conn.commit()
+            for name in ['kind_offset'] + ['map_' + d for d in DIMENSIONS]:
+                c.execute('DROP TABLE IF EXISTS temp.{}'.format(name))
+            c.execute('DETACH DATABASE stage')
+
+    def delete_export(self, export, c):
+        for (table, info) in self.tables.items():
+            if table != EXPORT_TABLE and info[0][1] == EXPORT_COLUMN:
+                c.execute('DELETE FROM main.{} WHERE {} = ?'
+                          .format(table, EXPORT_COLUMN), (export,))
+
+    def map_dimensions(self, stage, c):
+        """
+        Intern the names in each of the staged database's z* tables,
+        writing any new ones to the store, and put a temp.map_<name>
+        table from each staged id to the store's id.
+        """
+        for (name, dimension) in self.dimensions.items():
+            if dimension.table not in stage:
+                continue
+            if dimension.table not in self.tables:
+                c.execute('CREATE TABLE main.{} (value TEXT, name TEXT)'
+                          .format(dimension.table))
+                self.tables[dimension.table] = [(0, 'value'), (1, 'name')]
+            c.execute('CREATE TEMP TABLE map_{} (old TEXT PRIMARY KEY, '
+                      'new TEXT)'.format(name))
+            c.execute('SELECT value, name FROM stage.{}'
+                      .format(dimension.table))
+            c.executemany('INSERT INTO temp.map_{} VALUES (?, ?)'.format(name),
+                          [(value, dimension.intern(label))
+                           for (value, label) in c.fetchall()])
+            c.executemany('INSERT INTO main.{} (value, name) VALUES (?, ?)'
+                          .format(dimension.table), dimension.new)
+            dimension.new = []
+
+    def merge_table(self, export, table, info, offsets, c):
+        """
+        Copy a staged table into the store's table of the same name,
+        creating or widening it as needed, with lookup ids mapped to the
+        store's, rowids (and the columns referring to them) moved past
+        those already there, and the export column set to export.
+        """
+        columns = [row[1] for row in info]
+        types = dict((row[1], row[2]) for row in info)
+        without_rowid = table in WITHOUT_ROWID_TABLES
+        if table not in self.tables:
+            definitions = ', '.join(['{} INTEGER'.format(EXPORT_COLUMN)]
+                                    + ['{} {}'.format(column, types[column])
+                                       for column in columns])
+            if without_rowid:
+                keys = [row[1] for row in sorted(info, key=lambda r: r[5])
+                        if row[5]]
+                c.execute('CREATE TABLE main.{} ({}, PRIMARY KEY ({})) '
+                          'WITHOUT ROWID'.format(
+                              table, definitions,
+                              ', '.join([EXPORT_COLUMN] + keys)))
+            else:
+                c.execute('CREATE TABLE main.{} ({})'
+                          .format(table, definitions))
+        else:
+            existing = set(row[1] for row in self.tables[table])
+            for column in columns:
+                if column not in existing:
+                    c.execute('ALTER TABLE main.{} ADD COLUMN {} {}'
+                              .format(table, column, types[column]))
+        c.execute('PRAGMA main.table_info({})'.format(table))
+        self.tables[table] = c.fetchall()
+
+        joins = []
+        values = []
+        for column in columns:
+            value = 's.{}'.format(column)
+            dimension = LOOKUP_FIELDS.get(column)
+            if dimension is not None and 'z' + dimension in self.tables:
+                alias = 'm{}'.format(len(joins))
+                joins.append('LEFT JOIN temp.map_{} {} ON {}.old = s.{}'
+                             .format(dimension, alias, alias, column))
+                value = '{}.new'.format(alias)
+            parent = ROWID_COLUMNS.get((table, column), False)
+            if (parent is False and column == 'record'
+                    and table.endswith(dedup.CANONICAL_SUFFIX)):
+                parent = table[:-len(dedup.CANONICAL_SUFFIX)]
+            if parent is None:
+                joins.append('LEFT JOIN temp.kind_offset k '
+                             'ON k.old = s.type')
+                value = 's.{} + k.offset'.format(column)
+            elif parent is not False:
+                value = 's.{} + {:d}'.format(column, offsets.get(parent, 0))
+            values.append(value)
+        names = [EXPORT_COLUMN] + columns
+        values = ['{:d}'.format(export)] + values
+        if not without_rowid:
+            names.append('rowid')
+            values.append('s.rowid + {:d}'.format(offsets.get(table, 0)))
+        c.execute('INSERT INTO main.{} ({}) SELECT {} FROM stage.{} s {}{}'
+                  .format(table, ', '.join(names), ', '.join(values), table,
+                          ' '.join(joins),
+                          '' if without_rowid else ' ORDER BY s.rowid'))
+
+    def index_columns(self, table, columns):
+        """
+        The columns (or comma-separated lists of columns) of table to
+        index, and whether the index is unique: the export and time
+        columns together for the record tables, so that queries for one
+        export's records in a time range use a single index.
+        """
+        if table in DIMENSION_TABLES:
+            return [('value', True)]
+        elif (table in (EXPORT_TABLE, LOAD_STATE_TABLE, DATE_DIMENSION_TABLE)
+                or table in WITHOUT_ROWID_TABLES):
+            return []
+        elif table in CHILD_INDEXES:
+            return [(CHILD_INDEXES[table], False)]
+        times = [column for column in TIME_INDEX_COLUMNS if column in columns]
+        return [(', '.join([EXPORT_COLUMN] + times[:1]), False)] + [
+            (column, False) for column in INDEXED_LOOKUPS
+            if column in columns]
+
+    def build_indexes(self):
+        """
+        Index the store, once the exports are merged, and run ANALYZE.
+        """
+        starttime = datetime.now()
+        c = self.conn.cursor()
+        for (table, info) in self.tables.items():
+            columns = [row[1] for row in info]
+            for (column, unique) in self.index_columns(table, columns):
+                c.execute('CREATE {}INDEX IF NOT EXISTS ix_{}_{} ON {} ({})'
+                          .format('UNIQUE ' if unique else '', table,
+                                  column.replace(', ', '_'), table, column))
+        c.execute('ANALYZE')
+        self.conn.commit()
+        self.timings['index'] = (datetime.now() - starttime).total_seconds()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    jobs = None
+    if '--jobs' in args and args.index('--jobs') + 1 < len(args):
+        i = args.index('--jobs')
+        jobs = int(args[i + 1])
+        del args[i:i + 2]
+    output = 'cohort.sqlite'
+    if '--output' in args and args.index('--output') + 1 < len(args):
+        i = args.index('--output')
+        output = args[i + 1]
+        del args[i:i + 2]
+    options = {}
+    dates = 'epoch'
+    if '--dates' in args and args.index('--dates') + 1 < len(args):
+        i = args.index('--dates')
+        dates = args[i + 1]
+        del args[i:i + 2]
+    options['dates'] = dates
+    for (flag, option, value) in (('--metadata', 'metadata', True),
+                                  ('--no-routes', 'routes', False),
+                                  ('--canonical', 'canonical', True)):
+        if flag in args:
+            args.remove(flag)
+            options[option] = value
+    if not args or dates not in DATE_FORMATS:
+        print('USAGE: python cohort.py [--jobs N] [--output cohort.sqlite] '
+              '[--metadata] [--no-routes] [--canonical] '
+              '[--dates epoch|text|both] '
+              '[person=]/path/to/export.zip ...',
+              file=sys.stderr)
+        sys.exit(1)
+    exports = []
+    for arg in args:
+        (person, equals, path) = arg.partition('=')
+        if equals and not os.path.exists(arg):
+            exports.append((person, path))
+        else:
+            exports.append(arg)
+    cohort = Cohort(output)
+    cohort.load(exports, jobs, **options)
+    cohort.close()
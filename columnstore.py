@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+columnstore.py: A columnar, memory-mappable store for Apple Health data.
+
+Each kind of record (StepCount, HeartRate, Workout, ...) gets its own
+directory holding one little-endian binary file per column, plus a
+manifest.json describing them. The columns follow the 'n'/'d'/'s' type
+codes in applehealthdata's field lists:
+
+    'n' numbers:  float64, NaN where missing. Any values that are not
+                  numbers (category values such as
+                  HKCategoryValueSleepAnalysisInBed) are kept in a
+                  companion string column, <field>Text.
+    'd' dates:    int64 UTC seconds since the epoch, with the timezone
+                  in an int32 column, <field>Offset, in seconds east
+                  of UTC. Missing dates are MISSING_DATE.
+    's' strings:  int32 codes (MISSING_CODE where missing) into a
+                  dictionary of distinct values, <field>.json.
+
+ColumnStore reads a store back, memory-mapping each column, as a NumPy
+array if NumPy is installed, or otherwise as a memoryview, so loading a
+column costs next to nothing however large it is.
+
+MemoryColumnStore keeps the same columns in memory instead, as arrays,
+for loading a whole export for analysis: a few dozen bytes a record,
+rather than an Element and a dict of strings for each.
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import mmap
+import os
+import sys
+
+from array import array
+
+import healthexport
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+
+# Column storage: (array typecode, NumPy dtype, file suffix)
+STORAGE = {
+    'float64': ('d', '<f8', '.f8'),
+    'int64': ('q', '<i8', '.i8'),
+    'int32': ('i', '<i4', '.i4'),
+}
+
+MISSING_DATE = -(1 << 63)
+MISSING_CODE = -1
+
+# Values buffered per column before being appended to its file
+BUFFER_ROWS = 1 << 16
+
+
+class Column(object):
+    """
+    A single binary column being written: values are buffered in an
+    array and appended to the column's file in blocks.
+
+    With a directory of None, the column is kept in memory: all its
+    values stay in the array.
+    """
+    datatype = None
+
+    def __init__(self, directory, name, storage, rows=0, missing=None):
+        self.name = name
+        self.storage = storage
+        (typecode, dtype, suffix) = STORAGE[storage]
+        self.filename = name + suffix
+        self.values = array(typecode)
+        self.path = self.f = None
+        if directory is not None:
+            self.path = os.path.join(directory, self.filename)
+            self.f = open(self.path, 'wb')
+        if rows:
+            # the column was started part way through its table
+            self.values.extend([missing] * rows)
+            self.flush()
+
+    def append(self, value):
+        self.values.append(value)
+        if len(self.values) >= BUFFER_ROWS and self.f is not None:
+            self.flush()
+
+    def flush(self):
+        if self.f is None:
+            return
+        if sys.byteorder == 'big':
+            self.values.byteswap()
+        self.values.tofile(self.f)
+        del self.values[:]
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+
+    def description(self):
+        return {'name': self.name, 'type': self.datatype,
+                'storage': self.storage, 'file': self.filename}
+
+
+class NumberColumn(Column):
+    """
+    A number column, with a string column for any values that aren't
+    numbers, started when the first of those turns up.
+    """
+    datatype = 'n'
+
+    def __init__(self, directory, name):
+        Column.__init__(self, directory, name, 'float64')
+        self.directory = directory
+        self.rows = 0
+        self.text = None
+
+    def add(self, value):
+        number = float('nan')
+        is_text = False
+        if value:
+            try:
+                number = float(value)
+            except ValueError:
+                if self.text is None:
+                    self.text = StringColumn(self.directory,
+                                             self.name + 'Text', self.rows)
+                self.text.add(value)
+                is_text = True
+        if self.text is not None and not is_text:
+            self.text.add(None)
+        self.append(number)
+        self.rows += 1
+
+    def columns(self):
+        return [self] + ([self.text] if self.text else [])
+
+
+class DateColumn(Column):
+    """
+    A date column, as UTC seconds, with its offsets alongside.
+    """
+    datatype = 'd'
+
+    def __init__(self, directory, name):
+        Column.__init__(self, directory, name, 'int64')
+        self.offsets = Column(directory, name + 'Offset', 'int32')
+
+    def add(self, value):
+        if value:
+            (seconds, offset) = healthexport.timestamp_parts(value)
+        else:
+            (seconds, offset) = (MISSING_DATE, 0)
+        self.append(seconds)
+        self.offsets.append(offset)
+
+    def columns(self):
+        return [self, self.offsets]
+
+    def description(self):
+        d = Column.description(self)
+        d['offsets'] = self.offsets.name
+        return d
+
+
+class StringColumn(Column):
+    """
+    A dictionary-encoded string column: int32 codes into the list of
+    distinct values, which is written alongside as JSON when the column
+    is closed.
+    """
+    datatype = 's'
+
+    def __init__(self, directory, name, rows=0):
+        Column.__init__(self, directory, name, 'int32', rows, MISSING_CODE)
+        self.codes = {}
+        self.dictionary = []
+        self.dictionary_file = name + '.json'
+
+    def add(self, value):
+        if value is None:
+            self.append(MISSING_CODE)
+            return
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.dictionary)
+            self.dictionary.append(value)
+        self.append(code)
+
+    def columns(self):
+        return [self]
+
+    def close(self):
+        Column.close(self)
+        if self.path is None:
+            return
+        path = os.path.join(os.path.dirname(self.path), self.dictionary_file)
+        with io.open(path, 'w', encoding='UTF-8') as f:
+            f.write(json.dumps(self.dictionary, ensure_ascii=False))
+
+    def description(self):
+        d = Column.description(self)
+        d['dictionary'] = self.dictionary_file
+        return d
+
+
+COLUMN_CLASSES = {
+    'n': NumberColumn,
+    'd': DateColumn,
+    's': StringColumn,
+}
+
+
+class TableWriter(object):
+    """
+    The columns for one kind of record, written to directory.
+    """
+    def __init__(self, directory, kind, fields):
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.kind = kind
+        self.fields = list(fields.keys())
+        self.columns = [COLUMN_CLASSES[datatype](directory, field)
+                        for (field, datatype) in fields.items()]
+        self.rows = 0
+
+    def write(self, attributes):
+        get = attributes.get
+        for (field, column) in zip(self.fields, self.columns):
+            column.add(get(field))
+        self.rows += 1
+
+    def close(self):
+        columns = []
+        for field_column in self.columns:
+            for column in field_column.columns():
+                column.close()
+                columns.append(column.description())
+        manifest = {
+            'version': FORMAT_VERSION,
+            'kind': self.kind,
+            'rows': self.rows,
+            'byteorder': 'little',
+            'columns': columns,
+        }
+        path = os.path.join(self.directory, MANIFEST)
+        with io.open(path, 'w', encoding='UTF-8') as f:
+            f.write(json.dumps(manifest, indent=2, sort_keys=True,
+                               ensure_ascii=False))
+
+
+class ColumnStoreWriter(object):
+    """
+    Write records to a column store in directory, a subdirectory per
+    kind. Call close() to finish the files and write the manifests.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+
+    def write(self, kind, fields, attributes):
+        """
+        Append a record of the given kind, whose fields (an OrderedDict
+        of field names to type codes) are taken from attributes.
+        """
+        table = self.tables.get(kind)
+        if table is None:
+            table = self.tables[kind] = TableWriter(
+                os.path.join(self.directory, kind), kind, fields)
+        table.write(attributes)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+
+
+class MemoryTable(TableWriter):
+    """
+    The columns for one kind of record, held in memory as arrays, with
+    the same methods for reading them as a ColumnTable.
+    """
+    def __init__(self, kind, fields):
+        TableWriter.__init__(self, None, kind, fields)
+
+    def __len__(self):
+        return self.rows
+
+    def all_columns(self):
+        return [column for field_column in self.columns
+                for column in field_column.columns()]
+
+    def names(self):
+        return [column.name for column in self.all_columns()]
+
+    def find(self, name):
+        for column in self.all_columns():
+            if column.name == name:
+                return column
+        raise KeyError(name)
+
+    def column(self, name):
+        """
+        The raw values of a column, as an array: numbers, UTC seconds,
+        offsets, or codes into the dictionary of a string column.
+        """
+        return self.find(name).values
+
+    def dictionary(self, name):
+        return self.find(name).dictionary
+
+    def strings(self, name):
+        column = self.find(name)
+        dictionary = column.dictionary
+        return [None if code == MISSING_CODE else dictionary[code]
+                for code in column.values]
+
+
+class MemoryColumnStore(object):
+    """
+    Records held in memory in columns, a MemoryTable per kind.
+
+    This has the writing methods of a ColumnStoreWriter, so it can be
+    used wherever one is, and the reading methods of a ColumnStore.
+    Each distinct string is stored once per column, and numbers and
+    dates are stored as machine numbers in arrays.
+    """
+    def __init__(self):
+        self.tables = {}
+
+    def write(self, kind, fields, attributes):
+        table = self.tables.get(kind)
+        if table is None:
+            table = self.tables[kind] = MemoryTable(kind, fields)
+        table.write(attributes)
+
+    def close(self):
+        pass
+
+    def kinds(self):
+        return sorted(self.tables)
+
+    def table(self, kind):
+        return self.tables[kind]
+
+
+def map_column(path, storage):
+    """
+    Memory-map the column file at path, as a read-only NumPy array if
+    NumPy is available, or otherwise as a memoryview of the right type.
+    """
+    (typecode, dtype, suffix) = STORAGE[storage]
+    if os.path.getsize(path) == 0:
+        return numpy.zeros(0, dtype) if numpy else memoryview(array(typecode))
+    if numpy is not None:
+        return numpy.memmap(path, dtype=dtype, mode='r')
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if sys.byteorder == 'big':
+        values = array(typecode, m)
+        values.byteswap()
+        return memoryview(values)
+    return memoryview(m).cast(typecode)
+
+
+class ColumnTable(object):
+    """
+    The columns for one kind of record in a column store, which are
+    memory-mapped the first time they are asked for.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with io.open(os.path.join(directory, MANIFEST), encoding='UTF-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != FORMAT_VERSION:
+            raise ValueError('Unsupported column store version %s in %s'
+                             % (self.manifest['version'], directory))
+        self.kind = self.manifest['kind']
+        self.n_rows = self.manifest['rows']
+        self.descriptions = dict((d['name'], d)
+                                 for d in self.manifest['columns'])
+        self.mapped = {}
+        self.dictionaries = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def names(self):
+        return [d['name'] for d in self.manifest['columns']]
+
+    def column(self, name):
+        """
+        The raw values of a column: numbers, UTC seconds, offsets, or
+        codes into the dictionary of a string column.
+        """
+        if name not in self.mapped:
+            d = self.descriptions[name]
+            self.mapped[name] = map_column(os.path.join(self.directory,
+                                                        d['file']),
+                                           d['storage'])
+        return self.mapped[name]
+
+    def dictionary(self, name):
+        """
+        The distinct values of a string column, in code order.
+        """
+        if name not in self.dictionaries:
+            path = os.path.join(self.directory,
+                                self.descriptions[name]['dictionary'])
+            with io.open(path, encoding='UTF-8') as f:
+                self.dictionaries[name] = json.load(f)
+        return self.dictionaries[name]
+
+    def strings(self, name):
+        """
+        The values of a string column decoded, with None where missing.
+        """
+        dictionary = self.dictionary(name)
+        return [None if code == MISSING_CODE else dictionary[code]
+                for code in self.column(name)]
+
+
+class ColumnStore(object):
+    """
+    Read a column store written by ColumnStoreWriter.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+
+    def kinds(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.exists(os.path.join(self.directory, name,
+                                                     MANIFEST)))
+
+    def table(self, kind):
+        if kind not in self.tables:
+            self.tables[kind] = ColumnTable(os.path.join(self.directory,
+                                                         kind))
+        return self.tables[kind]
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+csvpool.py: Buffered writing of many CSV files at once.
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+# Most files held open at once; others are closed, least recently
+# written first, and reopened for appending when next written
+MAX_OPEN_FILES = 32
+# Characters buffered for a file before they are written in one go
+CHUNK_SIZE = 1 << 16
+# Characters buffered across all the files before every buffer is written
+MAX_BUFFERED = 16 << 20
+
+
+class CSVWriterPool(object):
+    """
+    A set of CSV files written a line at a time, with each file's lines
+    buffered in memory and written in chunks of chunk_size characters,
+    and no more than max_open of the files open at once.
+
+    Each file is created (truncating any existing file) with its header
+    the first time its buffer is written, and appended to after that,
+    so the header is written exactly once and the files are the same
+    as if each had been open, and written line by line, throughout.
+
+    Use add(key, path, header) the first time a key is seen, then
+    write(key, line); close() writes whatever is still buffered.
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES, chunk_size=CHUNK_SIZE,
+                 max_buffered=MAX_BUFFERED):
+        self.max_open = max_open
+        self.chunk_size = chunk_size
+        self.max_buffered = max_buffered
+        self.paths = OrderedDict()
+        self.buffers = {}
+        self.sizes = {}
+        self.created = set()
+        self.handles = OrderedDict()
+        self.buffered = 0
+
+    def __contains__(self, key):
+        return key in self.paths
+
+    def add(self, key, path, header):
+        self.paths[key] = path
+        self.buffers[key] = [header]
+        self.sizes[key] = len(header)
+        self.buffered += len(header)
+
+    def write(self, key, line):
+        buffer = self.buffers[key]
+        buffer.append(line)
+        size = self.sizes[key] = self.sizes[key] + len(line)
+        self.buffered += len(line)
+        if size >= self.chunk_size:
+            self.flush(key)
+        elif self.buffered >= self.max_buffered:
+            self.flush_all()
+
+    def handle(self, key):
+        """
+        The open file for key, opening it (and closing the least
+        recently used file, if too many are open) if necessary.
+        """
+        f = self.handles.pop(key, None)
+        if f is None:
+            if len(self.handles) >= self.max_open:
+                self.handles.popitem(last=False)[1].close()
+            f = open(self.paths[key], 'a' if key in self.created else 'w')
+            self.created.add(key)
+        self.handles[key] = f
+        return f
+
+    def flush(self, key):
+        buffer = self.buffers[key]
+        if buffer:
+            self.handle(key).write(''.join(buffer))
+            self.buffered -= self.sizes[key]
+            self.buffers[key] = []
+            self.sizes[key] = 0
+
+    def flush_all(self):
+        for key in self.paths:
+            self.flush(key)
+
+    def close(self):
+        self.flush_all()
+        for f in self.handles.values():
+            f.close()
+        self.handles = OrderedDict()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+dedup.py: Resolve samples recorded by more than one source for the
+same time, writing a canonical table for each kind alongside its raw
+table in the export.sqlite written by applehealthdataeventsqlite.py.
+
+When an iPhone and an Apple Watch both count steps, say, the raw
+StepCount table holds both sets of samples, and sums over it count
+the overlapping time twice. Like the Health app, this ranks the
+sources by a priority list and keeps, for each sample, only the part
+of its interval not covered by a sample from a source ranked above
+it, scaling its value by the fraction kept:
+
+    python dedup.py [--priority Watch,iPhone] [--types StepCount,...]
+                    /path/to/export.sqlite
+
+writes StepCountCanonical and so on, with the columns of the raw
+table plus record (the raw row's rowid) and fraction (the part of the
+sample kept), leaving out samples that are entirely covered.
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import heapq
+import sqlite3
+import sys
+
+from collections import deque
+from datetime import datetime
+
+import healthexport
+
+# Cumulative kinds that sources double up on
+DEDUP_TYPES = ('StepCount', 'DistanceWalkingRunning', 'ActiveEnergyBurned',
+               'FlightsClimbed')
+# Sources, most trusted first, matched case-insensitively against the
+# source name and then the device. Sources matching none of these come
+# after those that do.
+SOURCE_PRIORITY = ('Watch', 'iPhone')
+# Suffix of the name of the canonical table for a kind
+CANONICAL_SUFFIX = 'Canonical'
+# Rows written to a canonical table at a time
+BATCH_SIZE = 10000
+
+
+def covered_seconds(intervals, start, end):
+    """
+    Length of the part of (start, end) covered by the union of
+    intervals, a list of (start, end) pairs.
+    """
+    total = 0
+    reached = start
+    for (s, e) in sorted(intervals):
+        s = max(s, reached)
+        e = min(e, end)
+        if e > s:
+            total += e - s
+            reached = e
+    return total
+
+
+def sweep(rows):
+    """
+    Yield (row, fraction) for each of rows, where fraction is the part
+    of the row's interval not covered by any row of a better (lower)
+    rank.
+
+    Each row is a tuple starting (start, end, rank), and rows must be
+    in order of start. The rows are swept in that order, keeping a heap
+    (by end) of earlier rows still open, and reading ahead as far as
+    the current row's end, so each row is compared only with the rows
+    it overlaps. A row with start == end is a point in time, which is
+    kept unless it falls inside a better-ranked row.
+    """
+    rows = iter(rows)
+    ahead = deque()
+    active = []
+    exhausted = False
+    n = 0
+    while True:
+        if not ahead:
+            row = next(rows, None)
+            if row is None:
+                return
+            ahead.append(row)
+        row = ahead.popleft()
+        (start, end, rank) = row[:3]
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        while not exhausted and (not ahead or ahead[-1][0] < end
+                                 or ahead[-1][0] == start):
+            following = next(rows, None)
+            if following is None:
+                exhausted = True
+            else:
+                ahead.append(following)
+        covers = [other[:2] for (e, i, other) in active if other[2] < rank]
+        for other in ahead:
+            if other[0] >= end and other[0] > start:
+                break
+            if other[2] < rank:
+                covers.append(other[:2])
+        if end > start:
+            fraction = 1 - covered_seconds(covers, start, end) / (end - start)
+            heapq.heappush(active, (end, n, row))
+            n += 1
+        else:
+            fraction = 0 if any(s <= start < e for (s, e) in covers) else 1
+        yield (row, fraction)
+
+
+class Deduplicator(object):
+    """
+    Writes the canonical tables for the kinds in an export.sqlite.
+
+    Inputs:
+        conn:       A connection to export.sqlite
+        priority:   Sources, most trusted first; see SOURCE_PRIORITY
+        verbose:    Set to False for less output
+
+    Each source (each sourceName id) has its own rank, ordered by the
+    first pattern in priority that matches it, then by id, so no two
+    sources are ever tied.
+    """
+    def __init__(self, conn, priority=SOURCE_PRIORITY, verbose=True):
+        self.conn = conn
+        self.priority = [pattern.lower() for pattern in priority]
+        self.verbose = verbose
+        self.names = {}
+        for dimension in ('sourceName', 'device'):
+            self.names[dimension] = names = {}
+            try:
+                rows = conn.execute('SELECT value, name FROM z{}'
+                                    .format(dimension)).fetchall()
+            except sqlite3.OperationalError:  # no such table
+                rows = []
+            for (i, name) in rows:
+                names[i] = names[int(i)] = name
+        self.ranks = {}
+
+    def report(self, msg):
+        if self.verbose:
+            print(msg)
+            sys.stdout.flush()
+
+    def rank(self, source, device):
+        """
+        The rank of the source with the given sourceName and device ids.
+        """
+        key = (source, device)
+        rank = self.ranks.get(key)
+        if rank is None:
+            names = [(self.names['sourceName'].get(source) or '').lower(),
+                     (self.names['device'].get(device) or '').lower()]
+            position = len(self.priority)
+            for (i, pattern) in enumerate(self.priority):
+                if any(pattern in name for name in names):
+                    position = i
+                    break
+            rank = self.ranks[key] = (position,
+                                      -1 if source is None else int(source))
+        return rank
+
+    def run(self, kinds=DEDUP_TYPES):
+        """
+        Rewrite the canonical table for each of kinds that has a table.
+        """
+        tables = set(name for (name,) in self.conn.execute(
+            'SELECT name FROM sqlite_master WHERE type = \'table\''))
+        for kind in kinds:
+            if kind in tables:
+                self.dedup(kind)
+        self.conn.commit()
+
+    def dedup(self, kind):
+        """
+        Replace the canonical table for kind with the result of sweeping
+        its raw table, returning (raw rows, canonical rows).
+        """
+        starttime = datetime.now()
+        columns = [row[1] for row in self.conn.execute(
+            'PRAGMA table_info({})'.format(kind))]
+        epoch = 'startDateUtc' in columns
+        times = (['startDateUtc', 'endDateUtc'] if epoch
+                 else ['startDate', 'endDate'])
+        canonical = kind + CANONICAL_SUFFIX
+        self.conn.execute('DROP TABLE IF EXISTS {}'.format(canonical))
+        self.conn.execute('CREATE TABLE {} AS SELECT * FROM {} WHERE 0'
+                          .format(canonical, kind))
+        self.conn.execute('ALTER TABLE {} ADD COLUMN record INTEGER'
+                          .format(canonical))
+        self.conn.execute('ALTER TABLE {} ADD COLUMN fraction REAL'
+                          .format(canonical))
+        insert = 'INSERT INTO {} VALUES ({})'.format(
+            canonical, ', '.join('?' * (len(columns) + 2)))
+        value = columns.index('value')
+        source = columns.index('sourceName')
+        device = columns.index('device') if 'device' in columns else None
+        rank = self.rank
+
+        def rows():
+            for row in self.conn.execute(
+                    'SELECT {}, rowid, * FROM {}{}'.format(
+                        ', '.join(times), kind,
+                        ' ORDER BY {}, rowid'.format(times[0]) if epoch
+                        else '')):
+                (start, end) = row[:2]
+                if not epoch:
+                    start = healthexport.timestamp_parts(start)[0]
+                    end = healthexport.timestamp_parts(end)[0]
+                fields = row[3:]
+                yield (start, max(start, end),
+                       rank(fields[source],
+                            None if device is None else fields[device]),
+                       row[2], fields)
+
+        ordered = rows()
+        if not epoch:
+            # Text dates sort by local time, which is not UTC order when
+            # the offset changes (DST, travel), so sort on UTC here.
+            ordered = sorted(ordered, key=lambda row: (row[0], row[3]))
+
+        n_raw = 0
+        batch = []
+        n_kept = 0
+        writer = self.conn.cursor()
+        for ((start, end, r, rowid, fields), fraction) in sweep(ordered):
+            n_raw += 1
+            if fraction <= 0:
+                continue
+            fields = list(fields)
+            if fraction < 1 and fields[value] is not None:
+                fields[value] = fields[value] * fraction
+            batch.append(fields + [rowid, fraction])
+            if len(batch) >= BATCH_SIZE:
+                writer.executemany(insert, batch)
+                n_kept += len(batch)
+                batch = []
+        writer.executemany(insert, batch)
+        n_kept += len(batch)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_{}_{} ON {} ({})'
+                          .format(canonical, times[0], canonical, times[0]))
+        self.report('%s: kept %d of %d samples in %.1fs'
+                    % (canonical, n_kept, n_raw,
+                       (datetime.now() - starttime).total_seconds()))
+        return (n_raw, n_kept)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    priority = SOURCE_PRIORITY
+    if '--priority' in args and args.index('--priority') + 1 < len(args):
+        i = args.index('--priority')
+        priority = args[i + 1].split(',')
+        del args[i:i + 2]
+    kinds = DEDUP_TYPES
+    if '--types' in args and args.index('--types') + 1 < len(args):
+        i = args.index('--types')
+        kinds = args[i + 1].split(',')
+        del args[i:i + 2]
+    if len(args) != 1:
+        print('USAGE: python dedup.py [--priority Watch,iPhone] '
+              '[--types StepCount,...] /path/to/export.sqlite',
+              file=sys.stderr)
+        sys.exit(1)
+    conn = sqlite3.connect(args[0])
+    Deduplicator(conn, priority).run(kinds)
+    conn.close()
@@ -0,0 +1,1108 @@
+# -*- coding: utf-8 -*-
+"""
+healthexport.py: Helpers shared by the extractors for reading export.xml.
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import bz2
+import calendar
+import codecs
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import posixpath
+import re
+import sys
+import threading
+import zipfile
+
+from collections import Counter, OrderedDict, deque
+from datetime import date, datetime
+from xml.etree import ElementTree
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from html import unescape
+except ImportError:  # Python 2
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+# Bytes read at a time when scanning or parsing a range of the export
+READ_SIZE = 1 << 20
+# Approximate size of the byte ranges handed to each worker
+RANGE_SIZE = 32 << 20
+# How far back from a candidate boundary to look for an open Correlation
+CORRELATION_WINDOW = 1 << 16
+# Read buffer for exports, so decompressors are called with big blocks
+BUFFER_SIZE = 4 << 20
+# Where the phone puts export.xml inside export.zip
+ZIP_MEMBER = 'apple_health_export/export.xml'
+COMPRESSED_SUFFIXES = ('.zip', '.gz', '.bz2')
+# Items handed between pipeline threads at a time, and the number of
+# those batches a queue holds before its producer has to wait
+PIPELINE_BATCH = 1000
+QUEUE_DEPTH = 8
+
+# The values of a GPX track point, in the order route_points yields them
+GPX_POINT_FIELDS = ('time', 'lat', 'lon', 'ele', 'speed', 'course',
+                    'hAcc', 'vAcc')
+
+# The sidecar index of an export.xml is export.xml.index.json; see
+# ExportIndex. The elements of each kind are indexed in entries covering
+# at most INDEX_CHUNK_SIZE bytes, so that a time window within one kind
+# can be read without the rest of it.
+INDEX_SUFFIX = '.index.json'
+INDEX_VERSION = 1
+INDEX_CHUNK_SIZE = 1 << 20
+# Any start or end tag, and the names and dates in a start tag, in bytes
+ANY_TAG_RE = re.compile(br'<(/?)(\w+)([^>]*)>')
+ATTRIBUTE_NAME_RE = re.compile(br'\s(\w+)=')
+TYPE_RE = re.compile(br'\stype="([^"]*)"')
+DATE_RE = re.compile(br'\s(?:startDate|dateComponents)="([^"]*)"')
+# Record types are indexed by their full names; this gives the short
+# name the extractors use (HKQuantityTypeIdentifierStepCount -> StepCount)
+TYPE_PREFIX_RE = re.compile('^HK.*TypeIdentifier(.+)$')
+# A device description, which starts with a per-record object pointer
+# (<<HKDevice: 0x...>, name:Apple Watch, ...>); see abbreviate_device
+DEVICE_RE = re.compile('^<<HK.*>, (.+)>$')
+
+# Parser backends: ElementTree's iterparse, or scan_elements
+PARSERS = ('iterparse', 'scan')
+# A start tag (or a whole empty element) in the body of an export
+TAG_RE = re.compile(r'<(\w+)([^>]*)>')
+ATTRIBUTE_RE = re.compile(r'(\w+)="([^"]*)"')
+# An empty Record with its attributes in the order Apple writes them.
+# Runs of these are matched with a single findall, and each match turned
+# straight into a dict. Values (other than device, which nearly always
+# contains &lt;) must be free of references and whitespace that would
+# need normalizing; Records that don't fit take the slower path.
+RECORD_ATTRIBUTES = ('type', 'sourceName', 'sourceVersion', 'device',
+                     'unit', 'creationDate', 'startDate', 'endDate', 'value')
+RECORD_RE = re.compile(r'<Record type="([^"&\s]*)" sourceName="([^"&\t\n\r]*)"'
+                       r'(?: sourceVersion="([^"&\t\n\r]*)")?'
+                       r'(?: device="([^"\t\n\r]*)")?'
+                       r'(?: unit="([^"&\t\n\r]*)")?'
+                       r'(?: creationDate="([^"&\t\n\r]*)")?'
+                       r' startDate="([^"&\t\n\r]*)" endDate="([^"&\t\n\r]*)"'
+                       r'(?: value="([^"&\t\n\r]*)")?\s*/>')
+# The start of anything other than an empty Record
+OTHER_RE = re.compile(r'<(?!Record type="[^>]*/>)')
+
+# Elements that can appear at the top level of HealthData. Records also
+# appear nested inside Correlations, so those are checked separately.
+BOUNDARY_RE = re.compile(br'<(?:Record|Workout|ActivitySummary|Correlation)'
+                         br'[\s/>]')
+
+
+def is_compressed(path):
+    return path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def zip_member(archive):
+    """
+    Name of the export.xml inside an export.zip.
+    """
+    names = archive.namelist()
+    if ZIP_MEMBER in names:
+        return ZIP_MEMBER
+    for name in names:
+        if name == 'export.xml' or name.endswith('/export.xml'):
+            return name
+    raise ValueError('No export.xml found in %s' % archive.filename)
+
+
+def export_size(path):
+    """
+    Size in bytes of the export.xml that open_export(path) reads, or
+    None where that isn't known without decompressing it (.gz and .bz2).
+    """
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return archive.getinfo(zip_member(archive)).file_size
+    elif is_compressed(path):
+        return None
+    return os.path.getsize(path)
+
+
+def open_export(path, buffer_size=BUFFER_SIZE):
+    """
+    Open an export for reading as bytes. path can be export.xml itself,
+    the export.zip produced by the phone, or an export.xml compressed
+    with gzip (.gz) or bzip2 (.bz2). Compressed exports are decompressed
+    as they are read, never written out.
+    """
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            # the member keeps the archive's file open after this block
+            raw = archive.open(zip_member(archive))
+    elif lower.endswith('.gz'):
+        raw = gzip.GzipFile(path, 'rb')
+    elif lower.endswith('.bz2'):
+        raw = bz2.BZ2File(path, 'rb')
+    else:
+        return io.open(path, 'rb', buffering=buffer_size)
+    return io.BufferedReader(raw, buffer_size)
+
+
+def output_directory(path):
+    """
+    Default directory for the output extracted from the export at path.
+
+    This is the directory containing export.xml, or, for a compressed
+    export, a directory named after the archive alongside it
+    (so export.zip and export.xml.gz both give a sibling export/),
+    which is created if necessary.
+    """
+    (directory, name) = os.path.split(os.path.abspath(path))
+    if not is_compressed(path):
+        return directory
+    stem = name.split('.')[0] or name
+    directory = os.path.join(directory, stem)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+
+_DAY_SECONDS = {}
+_TIME_SECONDS = {'': 0}
+_LAST_TIMESTAMP = (None, None)
+
+def timestamp_parts(value):
+    """
+    Split an export timestamp such as '2016-04-01 12:34:56 +0100' into
+    (UTC seconds since the epoch, offset from UTC in seconds). A bare
+    date, like an ActivitySummary's dateComponents, is taken to be
+    midnight UTC.
+
+    Consecutive records share most of their timestamps, so the UTC
+    start of each distinct date and offset, and the seconds into the
+    day of each distinct time, are cached, and a timestamp seen before
+    costs two dict lookups. The last result is kept too, since the UTC
+    and offset columns for a timestamp each ask for it in turn. It is
+    a single (value, parts) tuple, read once and replaced whole, so a
+    parser thread and the main thread sharing it never see one's value
+    with the other's parts.
+    """
+    global _LAST_TIMESTAMP
+    last = _LAST_TIMESTAMP
+    if value == last[0]:
+        return last[1]
+    try:
+        (day, offset) = _DAY_SECONDS[value[:10] + value[19:]]
+        parts = (day + _TIME_SECONDS[value[11:19]], offset)
+        _LAST_TIMESTAMP = (value, parts)
+        return parts
+    except KeyError:
+        pass
+    offset = 0
+    zone = value[20:]
+    if zone:
+        offset = ((-1 if zone[0] == '-' else 1)
+                  * (int(zone[1:3]) * 3600 + int(zone[3:5]) * 60))
+    day = calendar.timegm((int(value[:4]), int(value[5:7]),
+                           int(value[8:10]), 0, 0, 0)) - offset
+    _DAY_SECONDS[value[:10] + value[19:]] = (day, offset)
+    time = value[11:19]
+    if time not in _TIME_SECONDS:
+        _TIME_SECONDS[time] = (int(time[:2]) * 3600 + int(time[3:5]) * 60
+                               + int(time[6:8]))
+    return (day + _TIME_SECONDS[time], offset)
+
+
+def iterparse_elements(f):
+    """
+    Yield each element of an export as its end tag is parsed, nested
+    elements before their parents, clearing the root as it goes so
+    that memory use stays bounded.
+    """
+    context = iter(ElementTree.iterparse(f, events=('start', 'end')))
+    event, root = next(context)
+    for event, element in context:
+        if event == 'end' and element is not root:
+            yield element
+            root.clear()
+
+
+def top_level_elements(f):
+    """
+    Yield each child of the root element of an export once it has been
+    fully parsed, complete with its own children (such as MetadataEntry),
+    and clear it from memory once the caller has finished with it.
+    """
+    context = iter(ElementTree.iterparse(f, events=('start', 'end')))
+    event, root = next(context)
+    depth = 0
+    for event, element in context:
+        if event == 'start':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0 and element is not root:
+                yield element
+                root.clear()
+
+
+_DEVICES = {}
+
+def abbreviate_device(device):
+    """
+    A device description without its leading <<HKDevice: 0x...> pointer,
+    which differs from record to record even for the same device.
+
+    Results are cached on the text after the pointer, which is all the
+    result depends on, so there is one entry per distinct device, and a
+    device seen before costs a find and a dict lookup, not a match.
+    """
+    if not device.startswith('<<HK'):
+        return device
+    i = device.find('>')
+    if i < 0:
+        return device
+    key = device[i:]
+    short = _DEVICES.get(key)
+    if short is None:
+        m = DEVICE_RE.match(device)
+        short = _DEVICES[key] = m.group(1) if m else device
+    return short
+
+
+_UNESCAPED = {}
+
+def unescape_value(value):
+    """
+    An attribute value with references replaced and whitespace
+    normalized as an XML parser would. Values needing this (mostly
+    device descriptions) repeat heavily, so results are cached.
+    """
+    result = _UNESCAPED.get(value)
+    if result is None:
+        if len(_UNESCAPED) > 100000:
+            _UNESCAPED.clear()
+        result = value.replace('\r\n', ' ')
+        for ch in '\t\n\r':
+            result = result.replace(ch, ' ')
+        result = _UNESCAPED[value] = unescape(result)
+    return result
+
+
+def attribute_dict(text):
+    """
+    The attributes in the text of a tag, as a dict.
+    """
+    if '\t' in text or '\n' in text or '\r' in text:
+        return dict((k, unescape_value(v))
+                    for (k, v) in ATTRIBUTE_RE.findall(text))
+    elif '&' in text:
+        return dict((k, unescape_value(v) if '&' in v else v)
+                    for (k, v) in ATTRIBUTE_RE.findall(text))
+    else:
+        return dict(ATTRIBUTE_RE.findall(text))
+
+
+def postorder(element):
+    """
+    Yield element's descendants and then element, in the order that
+    iterparse reports their end tags.
+    """
+    for child in element:
+        for e in postorder(child):
+            yield e
+    yield element
+
+
+def record_elements(text):
+    """
+    Yield a Record element for each tag in text, which holds nothing
+    but empty Record elements.
+    """
+    Element = ElementTree.Element
+    matches = list(RECORD_RE.finditer(text))
+    if len(matches) == text.count('<'):
+        for m in matches:
+            values = m.groups('')
+            attributes = dict(zip(RECORD_ATTRIBUTES, values))
+            if '' in values:
+                # missing attributes match as empty; put back any that
+                # were really there in this element's own tag
+                tag = m.group(0)
+                for (k, v) in list(attributes.items()):
+                    if v == '' and (' %s=""' % k) not in tag:
+                        del attributes[k]
+            if '&' in values[3]:
+                attributes['device'] = unescape_value(values[3])
+            yield Element('Record', attributes)
+    else:
+        for m in TAG_RE.finditer(text):
+            if "='" in m.group(2):
+                yield ElementTree.fromstring(m.group(0))
+            else:
+                yield Element('Record', attribute_dict(m.group(2)))
+
+
+def shallow_element(tag, text, content):
+    """
+    Build the element with start tag text whose content holds nothing
+    but empty elements (a Record and its MetadataEntry list, say), or
+    return None if the content is anything more involved.
+    """
+    if "='" in text or "='" in content:
+        return None
+    children = TAG_RE.findall(content)
+    if len(children) != content.count('<'):
+        return None
+    element = ElementTree.Element(tag, attribute_dict(text))
+    for (child, child_text) in children:
+        if not child_text.endswith('/'):
+            return None
+        ElementTree.SubElement(element, child, attribute_dict(child_text))
+    return element
+
+
+def scan_elements(f, nested=True, limit=None):
+    """
+    Yield the elements of an export in the same order as
+    iterparse_elements (or, if nested is False, top_level_elements),
+    from at most limit bytes of f.
+
+    Most of an export is empty, single-line Record elements, so rather
+    than parsing everything with ElementTree, this finds each run of
+    them with a regular expression and builds the elements directly from
+    their attributes. Everything else, including any element with
+    children (MetadataEntry, WorkoutEvent, Records inside a Correlation,
+    etc.), is handed to ElementTree as a string running to its end tag.
+    This relies on the layout Apple uses: double-quoted attributes, and
+    no element nested in another of the same name.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    Element = ElementTree.Element
+    match_tag = TAG_RE.match
+    search_other = OTHER_RE.search
+    buf = ''
+    pos = 0
+    remaining = limit
+    eof = False
+    while not eof:
+        size = READ_SIZE if remaining is None else min(READ_SIZE, remaining)
+        block = f.read(size) if size else b''
+        if remaining is not None:
+            remaining -= len(block)
+        eof = not block
+        # keep whatever follows the last complete element for next time
+        buf = buf[pos:] + decoder.decode(block, final=eof)
+        pos = 0
+        while True:
+            m = search_other(buf, pos)
+            start = m.start() if m else len(buf)
+            if start > pos:
+                run = buf[pos:start]
+                if '<' in run:
+                    for element in record_elements(run):
+                        yield element
+                pos = start
+            if m is None:
+                break
+            m = match_tag(buf, start)
+            if m is None:
+                if buf.find('>', start) < 0:
+                    break  # tag continues in the next block
+                pos = start + 1  # <!DOCTYPE, </HealthData> and the like
+                continue
+            (tag, text) = m.groups()
+            if tag == 'HealthData':
+                pos = m.end()
+            elif text.endswith('/'):
+                if "='" in text:
+                    yield ElementTree.fromstring(m.group(0))
+                else:
+                    yield Element(tag, attribute_dict(text))
+                pos = m.end()
+            else:
+                close = '</%s>' % tag
+                end = buf.find(close, m.end())
+                if end < 0:
+                    break
+                element = (shallow_element(tag, text, buf[m.end():end])
+                           or ElementTree.fromstring(buf[m.start():end + len(close)]))
+                end += len(close)
+                if nested:
+                    for e in postorder(element):
+                        yield e
+                else:
+                    yield element
+                pos = end
+
+
+def iter_elements(f, parser='iterparse', nested=True):
+    """
+    Yield the elements of an export using the named parser backend:
+    all of them, nested elements before their parents, or just the
+    top-level ones if nested is False.
+    """
+    if parser == 'scan':
+        return scan_elements(f, nested=nested)
+    elif parser == 'iterparse':
+        return iterparse_elements(f) if nested else top_level_elements(f)
+    else:
+        raise KeyError('Unexpected parser: %s' % parser)
+
+
+def body_extent(f):
+    """
+    Return (start, end) byte offsets of the body of HealthData: from just
+    after its start tag (and so after the DTD) to its end tag.
+    """
+    f.seek(0)
+    head = b''
+    start = -1
+    while start < 0:
+        block = f.read(READ_SIZE)
+        if not block:
+            raise ValueError('No HealthData element found')
+        head += block
+        tag = head.find(b'<HealthData')
+        close = head.find(b'>', tag) if tag >= 0 else -1
+        if close >= 0:
+            start = close + 1
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(start, size - CORRELATION_WINDOW))
+    tail_offset = f.tell()
+    tail = f.read()
+    end = tail.rfind(b'</HealthData>')
+    return (start, tail_offset + end if end >= 0 else size)
+
+
+def next_boundary(f, offset, end):
+    """
+    Return the offset of the first top-level element starting at or after
+    offset (or end, if there is none before it).
+
+    Records inside a Correlation are not top-level, so a candidate is
+    rejected if the last Correlation opened before it is still open.
+    """
+    while offset < end:
+        f.seek(offset)
+        block = f.read(min(READ_SIZE, end - offset))
+        m = BOUNDARY_RE.search(block)
+        if m is None:
+            # keep an overlap in case a tag straddles the block boundary
+            if offset + len(block) >= end:
+                return end
+            offset += max(len(block) - 32, 1)
+            continue
+        candidate = offset + m.start()
+        if block[m.start() + 1:m.start() + 7] == b'Record':
+            window_start = max(0, candidate - CORRELATION_WINDOW)
+            f.seek(window_start)
+            before = f.read(candidate - window_start)
+            if before.rfind(b'<Correlation') > before.rfind(b'</Correlation>'):
+                f.seek(candidate)
+                rest = f.read(min(CORRELATION_WINDOW, end - candidate))
+                close = rest.find(b'</Correlation>')
+                if close < 0:
+                    return end
+                offset = candidate + close + len(b'</Correlation>')
+                continue
+        return candidate
+    return end
+
+
+def split_export(path, n_ranges):
+    """
+    Split the body of the export at path into at most n_ranges byte
+    ranges (start, end), each starting on a top-level element.
+    """
+    with open(path, 'rb') as f:
+        (start, end) = body_extent(f)
+        step = max((end - start) // max(n_ranges, 1), 1)
+        offsets = [start]
+        for i in range(1, n_ranges):
+            target = start + i * step
+            if target <= offsets[-1]:
+                continue
+            boundary = next_boundary(f, target, end)
+            if offsets[-1] < boundary < end:
+                offsets.append(boundary)
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def iter_range(path, start, end, parser='iterparse', nested=True):
+    """
+    Yield the elements in bytes start to end of the export, as
+    iter_elements does for a whole file.
+
+    With iterparse, the range is parsed as the content of a bare
+    HealthData element, which is fine because the DTD declares no
+    entities.
+    """
+    if parser == 'scan':
+        with open(path, 'rb') as f:
+            f.seek(start)
+            for element in scan_elements(f, nested=nested,
+                                         limit=end - start):
+                yield element
+        return
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    parser.feed(b'<HealthData>')
+    root = None
+    depth = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(READ_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            parser.feed(block)
+            for (event, element) in parser.read_events():
+                if root is None:
+                    root = element
+                elif event == 'start':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if nested or depth == 0:
+                        yield element
+                        root.clear()
+    parser.feed(b'</HealthData>')
+    for (event, element) in parser.read_events():
+        if event == 'start':
+            depth += 1
+        elif element is not root:
+            depth -= 1
+            if nested or depth == 0:
+                yield element
+    parser.close()
+
+
+def open_export_file(path, name):
+    """
+    Open a file that the export at path refers to by name, such as a
+    workout route's '/workout-routes/route_2019-06-01_7.48am.gpx',
+    for reading as bytes. Names are relative to the folder holding
+    export.xml, whether that is inside export.zip or not. Raises
+    IOError if there is no such file.
+    """
+    name = name.lstrip('/')
+    if path.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        member = posixpath.join(posixpath.dirname(zip_member(archive)), name)
+        try:
+            return archive.open(member)
+        except KeyError:
+            raise IOError('No %s in %s' % (member, path))
+        finally:
+            archive.close()  # the member keeps the file open
+    return io.open(os.path.join(os.path.dirname(os.path.abspath(path)),
+                                *name.split('/')), 'rb')
+
+
+def gpx_seconds(value):
+    """
+    UTC seconds since the epoch for a GPX time such as
+    '2019-06-01T07:48:01Z'. Fractions of a second are dropped.
+    """
+    return timestamp_parts('%s %s' % (value[:10], value[11:19]))[0]
+
+
+def route_points(f):
+    """
+    Yield a tuple of GPX_POINT_FIELDS for each track point (trkpt) in
+    the GPX file f, such as a workout route, with the time as UTC epoch
+    seconds and anything missing as None. Points without a time are
+    skipped.
+    """
+    for (event, element) in ElementTree.iterparse(f):
+        if element.tag.rpartition('}')[2] != 'trkpt':
+            continue
+        values = {}
+        for child in element.iter():
+            values[child.tag.rpartition('}')[2]] = child.text
+        values.update(element.attrib)
+        element.clear()
+        if not values.get('time'):
+            continue
+        point = [gpx_seconds(values['time'])]
+        for field in GPX_POINT_FIELDS[1:]:
+            value = values.get(field)
+            point.append(float(value) if value else None)
+        yield tuple(point)
+
+
+def parallel_map(func, items, jobs):
+    """
+    Yield func(item) for each of items, computed in a pool of jobs
+    processes (or in this one, if jobs is 1), in whatever order they
+    finish. func must be a module-level function so that it can be
+    pickled.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(func, items):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parallel_map_ranges(path, func, jobs, args=(), range_size=RANGE_SIZE):
+    """
+    Split the export at path into byte ranges and call
+    func(path, start, end, *args) on each in a pool of jobs processes,
+    yielding the results in file order.
+
+    func must be a module-level function so that it can be pickled.
+    Only a couple of results per worker are held at once, so a slow
+    consumer holds the workers back rather than filling memory.
+    """
+    size = os.path.getsize(path)
+    n_ranges = max(jobs * 4, size // range_size + 1)
+    ranges = split_export(path, n_ranges)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = deque()
+        for (start, end) in ranges:
+            pending.append(pool.apply_async(func, (path, start, end) + tuple(args)))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+if sys.version_info.major < 3:
+    string_types = (str, unicode)
+    number_types = (int, long, float)
+else:
+    string_types = (str,)
+    number_types = (int, float)
+
+
+def epoch_seconds(value):
+    """
+    UTC seconds since the epoch for a time bound: a number of seconds,
+    an export timestamp such as '2016-04-01 12:34:56 +0100' or a date
+    such as '2016-04-01', or a datetime or date. Naive datetimes, dates
+    and bare date strings are taken to be UTC.
+    """
+    if isinstance(value, number_types):
+        return value
+    elif isinstance(value, string_types):
+        return timestamp_parts(value)[0]
+    elif isinstance(value, datetime):
+        if value.utcoffset() is not None:
+            value = value - value.utcoffset()
+        return calendar.timegm(value.timetuple())
+    elif isinstance(value, date):
+        return calendar.timegm(value.timetuple())
+    raise TypeError('Unexpected time: %r' % (value,))
+
+
+def element_kind(tag, attributes):
+    """
+    The kind of a top-level element: its type for a Record, else its tag.
+    """
+    return attributes.get('type', tag) if tag == 'Record' else tag
+
+
+def element_seconds(attributes):
+    """
+    UTC seconds of an element's startDate (or an ActivitySummary's
+    dateComponents), or None if it has neither.
+    """
+    value = attributes.get('startDate') or attributes.get('dateComponents')
+    return timestamp_parts(value)[0] if value else None
+
+
+class ExportIndex(object):
+    """
+    Byte offsets of the runs of each kind of element in an export.xml,
+    with their date ranges, and the counts HealthDataExtractor reports,
+    saved in a small sidecar file, export.xml.index.json, alongside it.
+
+    Each entry in self.runs is [kind, start, end, count, first, last]:
+    count top-level elements of kind (a Record's type, or the tag) in
+    bytes start to end, with startDates (or dateComponents) from first
+    to last, as UTC epoch seconds, or None if they have none. Apple
+    writes the Records of each type together, but where kinds are
+    interleaved, an entry's bytes hold elements of other kinds too.
+    Entries start and end on top-level elements, so can be read with
+    iter_range.
+
+    The index records the size and modification time of the export,
+    and load_index ignores an index that doesn't match them.
+    """
+    def __init__(self, path, size=None, mtime=None, runs=None, n_nodes=0,
+                 tags=None, fields=None, types=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.runs = runs or []
+        self.n_nodes = n_nodes
+        self.tags = Counter(tags or {})
+        self.fields = Counter(fields or {})
+        self.types = Counter(types or {})
+
+    def save(self):
+        with io.open(index_path(self.path), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(OrderedDict((
+                ('version', INDEX_VERSION),
+                ('size', self.size),
+                ('mtime', self.mtime),
+                ('n_nodes', self.n_nodes),
+                ('tags', self.tags),
+                ('fields', self.fields),
+                ('types', self.types),
+                ('runs', self.runs),
+            )), sort_keys=False))
+
+    def kinds(self, kinds):
+        """
+        The kinds in the index matching kinds, which can give Record
+        types in full or in short (StepCount for
+        HKQuantityTypeIdentifierStepCount).
+        """
+        wanted = set(kinds)
+        found = set()
+        for run in self.runs:
+            m = TYPE_PREFIX_RE.match(run[0])
+            if run[0] in wanted or (m and m.group(1) in wanted):
+                found.add(run[0])
+        return found
+
+    def ranges(self, kinds=None, start=None, end=None):
+        """
+        Byte ranges (start, end) holding every element of kinds (all
+        kinds if None) dated from start up to end (UTC seconds, or None
+        for no bound), in file order, merging entries that touch or
+        overlap. Elements without dates are only included with no bounds.
+        """
+        found = None if kinds is None else self.kinds(kinds)
+        ranges = []
+        for (kind, offset, stop, count, first, last) in sorted(
+                self.runs, key=lambda run: run[1]):
+            if found is not None and kind not in found:
+                continue
+            if start is not None or end is not None:
+                if first is None:
+                    continue
+                if start is not None and last < start:
+                    continue
+                if end is not None and first >= end:
+                    continue
+            if ranges and ranges[-1][1] >= offset:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], stop))
+            else:
+                ranges.append((offset, stop))
+        return ranges
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_index(path, chunk_size=INDEX_CHUNK_SIZE):
+    """
+    Index the export.xml at path in a single pass over its bytes,
+    returning an ExportIndex (which isn't saved).
+
+    Tags are found with a regular expression, without parsing, and
+    counted off by depth to pick out the top-level elements, which takes
+    less than half the time of a parse. It makes the same assumptions
+    about layout as scan_elements.
+    """
+    stats = os.stat(path)
+    index = ExportIndex(path, stats.st_size, stats.st_mtime)
+    runs = index.runs
+    tags = Counter()
+    fields = Counter()
+    types = Counter()
+    open_runs = {}
+    run = None  # the run of the last top-level element
+    depth = 0
+    with open(path, 'rb') as f:
+        (body_start, body_end) = body_extent(f)
+        f.seek(body_start)
+        offset = body_start
+        buf = b''
+        while offset + len(buf) < body_end:
+            block = f.read(min(READ_SIZE, body_end - offset - len(buf)))
+            if not block:
+                break
+            buf += block
+            pos = 0
+            for m in ANY_TAG_RE.finditer(buf):
+                pos = m.end()
+                (close, tag, text) = m.groups()
+                if close:
+                    depth -= 1
+                    continue
+                if depth == 0:
+                    tag = tag.decode('ascii')
+                    tags[tag] += 1
+                    fields.update(ATTRIBUTE_NAME_RE.findall(text))
+                    kind = tag
+                    if tag == 'Record':
+                        t = TYPE_RE.search(text)
+                        kind = t.group(1).decode('utf-8') if t else tag
+                        types[kind] += 1
+                    d = DATE_RE.search(text)
+                    seconds = (timestamp_parts(d.group(1).decode('ascii'))[0]
+                               if d else None)
+                    start = offset + m.start()
+                    if run is not None:
+                        run[2] = start
+                    run = open_runs.get(kind)
+                    if run is None or start - run[1] >= chunk_size:
+                        run = open_runs[kind] = [kind, start, None, 0,
+                                                 seconds, seconds]
+                        runs.append(run)
+                    run[3] += 1
+                    if seconds is not None:
+                        if run[4] is None or seconds < run[4]:
+                            run[4] = seconds
+                        if run[5] is None or seconds > run[5]:
+                            run[5] = seconds
+                if not text.endswith(b'/'):
+                    depth += 1
+            # keep any tag cut off at the end of the block
+            rest = buf.rfind(b'<', pos)
+            keep = buf[rest:] if rest >= 0 and buf.find(b'>', rest) < 0 else b''
+            offset += len(buf) - len(keep)
+            buf = keep
+    if run is not None:
+        run[2] = body_end
+    index.n_nodes = sum(tags.values())
+    index.tags = tags
+    index.fields = Counter(dict((name.decode('ascii'), n)
+                                for (name, n) in fields.items()))
+    index.types = types
+    return index
+
+
+def load_index(path):
+    """
+    The saved ExportIndex for the export.xml at path, or None if there
+    isn't one, or it is out of date.
+    """
+    try:
+        with io.open(index_path(path), encoding='utf-8') as f:
+            saved = json.load(f)
+        stats = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return None
+    if (saved.get('version') != INDEX_VERSION
+            or saved.get('size') != stats.st_size
+            or saved.get('mtime') != stats.st_mtime):
+        return None
+    return ExportIndex(path, saved['size'], saved['mtime'], saved['runs'],
+                       saved['n_nodes'], saved['tags'], saved['fields'],
+                       saved['types'])
+
+
+def export_index(path):
+    """
+    The ExportIndex for the export.xml at path, building and saving it
+    if there isn't an up-to-date one already. Compressed exports can't
+    be read from an offset, so aren't indexed, and give None.
+    """
+    if is_compressed(path):
+        return None
+    index = load_index(path)
+    if index is None:
+        index = build_index(path)
+        index.save()
+    return index
+
+
+def filter_elements(elements, kinds=None, start=None, end=None):
+    """
+    Yield those of the top-level elements of the given kinds (all, if
+    None; Record types can be given in full or short) with
+    start <= startDate < end, where either bound can be None (see
+    epoch_seconds for the forms they can take).
+    """
+    start = None if start is None else epoch_seconds(start)
+    end = None if end is None else epoch_seconds(end)
+    wanted = {}
+    kinds = None if kinds is None else set(kinds)
+    for element in elements:
+        if kinds is not None:
+            kind = element_kind(element.tag, element.attrib)
+            keep = wanted.get(kind)
+            if keep is None:
+                m = TYPE_PREFIX_RE.match(kind)
+                keep = wanted[kind] = (kind in kinds
+                                       or bool(m and m.group(1) in kinds))
+            if not keep:
+                continue
+        if start is not None or end is not None:
+            seconds = element_seconds(element.attrib)
+            if (seconds is None or (start is not None and seconds < start)
+                    or (end is not None and seconds >= end)):
+                continue
+        yield element
+
+
+def select_elements(path, kinds=None, start=None, end=None,
+                    parser='iterparse'):
+    """
+    Yield the top-level elements of the export at path of the given
+    kinds from start up to end, as filter_elements does.
+
+    Only the ranges of the export that its index (see export_index,
+    which builds one the first time) says can hold them are read. A
+    compressed export is read in full.
+    """
+    index = export_index(path)
+    if index is None:
+        with open_export(path) as f:
+            for element in filter_elements(iter_elements(f, parser,
+                                                         nested=False),
+                                           kinds, start, end):
+                yield element
+        return
+    for (offset, stop) in index.ranges(
+            kinds, None if start is None else epoch_seconds(start),
+            None if end is None else epoch_seconds(end)):
+        for element in filter_elements(iter_range(path, offset, stop, parser,
+                                                  nested=False),
+                                       kinds, start, end):
+            yield element
+
+
+class StageFailed(Exception):
+    """
+    Carries an exception raised in a pipeline thread over to the
+    thread consuming its output, where it is raised again.
+    """
+    def __init__(self, exc_info):
+        Exception.__init__(self, exc_info[1])
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[1]
+
+
+def put_until_stopped(q, item, stop):
+    """
+    Put item on the bounded queue q, giving up if stop is set while
+    waiting for space.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def threaded(iterable, batch_size=PIPELINE_BATCH, depth=QUEUE_DEPTH):
+    """
+    Yield the items of iterable, producing them in a separate thread.
+
+    Items are passed over in batches of batch_size through a queue
+    holding at most depth batches, so the producer runs ahead of the
+    consumer by a bounded amount, and waits when the consumer is slower.
+    An exception in the producer is raised in the consumer.
+    """
+    q = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            batch = []
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put_until_stopped(q, batch, stop):
+                        return
+                    batch = []
+            if batch:
+                put_until_stopped(q, batch, stop)
+            put_until_stopped(q, done, stop)
+        except BaseException:
+            put_until_stopped(q, StageFailed(sys.exc_info()), stop)
+
+    thread = threading.Thread(target=produce, name='parse')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            batch = q.get()
+            if batch is done:
+                break
+            elif isinstance(batch, StageFailed):
+                batch.reraise()
+            for item in batch:
+                yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class WriterThread(object):
+    """
+    A thread that runs the calls submitted to it, in order, so that
+    whatever it writes to (a database connection, file handles) is
+    only ever used from one thread.
+
+    The queue of calls is bounded, so submit blocks when the writer
+    falls behind. An exception in the writer is raised by the next
+    submit, or by close, which waits for all calls to finish.
+    """
+    def __init__(self, depth=QUEUE_DEPTH):
+        self.queue = queue.Queue(depth)
+        self.failed = None
+        self.thread = threading.Thread(target=self.run, name='write')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            call = self.queue.get()
+            if call is None:
+                return
+            if self.failed is None:
+                try:
+                    call[0](*call[1])
+                except BaseException:
+                    self.failed = StageFailed(sys.exc_info())
+
+    def submit(self, func, *args):
+        if self.failed is not None:
+            self.close()
+        self.queue.put((func, args))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.failed is not None:
+            self.failed.reraise()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+healthstore.py: Query the export.sqlite written by
+applehealthdataeventsqlite.py from Python.
+
+    store = HealthStore('export.sqlite')
+    for row in store.query('HeartRate', '2016-04-01', '2016-04-08',
+                           columns=['startDateUtc', 'value',
+                                    'sourceName']):
+        ...
+
+Rows come back with lookup ids (sourceName, device, unit, ...) resolved
+to their names, fetched from SQLite in chunks as they are iterated over,
+using the index on the table's time column (see build_indexes in
+applehealthdataeventsqlite.py) to find the range. With arrays=True, a
+query instead returns each column as a NumPy array (or a list, without
+NumPy).
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sqlite3
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from cohort import EXPORT_COLUMN, EXPORT_TABLE
+from healthexport import epoch_seconds, string_types
+from applehealthdataeventsqlite import (LOOKUP_FIELDS, METADATA_TABLE,
+                                        ROLLUP_PERIODS, ROUTE_POINT_COLUMNS,
+                                        ROUTE_POINT_TABLE, SIDE_TABLES,
+                                        TIME_INDEX_COLUMNS)
+
+# Rows fetched from SQLite at a time
+CHUNK_SIZE = 10000
+EPOCH = datetime(1970, 1, 1)
+
+
+def bound_value(value, column):
+    """
+    A query bound in the form stored in column: UTC seconds for the
+    <field>Utc columns, or text for a text date column, in which case
+    (like the export) it is compared as written, so bounds should be in
+    the same timezone as the data.
+    """
+    if column.endswith('Utc'):
+        return epoch_seconds(value)
+    elif isinstance(value, string_types):
+        return value
+    seconds = epoch_seconds(value)
+    text = (EPOCH + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+    return text[:10] if column == 'dateComponents' else text + ' +0000'
+
+
+class HealthStore(object):
+    """
+    Read-only queries over an export.sqlite.
+
+    The z* lookup tables are read when first needed, and kept, so ids
+    are resolved with a dict lookup.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.tables = OrderedDict()
+        for (name,) in self.conn.execute(
+                'SELECT name FROM sqlite_master WHERE type = \'table\' '
+                'AND name NOT LIKE \'sqlite_%\' ORDER BY name'):
+            self.tables[name] = [row[1] for row in self.conn.execute(
+                'PRAGMA table_info({})'.format(name))]
+        self.lookups = {}
+
+    def close(self):
+        self.conn.close()
+
+    def kinds(self):
+        """
+        The record types in the store.
+        """
+        dimensions = set('z' + name for name in LOOKUP_FIELDS.values())
+        return [name for name in self.tables
+                if name not in dimensions and name not in ROLLUP_PERIODS
+                and name not in SIDE_TABLES and name != EXPORT_TABLE]
+
+    def columns(self, kind):
+        return list(self.tables[kind])
+
+    def time_column(self, kind):
+        """
+        The column a query's start and end apply to: the first of
+        TIME_INDEX_COLUMNS in the table, which is the one indexed.
+        """
+        for column in TIME_INDEX_COLUMNS:
+            if column in self.tables[kind]:
+                return column
+        raise KeyError('%s has no time column' % kind)
+
+    def lookup(self, column):
+        """
+        Dict from id to name for a lookup column, or None if column
+        isn't one.
+        """
+        name = LOOKUP_FIELDS.get(column)
+        if name is None:
+            return None
+        if name not in self.lookups:
+            table = 'z' + name
+            names = self.lookups[name] = {}
+            if table in self.tables:
+                # ids are stored as text in text columns; as integers
+                # in case of numeric affinity
+                for (i, value) in self.conn.execute(
+                        'SELECT value, name FROM {}'.format(table)):
+                    names[i] = names[int(i)] = value
+        return self.lookups[name]
+
+    def exports(self):
+        """
+        The (export, person, path) of each export in a store written by
+        cohort.py, or [] for a single export.
+        """
+        if EXPORT_TABLE not in self.tables:
+            return []
+        return self.conn.execute('SELECT {}, person, path FROM {} ORDER BY {}'
+                                 .format(EXPORT_COLUMN, EXPORT_TABLE,
+                                         EXPORT_COLUMN)).fetchall()
+
+    def chunks(self, kind, start=None, end=None, columns=None,
+               chunk_size=CHUNK_SIZE, export=None):
+        """
+        Yield the rows of kind with start <= time < end, in time order,
+        as lists of up to chunk_size tuples. Either bound can be None.
+        In a cohort store, export picks out one export's rows.
+        """
+        if kind not in self.tables:
+            raise KeyError('No table for %s' % kind)
+        columns = list(columns or self.tables[kind])
+        for column in columns:
+            if column not in self.tables[kind] and column != 'rowid':
+                raise KeyError('%s has no column %s' % (kind, column))
+        time_column = self.time_column(kind)
+        conditions = []
+        parameters = []
+        if export is not None:
+            if EXPORT_COLUMN not in self.tables[kind]:
+                raise KeyError('%s has no %s column' % (kind, EXPORT_COLUMN))
+            conditions.append('{} = ?'.format(EXPORT_COLUMN))
+            parameters.append(export)
+        if start is not None:
+            conditions.append('{} >= ?'.format(time_column))
+            parameters.append(bound_value(start, time_column))
+        if end is not None:
+            conditions.append('{} < ?'.format(time_column))
+            parameters.append(bound_value(end, time_column))
+        sql = 'SELECT {} FROM {}{} ORDER BY {}'.format(
+            ', '.join(columns), kind,
+            ' WHERE ' + ' AND '.join(conditions) if conditions else '',
+            time_column)
+        lookups = [(i, names) for (i, names)
+                   in enumerate(self.lookup(column) for column in columns)
+                   if names is not None]
+        cursor = self.conn.execute(sql, parameters)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                if lookups:
+                    rows = [list(row) for row in rows]
+                    for row in rows:
+                        for (i, names) in lookups:
+                            row[i] = names.get(row[i])
+                    rows = [tuple(row) for row in rows]
+                yield rows
+        finally:
+            cursor.close()
+
+    def metadata(self, kind, rowids):
+        """
+        Dict from rowid to the list of (key, value) pairs of the
+        metadata for each of the given records of kind (which can be
+        fetched by asking a query for the 'rowid' column). The load
+        must have kept metadata; see Metadata in
+        applehealthdataeventsqlite.py.
+        """
+        result = dict((rowid, []) for rowid in rowids)
+        types = dict((name, i) for (i, name) in self.lookup('type').items()
+                     if not isinstance(i, int))
+        if METADATA_TABLE not in self.tables or kind not in types:
+            return result
+        keys = self.lookup('metadataKey')
+        ids = list(result)
+        for i in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[i:i + CHUNK_SIZE]
+            for (record, key, value) in self.conn.execute(
+                    'SELECT record, metadataKey, value FROM {} '
+                    'WHERE type = ? AND record IN ({}) ORDER BY rowid'
+                    .format(METADATA_TABLE, ', '.join('?' * len(chunk))),
+                    [types[kind]] + chunk):
+                result[record].append((keys.get(key), value))
+        return result
+
+    def route(self, workout, start=None, end=None):
+        """
+        The track points of the route of the workout with the given
+        rowid (see query), with start <= time < end, in time order, as
+        tuples of ROUTE_POINT_COLUMNS from applehealthdataeventsqlite.py.
+        """
+        if ROUTE_POINT_TABLE not in self.tables:
+            return []
+        conditions = ['workout = ?']
+        parameters = [workout]
+        if start is not None:
+            conditions.append('timeUtc >= ?')
+            parameters.append(epoch_seconds(start))
+        if end is not None:
+            conditions.append('timeUtc < ?')
+            parameters.append(epoch_seconds(end))
+        return self.conn.execute(
+            'SELECT {} FROM {} WHERE {} ORDER BY timeUtc'.format(
+                ', '.join(ROUTE_POINT_COLUMNS), ROUTE_POINT_TABLE,
+                ' AND '.join(conditions)), parameters).fetchall()
+
+    def query(self, kind, start=None, end=None, columns=None,
+              chunk_size=CHUNK_SIZE, arrays=False, export=None):
+        """
+        The rows of kind with start <= time < end, in time order, where
+        time is the table's time column (see time_column), and start
+        and end are UTC seconds, export timestamps or dates, or Python
+        datetimes or dates, or None for no bound.
+
+        columns can include 'rowid', for looking up the records'
+        metadata (see metadata). In a store written by cohort.py, export
+        restricts the rows to those of one export; see exports.
+
+        Returns an iterator of row tuples, fetched chunk_size at a time,
+        or with arrays=True, an OrderedDict from column name to a NumPy
+        array of the column's values (a list, if NumPy isn't installed).
+        """
+        chunks = self.chunks(kind, start, end, columns, chunk_size, export)
+        if not arrays:
+            return (row for rows in chunks for row in rows)
+        columns = list(columns or self.tables[kind])
+        values = [[] for column in columns]
+        for rows in chunks:
+            for (column_values, chunk_values) in zip(values, zip(*rows)):
+                column_values.extend(chunk_values)
+        if numpy is not None:
+            values = [numpy.array(column_values) for column_values in values]
+        return OrderedDict(zip(columns, values))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+loadmetrics.py: Progress and per-stage metrics for long imports, and a
+sampling profiler for finding where the time goes.
+
+LoadMetrics collects time spent in each stage of a load, records per
+second, bytes of the export consumed (for an ETA), peak RSS and counts
+per record type, and emits them as JSON lines, to a file or to a
+callback.
+
+SamplingProfiler samples the Python stack on SIGPROF (CPU time), which
+costs next to nothing between samples, and writes a report of the
+hottest lines and functions.
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import signal
+import sys
+import time
+
+from collections import Counter, OrderedDict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.time
+
+# Stages of a load, in pipeline order
+STAGES = ('parse', 'metadata', 'abbreviate', 'format', 'lookup', 'write',
+          'rollup', 'index')
+# Records between progress events
+PROGRESS_INTERVAL = 10000
+# Seconds of CPU time between profiler samples
+SAMPLE_INTERVAL = 0.001
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, or None if unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def timed(iterable, metrics, stage):
+    """
+    Yield the items of iterable, adding the time taken to produce each
+    one to the given stage of metrics.
+    """
+    iterator = iter(iterable)
+    stages = metrics.stages
+    while True:
+        start = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            stages[stage] += clock() - start
+            return
+        stages[stage] += clock() - start
+        yield item
+
+
+class LoadMetrics(object):
+    """
+    Metrics for a load, emitted as JSON lines.
+
+    Inputs:
+        sink:        A path to append JSON lines to, or a callable that
+                     is passed each event as a dict
+        total_bytes: Size of the (uncompressed) export, if known, for
+                     the ETA
+        position:    Callable returning the number of bytes of the export
+                     read so far, or None if unknown. Clear it when the
+                     export is closed.
+        interval:    Records between progress events
+
+    Events have an 'event' of 'start', 'progress' or 'summary'. Progress
+    and summary events carry the elapsed time, records, records_per_sec,
+    bytes, fraction done and eta_seconds (where the size is known),
+    peak_rss_mb, the seconds spent in each stage, and the counts for
+    each record type.
+    """
+    def __init__(self, sink, total_bytes=None, position=None,
+                 interval=PROGRESS_INTERVAL):
+        self.sink = sink
+        self.f = None
+        if not callable(sink):
+            self.f = io.open(sink, 'a', encoding='UTF-8')
+        self.total_bytes = total_bytes
+        self.position = position
+        self.interval = interval
+        self.stages = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.counts = Counter()
+        self.records = 0
+        self.next_progress = interval
+        self.started = time.time()
+
+    def emit(self, event, **fields):
+        record = OrderedDict((('event', event),
+                              ('time', round(time.time(), 3))))
+        record.update(fields)
+        if self.f is None:
+            self.sink(record)
+        else:
+            self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+
+    def start(self, path):
+        self.started = time.time()
+        self.emit('start', path=path, total_bytes=self.total_bytes)
+
+    def add(self, kind):
+        """
+        Count a record of kind, emitting progress every interval records.
+        """
+        self.counts[kind] += 1
+        self.records += 1
+        if self.records >= self.next_progress:
+            self.next_progress += self.interval
+            self.emit('progress', **self.snapshot())
+
+    def snapshot(self, done=False):
+        elapsed = time.time() - self.started
+        if done:
+            position = self.total_bytes
+        else:
+            position = self.position() if self.position else None
+        fields = OrderedDict((
+            ('elapsed', round(elapsed, 3)),
+            ('records', self.records),
+            ('records_per_sec', round(self.records / elapsed, 1)
+                                if elapsed else None),
+            ('bytes', position),
+        ))
+        if position and self.total_bytes:
+            fraction = min(1.0, position / self.total_bytes)
+            fields['fraction'] = round(fraction, 4)
+            fields['eta_seconds'] = (round(elapsed * (1 - fraction)
+                                           / fraction, 1)
+                                     if fraction else None)
+        fields['peak_rss_mb'] = peak_rss_mb()
+        fields['stages'] = OrderedDict((stage, round(seconds, 3))
+                                       for (stage, seconds)
+                                       in self.stages.items())
+        return fields
+
+    def finish(self):
+        fields = self.snapshot(done=True)
+        fields['counts'] = OrderedDict(sorted(self.counts.items()))
+        self.emit('summary', **fields)
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler: every interval seconds of CPU time, SIGPROF
+    records the line being run (for self time) and every function on
+    the stack (for inclusive time).
+
+    Where SIGPROF isn't available (Windows), falls back to cProfile.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lines = Counter()
+        self.functions = Counter()
+        self.samples = 0
+        self.profile = None
+        self.previous = None
+
+    def sample(self, signum, frame):
+        self.samples += 1
+        if frame is None:
+            return
+        code = frame.f_code
+        self.lines[(code.co_filename, frame.f_lineno or 0,
+                    code.co_name)] += 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if key not in seen:
+                seen.add(key)
+                self.functions[key] += 1
+            frame = frame.f_back
+
+    def start(self):
+        if hasattr(signal, 'setitimer') and hasattr(signal, 'SIGPROF'):
+            self.previous = signal.signal(signal.SIGPROF, self.sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        if self.profile is not None:
+            self.profile.disable()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+
+    def report(self, path, top=25):
+        """
+        Write the hottest lines (self time) and functions (inclusive
+        time) to path.
+        """
+        with io.open(path, 'w', encoding='UTF-8') as f:
+            if self.profile is not None:
+                import pstats
+                stream = io.StringIO() if sys.version_info.major > 2 else (
+                    io.BytesIO())
+                stats = pstats.Stats(self.profile, stream=stream)
+                stats.sort_stats('tottime').print_stats(top)
+                f.write(stream.getvalue())
+                return
+            total = max(1, self.samples)
+            f.write('%d samples, one per %gs of CPU time\n\n'
+                    % (self.samples, self.interval))
+            for (title, counter) in (('Hottest lines (self time)',
+                                      self.lines),
+                                     ('Hottest functions (inclusive time)',
+                                      self.functions)):
+                f.write('%s:\n' % title)
+                for ((filename, line, name), n) in counter.most_common(top):
+                    f.write('%6.1f%% %7d  %s:%d %s\n'
+                            % (100.0 * n / total, n,
+                               os.path.basename(filename), line, name))
+                f.write('\n')
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+makeexport.py: Generate synthetic Apple Health exports.
+
+The exports follow the DTD at the top of the sample in testdata, and are
+laid out as the phone lays them out: Me, then each record type in turn
+in time order (including the blood pressure Records, which the DTD has
+repeated at the top level), then the blood pressure Correlations holding
+them, Workouts (with their WorkoutEvents) and one ActivitySummary per
+day. The same settings always
+produce the same file.
+
+Usage:
+    python makeexport.py [--records N | --size 1.5G] [--seed S] out.xml
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import calendar
+import io
+import os
+import random
+import sys
+import time
+
+from collections import OrderedDict
+
+# Record types generated by default: (unit, relative frequency,
+# (low, high) for the value, decimal places). Values of None are
+# category types, whose values come from CATEGORY_VALUES.
+RECORD_MIX = OrderedDict((
+    ('HKQuantityTypeIdentifierHeartRate', ('count/min', 30, (45, 190), 0)),
+    ('HKQuantityTypeIdentifierStepCount', ('count', 20, (1, 600), 0)),
+    ('HKQuantityTypeIdentifierDistanceWalkingRunning',
+     ('km', 15, (0.001, 0.5), 5)),
+    ('HKQuantityTypeIdentifierActiveEnergyBurned',
+     ('kcal', 15, (0.05, 12), 3)),
+    ('HKQuantityTypeIdentifierBasalEnergyBurned',
+     ('kcal', 10, (0.5, 2), 3)),
+    ('HKQuantityTypeIdentifierFlightsClimbed', ('count', 3, (1, 6), 0)),
+    ('HKQuantityTypeIdentifierHeartRateVariabilitySDNN',
+     ('ms', 1, (10, 120), 3)),
+    ('HKQuantityTypeIdentifierRestingHeartRate',
+     ('count/min', 0.2, (45, 75), 0)),
+    ('HKQuantityTypeIdentifierBodyMass', ('kg', 0.1, (70, 90), 1)),
+    ('HKCategoryTypeIdentifierAppleStandHour', (None, 3, None, 0)),
+    ('HKCategoryTypeIdentifierSleepAnalysis', (None, 0.5, None, 0)),
+))
+
+CATEGORY_VALUES = {
+    'HKCategoryTypeIdentifierAppleStandHour': (
+        'HKCategoryValueAppleStandHourIdle',
+        'HKCategoryValueAppleStandHourStood'),
+    'HKCategoryTypeIdentifierSleepAnalysis': (
+        'HKCategoryValueSleepAnalysisInBed',
+        'HKCategoryValueSleepAnalysisAsleep'),
+}
+
+# Sources and the devices that write them. Names include the
+# non-breaking space and ampersand that turn up in real exports.
+SOURCES = (
+    ('NJR Apple\xa0Watch', 'Watch'),
+    ('NJR iPhone', 'iPhone'),
+    ('Health', None),
+    ('Withings & Co', 'Scale'),
+    ('Strava', None),
+)
+
+# The member Records of a blood pressure Correlation
+BLOOD_PRESSURE_TYPES = ('HKQuantityTypeIdentifierBloodPressureSystolic',
+                        'HKQuantityTypeIdentifierBloodPressureDiastolic')
+
+WORKOUT_TYPES = ('HKWorkoutActivityTypeWalking',
+                 'HKWorkoutActivityTypeRunning',
+                 'HKWorkoutActivityTypeCycling',
+                 'HKWorkoutActivityTypeOther')
+
+START_DATE = '2015-01-01'
+TIMEZONES = ('+0000', '+0100')
+RECORDS_PER_DAY = 2500
+MOTION_CONTEXT_KEY = 'HKMetadataKeyHeartRateMotionContext'
+METADATA_KEYS = ('HKMetadataKeyDevicePlacementSide',
+                 'HKMetadataKeySyncVersion',
+                 'HKMetadataKeySyncIdentifier')
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def sample_dtd():
+    """
+    The XML declaration and DTD from the sample export in testdata.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'testdata', 'export6s3sample.xml')
+    with io.open(path, encoding='UTF-8') as f:
+        text = f.read()
+    return text[:text.index('<HealthData')]
+
+
+def parse_size(text):
+    """
+    Parse a size such as 500M or 1.5G as a number of bytes.
+    """
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def escape(value):
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+                 .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+class ExportGenerator(object):
+    """
+    Generate a synthetic export.
+
+    Inputs:
+        n_records:  Number of Records (not counting the blood pressure
+                    Records of Correlations) to generate
+        size:       Alternatively, an approximate size for the export in
+                    bytes, from which n_records is estimated
+        seed:       Seed for the random numbers; the same settings and
+                    seed always give the same export
+        mix:        OrderedDict of record types as in RECORD_MIX
+        n_sources:  How many of SOURCES to use
+        n_devices:  Number of distinct devices (hardware and software
+                    versions) per source that has a device
+        metadata_density: Fraction of Records (other than HeartRate,
+                    which always has a motion context) with MetadataEntry
+                    children
+        workouts_per_day, correlations_per_day: Average counts per day
+        activity_summaries: Whether to write one ActivitySummary per day
+        records_per_day: Sets the number of days the export covers
+        start_date: First day covered, as YYYY-MM-DD
+    """
+    def __init__(self, n_records=100000, size=None, seed=0, mix=RECORD_MIX,
+                 n_sources=len(SOURCES), n_devices=3, metadata_density=0.1,
+                 workouts_per_day=0.5, correlations_per_day=0.2,
+                 activity_summaries=True, records_per_day=RECORDS_PER_DAY,
+                 start_date=START_DATE):
+        self.seed = seed
+        self.mix = mix
+        self.sources = SOURCES[:max(1, n_sources)]
+        self.n_devices = n_devices
+        self.metadata_density = metadata_density
+        self.workouts_per_day = workouts_per_day
+        self.correlations_per_day = correlations_per_day
+        self.activity_summaries = activity_summaries
+        self.records_per_day = records_per_day
+        self.start = calendar.timegm(time.strptime(start_date, '%Y-%m-%d'))
+        if size is not None:
+            n_records = self.estimate_records(size)
+        self.n_records = n_records
+        self.n_days = max(1, int(round(n_records / records_per_day)))
+        self.counts = OrderedDict()
+        self.pressures = []
+
+    def estimate_records(self, size):
+        """
+        Estimate the number of records in an export of size bytes, by
+        generating a small one and measuring it.
+        """
+        sample = ExportGenerator(n_records=2000, seed=self.seed, mix=self.mix,
+                                 n_sources=len(self.sources),
+                                 n_devices=self.n_devices,
+                                 metadata_density=self.metadata_density,
+                                 workouts_per_day=self.workouts_per_day,
+                                 correlations_per_day=self.correlations_per_day,
+                                 activity_summaries=self.activity_summaries,
+                                 records_per_day=self.records_per_day)
+        n_bytes = sum(len(s.encode('UTF-8')) for s in sample.body())
+        return max(1, int(size * 2000 / n_bytes))
+
+    def timestamp(self, seconds, zone):
+        offset = (1 if zone[0] == '+' else -1) * (int(zone[1:3]) * 3600
+                                                  + int(zone[3:5]) * 60)
+        return '%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                        time.gmtime(seconds + offset)), zone)
+
+    def device(self, kind, index):
+        return escape('<<HKDevice: 0x%x>, name:%s, manufacturer:Apple, '
+                      'model:%s, hardware:%s%d,%d, software:%d.%d>'
+                      % (0x1c0000000 + 0x10 * index, kind, kind, kind,
+                         index + 1, index % 2 + 1, 10 + index, index % 4))
+
+    def source_attributes(self, rng):
+        (name, device) = self.sources[rng.randrange(len(self.sources))]
+        text = ' sourceName="%s" sourceVersion="%d.%d"' % (
+            escape(name), rng.randrange(9, 13), rng.randrange(4))
+        if device is not None:
+            text += ' device="%s"' % self.device(device,
+                                                 rng.randrange(self.n_devices))
+        return text
+
+    def zone(self, seconds):
+        # summer time, roughly
+        month = time.gmtime(seconds).tm_mon
+        return TIMEZONES[1] if 4 <= month <= 10 else TIMEZONES[0]
+
+    def times(self, rng, count):
+        """
+        count sorted start times spread over the days covered.
+        """
+        span = self.n_days * 86400
+        step = span / max(1, count)
+        for i in range(count):
+            yield self.start + int(i * step + rng.random() * step)
+
+    def value(self, rng, kind, low_high, places):
+        if low_high is None:
+            values = CATEGORY_VALUES[kind]
+            return values[rng.randrange(len(values))]
+        (low, high) = low_high
+        value = low + (high - low) * rng.random()
+        return '%.*f' % (places, value) if places else '%d' % round(value)
+
+    def records(self, rng):
+        total = sum(weight for (unit, weight, low_high, places)
+                    in self.mix.values())
+        for (kind, (unit, weight, low_high, places)) in self.mix.items():
+            count = int(round(self.n_records * weight / total))
+            self.counts[kind] = count
+            unit_text = ' unit="%s"' % unit if unit else ''
+            for start in self.times(rng, count):
+                zone = self.zone(start)
+                end = start + rng.randrange(1, 600)
+                created = end + rng.randrange(1, 3600)
+                head = (' <Record type="%s"%s%s creationDate="%s" '
+                        'startDate="%s" endDate="%s" value="%s"' % (
+                            kind, self.source_attributes(rng), unit_text,
+                            self.timestamp(created, zone),
+                            self.timestamp(start, zone),
+                            self.timestamp(end, zone),
+                            self.value(rng, kind, low_high, places)))
+                metadata = []
+                if kind == 'HKQuantityTypeIdentifierHeartRate':
+                    metadata.append((MOTION_CONTEXT_KEY,
+                                     '%d' % rng.randrange(3)))
+                if rng.random() < self.metadata_density:
+                    key = METADATA_KEYS[rng.randrange(len(METADATA_KEYS))]
+                    metadata.append((key, '%d' % rng.randrange(1000)))
+                if metadata:
+                    yield head + '>\n' + ''.join(
+                        '  <MetadataEntry key="%s" value="%s"/>\n' % entry
+                        for entry in metadata) + ' </Record>\n'
+                else:
+                    yield head + '/>\n'
+        for (i, kind) in enumerate(BLOOD_PRESSURE_TYPES):
+            self.counts[kind] = len(self.pressures)
+            for (correlation, members) in self.pressures:
+                yield ' ' + members[i]
+
+    def blood_pressures(self, rng):
+        """
+        The blood pressure Correlations, in time order, each as the text
+        of its start tag and of its member Records (without indentation),
+        which records() also writes at the top level.
+        """
+        count = int(round(self.n_days * self.correlations_per_day))
+        pressures = []
+        for start in self.times(rng, count):
+            zone = self.zone(start)
+            when = ('creationDate="%s" startDate="%s" endDate="%s"'
+                    % (self.timestamp(start + 5, zone),
+                       self.timestamp(start, zone),
+                       self.timestamp(start, zone)))
+            source = ' sourceName="%s"' % escape(self.sources[-1][0])
+            members = ['<Record type="%s"%s unit="mmHg" %s value="%d"/>\n'
+                       % (kind, source, when, value)
+                       for (kind, value) in zip(BLOOD_PRESSURE_TYPES,
+                                                (rng.randrange(100, 150),
+                                                 rng.randrange(60, 95)))]
+            pressures.append((' <Correlation type='
+                              '"HKCorrelationTypeIdentifierBloodPressure"'
+                              '%s %s>\n' % (source, when), members))
+        return pressures
+
+    def correlations(self, rng):
+        self.counts['Correlation'] = len(self.pressures)
+        for (correlation, members) in self.pressures:
+            yield correlation
+            for member in members:
+                yield '  ' + member
+            yield ' </Correlation>\n'
+
+    def workouts(self, rng):
+        count = int(round(self.n_days * self.workouts_per_day))
+        self.counts['Workout'] = count
+        for start in self.times(rng, count):
+            zone = self.zone(start)
+            minutes = 10 + 80 * rng.random()
+            end = start + int(minutes * 60)
+            activity = WORKOUT_TYPES[rng.randrange(len(WORKOUT_TYPES))]
+            yield (' <Workout workoutActivityType="%s" duration="%r" '
+                   'durationUnit="min" totalDistance="%.3f" '
+                   'totalDistanceUnit="km" totalEnergyBurned="%.3f" '
+                   'totalEnergyBurnedUnit="kcal"%s creationDate="%s" '
+                   'startDate="%s" endDate="%s">\n'
+                   % (activity, minutes, minutes * 0.15 * rng.random(),
+                      minutes * 8 * rng.random(), self.source_attributes(rng),
+                      self.timestamp(end + 30, zone),
+                      self.timestamp(start, zone), self.timestamp(end, zone)))
+            if rng.random() < 0.5:
+                pause = start + (end - start) // 2
+                for (event, seconds) in (('Pause', pause),
+                                         ('Resume', pause + 60)):
+                    yield ('  <WorkoutEvent type="HKWorkoutEventType%s" '
+                           'date="%s"/>\n'
+                           % (event, self.timestamp(seconds, zone)))
+            yield ' </Workout>\n'
+
+    def summaries(self, rng):
+        count = self.n_days if self.activity_summaries else 0
+        self.counts['ActivitySummary'] = count
+        for day in range(count):
+            date = time.strftime('%Y-%m-%d',
+                                 time.gmtime(self.start + day * 86400))
+            yield (' <ActivitySummary dateComponents="%s" '
+                   'activeEnergyBurned="%.3f" activeEnergyBurnedGoal="600" '
+                   'activeEnergyBurnedUnit="kcal" appleExerciseTime="%d" '
+                   'appleExerciseTimeGoal="30" appleStandHours="%d" '
+                   'appleStandHoursGoal="12"/>\n'
+                   % (date, 900 * rng.random(), rng.randrange(90),
+                      rng.randrange(18)))
+
+    def body(self):
+        """
+        Yield the text of the export, element by element.
+        """
+        rng = random.Random(self.seed)
+        yield sample_dtd()
+        yield '<HealthData locale="en_GB">\n'
+        end = self.start + self.n_days * 86400
+        yield (' <ExportDate value="%s"/>\n'
+               % self.timestamp(end, self.zone(end)))
+        yield (' <Me HKCharacteristicTypeIdentifierDateOfBirth="1970-01-01" '
+               'HKCharacteristicTypeIdentifierBiologicalSex="HKBiologicalSexNotSet" '
+               'HKCharacteristicTypeIdentifierBloodType="HKBloodTypeNotSet" '
+               'HKCharacteristicTypeIdentifierFitzpatrickSkinType='
+               '"HKFitzpatrickSkinTypeNotSet"/>\n')
+        self.pressures = self.blood_pressures(rng)
+        for part in (self.records, self.correlations, self.workouts,
+                     self.summaries):
+            for text in part(rng):
+                yield text
+        yield '</HealthData>\n'
+
+    def write(self, path):
+        """
+        Write the export to path, returning the number of elements of
+        each kind written.
+        """
+        with io.open(path, 'w', encoding='UTF-8', newline='\n',
+                     buffering=1 << 20) as f:
+            for text in self.body():
+                f.write(text)
+        return self.counts
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kwargs = {}
+    for (flag, name, convert) in (('--records', 'n_records', int),
+                                  ('--size', 'size', parse_size),
+                                  ('--seed', 'seed', int)):
+        if flag in args and args.index(flag) + 1 < len(args):
+            i = args.index(flag)
+            kwargs[name] = convert(args[i + 1])
+            del args[i:i + 2]
+    if len(args) != 1:
+        print('USAGE: python makeexport.py [--records N | --size 1.5G] '
+              '[--seed S] /path/to/out.xml', file=sys.stderr)
+        sys.exit(1)
+    counts = ExportGenerator(**kwargs).write(args[0])
+    for (kind, count) in counts.items():
+        print('%s: %d' % (kind, count))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+rowcodec.py: Row codecs, compiled once per record type, that turn a
+record's attributes into the row an output sink writes.
+
+A field plan is a list of (field, converter) pairs. Rather than loop
+over the plan for every record, branching on each field's datatype,
+compile_codec generates a function with the attribute lookups written
+out and the converters bound to it, e.g. for a CSV Record
+
+    def encode(attributes):
+        get = attributes.get
+        return separator.join([c0(get('sourceName', default)), ...,
+                               c8(get('value', default))]) + terminator
+
+Each sink supplies converters for its datatypes (see codec_fields).
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+
+def compose(first, second):
+    """
+    The converter applying first, then second; either can be None.
+    """
+    if first is None:
+        return second
+    elif second is None:
+        return first
+    return lambda value: second(first(value))
+
+
+def codec_fields(plan, converters, column_converters=None):
+    """
+    (field, converter) pairs for a plan of (column, field, datatype)
+    triples, taking the converter for each datatype from converters,
+    followed by any for the column in column_converters (such as a
+    lookup). A converter of None passes the value through unchanged.
+    """
+    column_converters = column_converters or {}
+    fields = []
+    for (column, field, datatype) in plan:
+        if datatype not in converters:
+            raise KeyError('Unexpected format value: %s' % datatype)
+        fields.append((field, compose(converters[datatype],
+                                      column_converters.get(column))))
+    return fields
+
+
+def compile_codec(fields, default=None, separator=None, terminator=''):
+    """
+    Compile a function from a record's attributes dict to its row.
+
+    Inputs:
+        fields:     A sequence of (field, converter) pairs, where
+                    converter is called with the field's value, or is
+                    None to use the value as it is
+        default:    The value for attributes the record doesn't have
+        separator:  If set, the row is returned as a string, with the
+                    values joined by separator and followed by
+                    terminator, rather than as a list
+    """
+    namespace = {'default': default, 'separator': separator,
+                 'terminator': terminator}
+    values = []
+    for (i, (field, converter)) in enumerate(fields):
+        value = 'get(%r, default)' % str(field)
+        if converter is not None:
+            namespace['c%d' % i] = converter
+            value = 'c%d(%s)' % (i, value)
+        values.append(value)
+    row = '[%s]' % ', '.join(values)
+    if separator is not None:
+        row = 'separator.join(%s) + terminator' % row
+    source = ('def encode(attributes):\n'
+              '    get = attributes.get\n'
+              '    return %s\n' % row)
+    exec(compile(source, '<codec>', 'exec'), namespace)
+    return namespace['encode']
@@ -10,18 +10,25 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import bz2
+import gzip
 import os
 import re
 import shutil
 import sys
 import unittest
+import zipfile
 
 from collections import Counter
+from xml.etree import ElementTree
 
 
+import healthexport
+
 from applehealthdata import (HealthDataExtractor,
                              format_freqs, format_value,
                              abbreviate, encode)
+from makeexport import ExportGenerator
 
 CLEAN_UP = True
 VERBOSE = False
@@ -81,6 +88,30 @@ def copy_test_data():
     return out_xml_file
 
 
+def compress_test_data(suffix):
+    """
+    Copy the test data into the tmp directory as a compressed export:
+    an export.zip laid out as the phone writes it, or export.xml.gz
+    or export.xml.bz2. Returns the path to the compressed export.
+    """
+    tmp_dir = make_tmp_dir()
+    in_xml_file = os.path.join(get_testdata_dir(), 'export6s3sample.xml')
+    with open(in_xml_file, 'rb') as f:
+        xml = f.read()
+    if suffix == '.zip':
+        path = os.path.join(tmp_dir, 'export.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('apple_health_export/export_cda.xml', b'<x/>')
+            archive.writestr('apple_health_export/export.xml', xml)
+    else:
+        path = os.path.join(tmp_dir, 'export.xml' + suffix)
+        opener = gzip.GzipFile if suffix == '.gz' else bz2.BZ2File
+        f = opener(path, 'wb')
+        f.write(xml)
+        f.close()
+    return path
+
+
 class TestAppleHealthDataExtractor(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
@@ -88,9 +119,9 @@ class TestAppleHealthDataExtractor(unittest.TestCase):
         if CLEAN_UP:
             remove_any_tmp_dir()
 
-    def check_file(self, filename):
+    def check_file(self, filename, directory=None):
         expected_output = os.path.join(get_testdata_dir(), filename)
-        actual_output = os.path.join(get_tmp_dir(), filename)
+        actual_output = os.path.join(directory or get_tmp_dir(), filename)
         with open(expected_output) as f:
             expected = f.read()
         with open(actual_output) as f:
@@ -105,6 +136,80 @@ class TestAppleHealthDataExtractor(unittest.TestCase):
                      'Workout', 'ActivitySummary'):
             self.check_file('%s.csv' % kind)
 
+    def test_compressed_extraction(self):
+        for suffix in ('.zip', '.gz', '.bz2'):
+            path = compress_test_data(suffix)
+            data = HealthDataExtractor(path, verbose=VERBOSE)
+            data.extract()
+            out_dir = os.path.join(get_tmp_dir(), 'export')
+            self.assertEqual(data.directory, out_dir)
+            self.assertEqual(data.n_nodes, 20)
+            for kind in ('StepCount', 'DistanceWalkingRunning',
+                         'Workout', 'ActivitySummary'):
+                self.check_file('%s.csv' % kind, out_dir)
+
+    def test_extraction_streams(self):
+        """
+        The export is never parsed into a whole tree, and with iterparse
+        the root is cleared as its children are consumed, so it never
+        holds more than a chunk's worth of them.
+        """
+        path = os.path.join(make_tmp_dir(), 'export.xml')
+        ExportGenerator(n_records=5000).write(path)
+        (parse, getroot) = (ElementTree.parse, ElementTree.ElementTree.getroot)
+        iterparse = ElementTree.iterparse
+        most = []
+
+        def refuse(*args, **kwargs):
+            raise AssertionError('the whole export was parsed')
+
+        def watched(source, events=None, parser=None):
+            root = None
+            for (event, element) in iterparse(source, events, parser):
+                if root is None:
+                    root = element
+                most.append(len(root))
+                yield (event, element)
+
+        ElementTree.parse = ElementTree.ElementTree.getroot = refuse
+        ElementTree.iterparse = watched
+        try:
+            for parser in ('iterparse', 'scan'):
+                data = HealthDataExtractor(path, verbose=VERBOSE,
+                                           parser=parser)
+                data.extract()
+                self.assertGreater(data.n_nodes, 5000)
+        finally:
+            ElementTree.parse = parse
+            ElementTree.ElementTree.getroot = getroot
+            ElementTree.iterparse = iterparse
+        self.assertLess(max(most), 500)
+
+    def test_indexed_stats_and_selection(self):
+        path = copy_test_data()
+        streamed = HealthDataExtractor(path, verbose=VERBOSE)
+        streamed.collect_stats()
+        healthexport.export_index(path)
+        indexed = HealthDataExtractor(path, verbose=VERBOSE)
+        indexed.collect_stats()
+        for stat in ('n_nodes', 'tags', 'fields', 'record_types',
+                     'other_types'):
+            self.assertEqual(getattr(indexed, stat), getattr(streamed, stat))
+
+        data = HealthDataExtractor(path, verbose=VERBOSE, kinds=['StepCount'])
+        data.extract()
+        self.assertEqual([name for name in os.listdir(data.directory)
+                          if name.endswith('.csv')], ['StepCount.csv'])
+        self.check_file('StepCount.csv')
+        data = HealthDataExtractor(path, verbose=VERBOSE,
+                                   start='2014-09-13 11:00:00 +0100',
+                                   end='2016-04-15')
+        data.extract()
+        self.assertEqual(sorted(data.record_types.items()),
+                         [('DistanceWalkingRunning', 5), ('StepCount', 4)])
+        self.assertEqual(data.other_types,
+                         Counter({'ActivitySummary': 1, 'Workout': 1}))
+
     def test_format_freqs(self):
         counts = Counter()
         self.assertEqual(format_freqs(counts), '')
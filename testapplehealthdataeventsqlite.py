@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+"""
+testapplehealthdataeventsqlite.py: tests for applehealthdataeventsqlite.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import sqlite3
+import unittest
+
+from datetime import datetime
+
+from applehealthdataeventsqlite import (HealthDataExtractorEV, LookupDimension,
+                                        ROLLUP_PERIODS, sql_value)
+from testapplehealthdata import (copy_test_data, get_tmp_dir,
+                                 remove_any_tmp_dir, CLEAN_UP)
+
+NEW_TYPE_RECORD = (
+    ' <Record type="HKQuantityTypeIdentifierOxygenSaturation"'
+    ' sourceName="Watch" unit="%" creationDate="2019-01-01 10:00:05 +0000"'
+    ' startDate="2019-01-01 10:00:00 +0000"'
+    ' endDate="2019-01-01 10:00:00 +0000" value="0.97"'
+    ' sampleQuality="good"/>\n'
+)
+
+HEART_RATE_WITH_METADATA = (
+    ' <Record type="HKQuantityTypeIdentifierHeartRate" sourceName="Watch"'
+    ' unit="count/min" creationDate="2019-01-01 10:00:05 +0000"'
+    ' startDate="2019-01-01 10:00:00 +0000"'
+    ' endDate="2019-01-01 10:00:00 +0000" value="%d">\n'
+    '  <MetadataEntry key="HKMetadataKeyHeartRateMotionContext" value="1"/>\n'
+    '  <MetadataEntry key="HKMetadataKeySyncIdentifier" value="sync%d"/>\n'
+    ' </Record>\n'
+)
+
+BLOOD_PRESSURE = (
+    '  <Record type="HKQuantityTypeIdentifierBloodPressure%s"'
+    ' sourceName="Cuff" unit="mmHg" creationDate="2019-01-0%d 08:00:05 +0000"'
+    ' startDate="2019-01-0%d 08:00:00 +0000"'
+    ' endDate="2019-01-0%d 08:00:00 +0000" value="%d"/>\n'
+)
+
+def blood_pressure(day, systolic, diastolic):
+    """
+    A Correlation for a blood pressure reading, and its two members as
+    they appear at the top level of an export.
+    """
+    members = [BLOOD_PRESSURE % ('Systolic', day, day, day, systolic),
+               BLOOD_PRESSURE % ('Diastolic', day, day, day, diastolic)]
+    correlation = (
+        ' <Correlation type="HKCorrelationTypeIdentifierBloodPressure"'
+        ' sourceName="Cuff" creationDate="2019-01-0%d 08:00:05 +0000"'
+        ' startDate="2019-01-0%d 08:00:00 +0000"'
+        ' endDate="2019-01-0%d 08:00:00 +0000">\n%s </Correlation>\n'
+        % (day, day, day, ''.join(members)))
+    return (correlation, [member[1:] for member in members])
+
+WORKOUT_WITH_ROUTE = (
+    ' <Workout workoutActivityType="HKWorkoutActivityTypeRunning"'
+    ' duration="20" durationUnit="min" sourceName="Watch"'
+    ' creationDate="2019-01-05 10:21:00 +0000"'
+    ' startDate="2019-01-05 10:00:00 +0000"'
+    ' endDate="2019-01-05 10:20:00 +0000">\n'
+    '  <MetadataEntry key="HKIndoorWorkout" value="0"/>\n'
+    '  <WorkoutEvent type="HKWorkoutEventTypePause"'
+    ' date="2019-01-05 10:05:00 +0000"/>\n'
+    '  <WorkoutEvent type="HKWorkoutEventTypeResume"'
+    ' date="2019-01-05 10:06:00 +0000"/>\n'
+    '  <WorkoutRoute sourceName="Watch"'
+    ' creationDate="2019-01-05 10:21:00 +0000"'
+    ' startDate="2019-01-05 10:00:00 +0000"'
+    ' endDate="2019-01-05 10:20:00 +0000">\n'
+    '   <FileReference path="/workout-routes/%s"/>\n'
+    '  </WorkoutRoute>\n'
+    ' </Workout>\n'
+)
+
+ROUTE_GPX = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx version="1.1" creator="Apple Health Export"'
+    ' xmlns="http://www.topografix.com/GPX/1/1">\n'
+    ' <trk><name>Route</name><trkseg>\n'
+    '%s'
+    ' </trkseg></trk>\n'
+    '</gpx>\n'
+)
+ROUTE_POINT = (
+    '  <trkpt lon="-0.1%d" lat="51.5%d"><ele>1%d.5</ele>'
+    '<time>2019-01-05T10:0%d:00Z</time>'
+    '<extensions><speed>2.5</speed><course>90</course>'
+    '<hAcc>3</hAcc><vAcc>2</vAcc></extensions></trkpt>\n'
+)
+
+VERBOSE = False
+
+
+def add_records(path, records):
+    """
+    Insert extra top-level elements just before the end of the export.
+    """
+    with open(path) as f:
+        xml = f.read()
+    xml = xml.replace('</HealthData>', ''.join(records) + '</HealthData>')
+    with open(path, 'w') as f:
+        f.write(xml)
+
+
+def extract_sample(records=(), **kwargs):
+    """
+    Load a fresh copy of the sample export, with any extra records
+    added, into SQLite, returning a connection to the resulting database.
+    The records span years, so DateDimension is only written if asked for.
+    """
+    path = copy_test_data()
+    add_records(path, records)
+    kwargs.setdefault('date_dimension', False)
+    HealthDataExtractorEV(path, verbose=VERBOSE, **kwargs)
+    return sqlite3.connect(os.path.join(get_tmp_dir(), 'export.sqlite'))
+
+
+def extract_with_routes(**kwargs):
+    """
+    Load the sample export with blood pressure Correlations and two
+    workouts with routes, one of whose GPX files is missing.
+
+    The first Correlation's systolic record comes before it at the top
+    level, and its diastolic record after it; the second Correlation's
+    members are only inside it.
+    """
+    (first, first_members) = blood_pressure(1, 120, 80)
+    (second, second_members) = blood_pressure(2, 130, 85)
+    records = ([first_members[0], first, first_members[1], second,
+                WORKOUT_WITH_ROUTE % 'route_1.gpx',
+                WORKOUT_WITH_ROUTE.replace('2019-01-05', '2019-01-06')
+                % 'missing.gpx'])
+    path = copy_test_data()
+    add_records(path, records)
+    routes = os.path.join(get_tmp_dir(), 'workout-routes')
+    os.makedirs(routes)
+    with open(os.path.join(routes, 'route_1.gpx'), 'w') as f:
+        f.write(ROUTE_GPX % ''.join(ROUTE_POINT % (i, i, i, i)
+                                    for i in range(3)))
+    kwargs.setdefault('date_dimension', False)
+    HealthDataExtractorEV(path, verbose=VERBOSE, **kwargs)
+    return sqlite3.connect(os.path.join(get_tmp_dir(), 'export.sqlite'))
+
+
+class TestAppleHealthDataExtractorSQLite(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def test_sql_values(self):
+        self.assertEqual(sql_value(None, 's'), None)
+        self.assertEqual(sql_value("one '2' three", 's'), "one '2' three")
+        self.assertEqual(sql_value('', 'n'), '0')
+        self.assertEqual(sql_value('2.5', 'n'), '2.5')
+        self.assertEqual(sql_value('HKCategoryValueAppleStandHourStood', 'n'),
+                         '1')
+        self.assertRaises(KeyError, sql_value, 'a', 'z')
+
+    def test_lookup_dimension_ids_are_stable(self):
+        conn = sqlite3.connect(':memory:')
+        c = conn.cursor()
+        units = LookupDimension('unit')
+        self.assertEqual([units.intern(v) for v in ('km', 'kcal', 'km')],
+                         [0, 1, 0])
+        units.write(c)
+        self.assertEqual(units.new, [])
+
+        reloaded = LookupDimension('unit')
+        reloaded.load(c)
+        self.assertEqual([reloaded.intern(v) for v in ('kcal', 'min', 'km')],
+                         [1, 2, 0])
+        reloaded.write(c)
+        self.assertEqual(c.execute('SELECT value, name FROM zunit '
+                                   'ORDER BY name').fetchall(),
+                         [('1', 'kcal'), ('0', 'km'), ('2', 'min')])
+
+    def test_unknown_record_type(self):
+        conn = extract_sample([NEW_TYPE_RECORD])
+        columns = [row[1] for row in
+                   conn.execute('PRAGMA table_info(OxygenSaturation)')]
+        self.assertEqual(columns[-2:], ['value', 'sampleQuality'])
+        self.assertEqual(conn.execute('SELECT value, sampleQuality '
+                                      'FROM OxygenSaturation').fetchall(),
+                         [(0.97, 'good')])
+        conn.close()
+
+    def test_incremental_reload(self):
+        conn = extract_sample()
+        conn.close()
+        path = os.path.join(get_tmp_dir(), 'export6s3sample.xml')
+        HealthDataExtractorEV(path, verbose=VERBOSE, incremental=True)
+        newer_steps = (
+            ' <Record type="HKQuantityTypeIdentifierStepCount"'
+            ' sourceName="Health" unit="count"'
+            ' creationDate="2014-09-21 07:08:48 +0100"'
+            ' startDate="2014-09-13 11:40:00 +0100"'
+            ' endDate="2014-09-13 11:40:05 +0100" value="7"/>\n'
+            ' <Record type="HKQuantityTypeIdentifierStepCount"'
+            ' sourceName="Health" unit="count"'
+            ' creationDate="2014-09-22 07:08:48 +0100"'
+            ' startDate="2014-09-21 11:40:00 +0100"'
+            ' endDate="2014-09-21 11:40:05 +0100" value="8"/>\n'
+        )
+        add_records(path, [newer_steps, NEW_TYPE_RECORD])
+        data = HealthDataExtractorEV(path, verbose=VERBOSE, incremental=True)
+        self.assertEqual((data.n_records, data.n_skipped), (3, 18))
+
+        conn = sqlite3.connect(os.path.join(get_tmp_dir(), 'export.sqlite'))
+        self.assertEqual(conn.execute('SELECT COUNT(*), SUM(value) '
+                                      'FROM StepCount').fetchone(),
+                         (12, 2532))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM Workout')
+                         .fetchone(), (1,))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM OxygenSaturation')
+                         .fetchone(), (1,))
+        self.assertEqual(conn.execute('SELECT SUM(n), SUM(total) '
+                                      'FROM RollupDay '
+                                      'WHERE kind = \'StepCount\'')
+                         .fetchone(), (12, 2532))
+        self.assertEqual(conn.execute('SELECT n, total, minimum, maximum '
+                                      'FROM RollupHour '
+                                      'WHERE kind = \'StepCount\' '
+                                      'AND bucket = strftime(\'%s\', '
+                                      '\'2014-09-21 11:00:00\')')
+                         .fetchall(), [(1, 8, 8, 8)])
+        conn.close()
+
+    def test_rollups_match_samples(self):
+        conn = extract_sample()
+        for (table, seconds) in ROLLUP_PERIODS.items():
+            for kind in ('StepCount', 'DistanceWalkingRunning'):
+                expected = conn.execute(
+                    'SELECT bucket, COUNT(*), SUM(value), MIN(value), '
+                    'MAX(value), AVG(value) FROM (SELECT value, '
+                    'startDateUtc + startDateOffset - (startDateUtc '
+                    '+ startDateOffset) % ? AS bucket FROM {}) '
+                    'GROUP BY bucket ORDER BY bucket'.format(kind),
+                    (seconds,)).fetchall()
+                actual = conn.execute(
+                    'SELECT bucket, n, total, minimum, maximum, mean '
+                    'FROM {} WHERE kind = ? ORDER BY bucket'.format(table),
+                    (kind,)).fetchall()
+                self.assertEqual((table, kind, actual),
+                                 (table, kind, expected))
+        workouts = conn.execute('SELECT field, context, n FROM RollupDay '
+                                'WHERE kind = \'Workout\' '
+                                'ORDER BY field').fetchall()
+        self.assertEqual(workouts,
+                         [('duration', 'HKWorkoutActivityTypeOther', 1),
+                          ('totalDistance', 'HKWorkoutActivityTypeOther', 1),
+                          ('totalEnergyBurned',
+                           'HKWorkoutActivityTypeOther', 1)])
+        conn.close()
+
+    def test_date_keys_and_dimension(self):
+        conn = extract_sample(date_dimension=True)
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*) FROM StepCount s JOIN DateDimension d '
+            'ON d.DateKey = s.startDateKey '
+            'WHERE s.startDateKey = (s.startDateUtc + s.startDateOffset) / 300 '
+            'AND datetime(s.startDateUtc + s.startDateOffset, \'unixepoch\') '
+            'BETWEEN d.CalendarDateInterval AND d.CalendarDateIntervalEnd'
+        ).fetchone(), (10,))
+        self.assertEqual(conn.execute(
+            'SELECT a.dateComponents, d.CalendarDate, d.DayOfWeek '
+            'FROM ActivitySummary a JOIN DateDimension d '
+            'ON d.DateKey = a.dateComponentsKey').fetchall(),
+            [('2016-04-14', '2016-04-14 00:00:00', 'Thursday'),
+             ('2016-04-15', '2016-04-15 00:00:00', 'Friday')])
+        plan = ' '.join(row[-1] for row in conn.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM StepCount s '
+            'JOIN DateDimension d ON d.DateKey = s.startDateKey'))
+        self.assertIn('INTEGER PRIMARY KEY', plan)
+        # the data is on days 16326, 16333, 16893, 16905 and 16906; the
+        # days between are filled in, but not the gap of over a year
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*), MIN(DateKey) % 288, MAX(DateKey) % 288 '
+            'FROM DateDimension').fetchone(), (22 * 288, 0, 287))
+        self.assertEqual([day for (day,) in conn.execute(
+            'SELECT DayKey / 288 FROM DateDimension WHERE DateKey = DayKey')],
+            list(range(16326, 16334)) + list(range(16893, 16907)))
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*), COUNT(s.value) FROM DateDimension d '
+            'LEFT JOIN StepCount s ON s.startDateKey = d.DateKey '
+            'WHERE d.CalendarDate = \'2014-09-14 00:00:00\'').fetchone(),
+            (288, 0))
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*) FROM DateDimension WHERE '
+            'DayNumber != strftime(\'%w\', CalendarDateInterval) '
+            'OR HourNumber != strftime(\'%H\', CalendarDateInterval) '
+            'OR MinuteNumber != strftime(\'%M\', CalendarDateInterval) '
+            'OR DayOfMonth != strftime(\'%d\', CalendarDateInterval) '
+            'OR YearWeek != strftime(\'%Y-%W\', CalendarDateInterval) '
+            'OR CalendarDateIntervalEnd != datetime(CalendarDateInterval, '
+            '\'+299 second\') '
+            'OR CalendarDateInterval != datetime(DateKey * 300, '
+            '\'unixepoch\') '
+            'OR CalendarDateHour != datetime(HourKey * 300, \'unixepoch\') '
+            'OR CalendarDate != datetime(DayKey * 300, \'unixepoch\')'
+        ).fetchone(), (0,))
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*), SUM(d.DateKey = d.HourKey) FROM RollupHour r '
+            'JOIN DateDimension d ON d.DateKey = r.bucket / 300').fetchone(),
+            conn.execute('SELECT COUNT(*), COUNT(*) FROM RollupHour')
+            .fetchone())
+        conn.close()
+
+        # a stray day before 1970 adds one day of rows, and an
+        # incremental load extends the dimension and fills in the keys
+        # of a table from before there were any
+        record = NEW_TYPE_RECORD.replace('OxygenSaturation', 'StepCount')
+        for dates in ('epoch', 'text'):
+            conn = extract_sample([record.replace('2019-01-01 10:00',
+                                                  '1969-12-31 23:02:30')],
+                                  date_dimension=True, dates=dates)
+            conn.execute('ALTER TABLE StepCount DROP COLUMN startDateKey')
+            conn.commit()
+            conn.close()
+            path = os.path.join(get_tmp_dir(), 'export6s3sample.xml')
+            add_records(path, [record])
+            HealthDataExtractorEV(path, verbose=VERBOSE, incremental=True)
+            conn = sqlite3.connect(os.path.join(get_tmp_dir(),
+                                                'export.sqlite'))
+            self.assertEqual(conn.execute(
+                'SELECT COUNT(*), COUNT(startDateKey) FROM StepCount '
+                'JOIN DateDimension ON DateKey = startDateKey').fetchone(),
+                (12, 12))
+            self.assertEqual([day for (day,) in conn.execute(
+                'SELECT DayKey / 288 FROM DateDimension '
+                'WHERE DateKey = DayKey')],
+                [-1] + list(range(16326, 16334))
+                + list(range(16893, 16907)) + [17897])
+            self.assertEqual(conn.execute(
+                'SELECT COUNT(*), CalendarDate FROM DateDimension '
+                'WHERE DateKey < 0').fetchone(),
+                (288, '1969-12-31 00:00:00'))
+            self.assertEqual(conn.execute(
+                'SELECT startDateKey FROM StepCount '
+                'WHERE startDateKey < 0').fetchall(), [(-12,)])
+            conn.close()
+
+    def test_parallel_load_matches_serial(self):
+        conn = extract_sample([NEW_TYPE_RECORD])
+        serial = list(conn.iterdump())
+        conn.close()
+        conn = extract_sample([NEW_TYPE_RECORD], jobs=3)
+        self.assertEqual(list(conn.iterdump()), serial)
+        conn.close()
+
+    def test_pipelined_load_matches_serial(self):
+        conn = extract_sample([NEW_TYPE_RECORD], batch_size=3)
+        serial = list(conn.iterdump())
+        conn.close()
+        conn = extract_sample([NEW_TYPE_RECORD], batch_size=3, pipeline=True)
+        self.assertEqual(list(conn.iterdump()), serial)
+        conn.close()
+
+    def test_scan_load_matches_iterparse(self):
+        conn = extract_sample([NEW_TYPE_RECORD])
+        expected = list(conn.iterdump())
+        conn.close()
+        for jobs in (1, 3):
+            conn = extract_sample([NEW_TYPE_RECORD], jobs=jobs, parser='scan')
+            self.assertEqual(list(conn.iterdump()), expected)
+            conn.close()
+
+    def test_indexes_and_vacuum(self):
+        conn = extract_sample()
+        expected = list(conn.iterdump())
+        indexes = set(row[0] for row in conn.execute(
+            'SELECT name FROM sqlite_master WHERE type = \'index\''))
+        self.assertTrue(set(['ix_StepCount_startDateUtc',
+                             'ix_StepCount_sourceName',
+                             'ix_Workout_workoutActivityType',
+                             'ix_ActivitySummary_dateComponents',
+                             'ix_zsourceName_value']) <= indexes)
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT SUM(value) '
+                            'FROM StepCount WHERE startDateUtc > 0')
+        self.assertIn('ix_StepCount_startDateUtc',
+                      ' '.join(str(row) for row in plan))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM sqlite_stat1')
+                         .fetchone()[0] > 0, True)
+        conn.close()
+
+        conn = extract_sample(vacuum=True, page_size=4096)
+        self.assertEqual(conn.execute('PRAGMA page_size').fetchone(), (4096,))
+        self.assertEqual(list(conn.iterdump()), expected)
+        conn.close()
+        self.assertFalse(os.path.exists(os.path.join(
+            get_tmp_dir(), 'export.sqlite.vacuum')))
+
+    def test_metrics_and_profile(self):
+        expected = list(extract_sample().iterdump())
+        events = []
+        profile = os.path.join(get_tmp_dir(), 'profile.txt')
+        conn = extract_sample(metrics=events.append, profile=profile)
+        self.assertEqual(list(conn.iterdump()), expected)
+        conn.close()
+        self.assertEqual([e['event'] for e in events], ['start', 'summary'])
+        summary = events[-1]
+        self.assertEqual(dict(summary['counts']),
+                         {'ActivitySummary': 2, 'DistanceWalkingRunning': 5,
+                          'StepCount': 10, 'Workout': 1})
+        self.assertEqual(summary['records'], 18)
+        self.assertEqual(summary['bytes'], events[0]['total_bytes'])
+        self.assertEqual(summary['fraction'], 1.0)
+        self.assertEqual(list(summary['stages']),
+                         ['parse', 'metadata', 'abbreviate', 'format',
+                          'lookup', 'write', 'rollup', 'index'])
+        self.assertTrue(os.path.exists(profile))
+
+        path = os.path.join(get_tmp_dir(), 'metrics.jsonl')
+        extract_sample(metrics=path).close()
+        with open(path) as f:
+            self.assertEqual(json.loads(f.readlines()[-1])['records'], 18)
+
+    def test_metadata_side_table(self):
+        records = [HEART_RATE_WITH_METADATA % (60 + i, i) for i in range(3)]
+        tables = ('StepCount', 'DistanceWalkingRunning', 'HeartRate',
+                  'Workout', 'ActivitySummary')
+        conn = extract_sample(records)
+        expected = [conn.execute('SELECT * FROM %s' % table).fetchall()
+                    for table in tables]
+        conn.close()
+        conn = extract_sample(records, metadata=True)
+        self.assertEqual([conn.execute('SELECT * FROM %s' % table).fetchall()
+                          for table in tables], expected)
+        rows = conn.execute(
+            'SELECT h.value, k.name, m.value FROM Metadata m '
+            'JOIN ztype t ON m.type = t.value '
+            'JOIN zmetadataKey k ON m.metadataKey = k.value '
+            'JOIN HeartRate h ON t.name = \'HeartRate\' '
+            'AND m.record = h.rowid ORDER BY m.rowid').fetchall()
+        self.assertEqual(rows, [(60 + i, key, value) for i in range(3)
+                                for (key, value) in
+                                (('HKMetadataKeyHeartRateMotionContext', '1'),
+                                 ('HKMetadataKeySyncIdentifier',
+                                  'sync%d' % i))])
+        self.assertEqual(conn.execute('SELECT motionContext FROM HeartRate')
+                         .fetchall(), [('1',)] * 3)
+        conn.close()
+
+        path = os.path.join(get_tmp_dir(), 'export6s3sample.xml')
+        add_records(path, [HEART_RATE_WITH_METADATA.replace('10:00:0', '11:00:0')
+                           % (90, 9)])
+        HealthDataExtractorEV(path, verbose=VERBOSE, incremental=True,
+                              metadata=True)
+        conn = sqlite3.connect(os.path.join(get_tmp_dir(), 'export.sqlite'))
+        self.assertEqual(conn.execute(
+            'SELECT m.value FROM Metadata m JOIN HeartRate h '
+            'ON m.record = h.rowid WHERE h.value = 90').fetchall(),
+            [('1',), ('sync9',)])
+        conn.close()
+
+    def test_correlations_and_workout_children(self):
+        conn = extract_with_routes(route_jobs=2)
+        self.assertEqual(conn.execute(
+            'SELECT t.name, COUNT(*) FROM Correlation c '
+            'JOIN CorrelationRecord l ON l.correlation = c.rowid '
+            'JOIN ztype t ON c.type = t.value '
+            'GROUP BY c.rowid ORDER BY c.rowid').fetchall(),
+            [('BloodPressure', 2), ('BloodPressure', 2)])
+        for (kind, values) in (('BloodPressureSystolic', [120, 130]),
+                               ('BloodPressureDiastolic', [80, 85])):
+            self.assertEqual(conn.execute(
+                'SELECT value FROM %s ORDER BY value' % kind).fetchall(),
+                [(value,) for value in values])
+            self.assertEqual(conn.execute(
+                'SELECT c.startDateUtc, r.startDateUtc FROM Correlation c '
+                'JOIN CorrelationRecord l ON l.correlation = c.rowid '
+                'JOIN ztype t ON l.type = t.value AND t.name = ? '
+                'JOIN %s r ON l.record = r.rowid ORDER BY r.value' % kind,
+                (kind,)).fetchall(),
+                [(1546329600, 1546329600), (1546416000, 1546416000)])
+
+        self.assertEqual(conn.execute(
+            'SELECT t.name, e.dateUtc FROM WorkoutEvent e '
+            'JOIN Workout w ON e.workout = w.rowid '
+            'JOIN ztype t ON e.type = t.value '
+            'WHERE w.startDateUtc = 1546682400 ORDER BY e.dateUtc').fetchall(),
+            [('HKWorkoutEventTypePause', 1546682700),
+             ('HKWorkoutEventTypeResume', 1546682760)])
+        self.assertEqual(conn.execute(
+            'SELECT r.path, COUNT(p.timeUtc) FROM WorkoutRoute r '
+            'LEFT JOIN RoutePoint p ON p.workout = r.workout '
+            'GROUP BY r.path ORDER BY r.path').fetchall(),
+            [('/workout-routes/missing.gpx', 0),
+             ('/workout-routes/route_1.gpx', 3)])
+        self.assertEqual(conn.execute(
+            'SELECT timeUtc, latitude, longitude, elevation, speed, '
+            'horizontalAccuracy FROM RoutePoint ORDER BY timeUtc')
+            .fetchall()[-1], (1546682520, 51.52, -0.12, 12.5, 2.5, 3.0))
+        expected = list(conn.iterdump())
+        conn.close()
+
+        for kwargs in ({'jobs': 3}, {'parser': 'scan'},
+                       {'pipeline': True, 'route_jobs': 1}):
+            conn = extract_with_routes(**kwargs)
+            self.assertEqual(list(conn.iterdump()), expected)
+            conn.close()
+
+    def test_tiny_reference_load(self):
+        conn = extract_sample(batch_size=3)
+        counts = dict((kind, conn.execute('SELECT COUNT(*) FROM %s'
+                                          % kind).fetchone()[0])
+                      for kind in ('StepCount', 'DistanceWalkingRunning',
+                                   'Workout', 'ActivitySummary'))
+        self.assertEqual(counts, {
+            'StepCount': 10,
+            'DistanceWalkingRunning': 5,
+            'Workout': 1,
+            'ActivitySummary': 2,
+        })
+        steps = conn.execute('SELECT SUM(value) FROM StepCount').fetchone()
+        self.assertEqual(steps[0], 2517)
+        workout = conn.execute('SELECT s.name, w.startDateUtc, '
+                               'w.startDateOffset, w.duration '
+                               'FROM Workout w JOIN zsourceName s '
+                               'ON w.sourceName = s.value').fetchall()
+        self.assertEqual(workout, [('NJR Apple\xa0Watch', 1459590038, 3600,
+                                    31.73680251737436)])
+        conn.close()
+
+    def test_date_formats(self):
+        columns = {}
+        for dates in ('epoch', 'text', 'both'):
+            conn = extract_sample(dates=dates)
+            columns[dates] = [row[1] for row in
+                              conn.execute('PRAGMA table_info(StepCount)')
+                              if 'Date' in row[1]]
+            if dates == 'both':
+                rows = conn.execute('SELECT startDate, startDateUtc, '
+                                    'startDateOffset, endDateUtc '
+                                    'FROM StepCount').fetchall()
+            conn.close()
+        self.assertEqual(columns['text'],
+                         ['creationDate', 'startDate', 'startDateKey',
+                          'endDate'])
+        self.assertEqual(columns['epoch'],
+                         ['creationDateUtc', 'creationDateOffset',
+                          'startDateUtc', 'startDateOffset', 'startDateKey',
+                          'endDateUtc', 'endDateOffset'])
+        self.assertEqual(len(columns['both']), 10)
+        self.assertEqual(len(rows), 10)
+        for (text, utc, offset, end) in rows:
+            self.assertEqual(datetime.utcfromtimestamp(utc + offset)
+                             .strftime('%Y-%m-%d %H:%M:%S'), text[:19])
+            self.assertEqual(offset, 3600)
+            self.assertTrue(end >= utc)
+
+
+if __name__ == '__main__':
+    unittest.main()
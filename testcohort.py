@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+testcohort.py: tests for cohort.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sqlite3
+import unittest
+
+from applehealthdataeventsqlite import HealthDataExtractorEV
+from cohort import Cohort, person_name
+from healthstore import HealthStore
+from testapplehealthdata import (copy_test_data, get_tmp_dir,
+                                 remove_any_tmp_dir, CLEAN_UP)
+from testapplehealthdataeventsqlite import (add_records, blood_pressure,
+                                            HEART_RATE_WITH_METADATA)
+
+VERBOSE = False
+
+
+def cohort_exports():
+    """
+    Copies of the sample export for alice, and for bob with heart rate
+    metadata and a blood pressure Correlation added (so that bob's
+    exports have names alice's don't), returning their paths.
+    """
+    sample = copy_test_data()
+    paths = []
+    for person in ('alice', 'bob'):
+        directory = os.path.join(get_tmp_dir(), person, 'apple_health_export')
+        os.makedirs(directory)
+        paths.append(os.path.join(directory, 'export.xml'))
+        shutil.copyfile(sample, paths[-1])
+    (correlation, members) = blood_pressure(1, 120, 80)
+    add_records(paths[1], [HEART_RATE_WITH_METADATA % (60 + i, i)
+                           for i in range(2)] + members + [correlation])
+    return paths
+
+
+class TestCohort(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def test_extractors_keep_their_own_lookups(self):
+        paths = cohort_exports()
+        for path in paths:
+            HealthDataExtractorEV(path, verbose=VERBOSE)
+        names = []
+        for path in paths:
+            conn = sqlite3.connect(os.path.join(os.path.dirname(path),
+                                                'export.sqlite'))
+            names.append(sorted(name for (name,) in conn.execute(
+                'SELECT name FROM zsourceName')))
+            conn.close()
+        self.assertEqual(names, [['Health', 'NJR Apple\xa0Watch'],
+                                 ['Cuff', 'Health', 'NJR Apple\xa0Watch',
+                                  'Watch']])
+
+    def test_cohort_load(self):
+        paths = cohort_exports()
+        self.assertEqual([person_name(path) for path in paths],
+                         ['alice', 'bob'])
+        db_path = os.path.join(get_tmp_dir(), 'cohort.sqlite')
+        cohort = Cohort(db_path, verbose=VERBOSE)
+        loaded = cohort.load([paths[0], ('robert', paths[1])], jobs=2,
+                             metadata=True)
+        self.assertEqual(sorted(loaded.values()), [18, 23])
+        cohort.close()
+
+        HealthDataExtractorEV(paths[1], verbose=VERBOSE, metadata=True)
+        single = HealthStore(os.path.join(os.path.dirname(paths[1]),
+                                          'export.sqlite'))
+        store = HealthStore(db_path)
+        exports = store.exports()
+        self.assertEqual([person for (export, person, path) in exports],
+                         ['alice', 'robert'])
+        bob = exports[1][0]
+        for kind in single.kinds():
+            columns = [column for column in single.columns(kind)
+                       if column != 'rowid']
+            self.assertEqual(list(store.query(kind, columns=columns,
+                                              export=bob)),
+                             list(single.query(kind, columns=columns)),
+                             kind)
+        self.assertEqual(len(list(store.query('StepCount'))), 20)
+        rows = list(store.query('HeartRate', columns=['rowid', 'value']))
+        metadata = store.metadata('HeartRate', [rowid for (rowid, value)
+                                                in rows])
+        self.assertEqual(metadata[rows[1][0]][1],
+                         ('HKMetadataKeySyncIdentifier', 'sync1'))
+        self.assertEqual(store.conn.execute(
+            'SELECT s.value, d.value FROM CorrelationRecord a '
+            'JOIN CorrelationRecord b ON a.correlation = b.correlation '
+            'AND a.rowid < b.rowid '
+            'JOIN BloodPressureSystolic s ON s.rowid = a.record '
+            'JOIN BloodPressureDiastolic d ON d.rowid = b.record').fetchall(),
+            [(120, 80)])
+        self.assertEqual(store.conn.execute(
+            'SELECT COUNT(*) FROM zsourceName').fetchone(), (4,))
+        store.close()
+        single.close()
+
+        cohort = Cohort(db_path, verbose=VERBOSE)
+        cohort.load([('bob', paths[1])], jobs=1, metadata=True)
+        cohort.close()
+        store = HealthStore(db_path)
+        self.assertEqual(len(list(store.query('StepCount'))), 20)
+        self.assertEqual(len(list(store.query('HeartRate'))), 2)
+        self.assertEqual([person for (export, person, path)
+                          in store.exports()], ['alice', 'bob'])
+        self.assertIn('ix_StepCount_export_startDateUtc', [
+            name for (name,) in store.conn.execute(
+                'SELECT name FROM sqlite_master WHERE type = \'index\'')])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+testcolumnstore.py: tests for columnstore.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import math
+import os
+import unittest
+
+from collections import OrderedDict
+
+from applehealthdata import HealthDataExtractor
+from columnstore import (ColumnStore, ColumnStoreWriter,
+                         MISSING_CODE, MISSING_DATE)
+from testapplehealthdata import (copy_test_data, get_tmp_dir, make_tmp_dir,
+                                 remove_any_tmp_dir, CLEAN_UP, VERBOSE)
+from testapplehealthdataeventsqlite import add_records
+
+DEVICE_STEPS = (
+    ' <Record type="HKQuantityTypeIdentifierStepCount" sourceName="Watch"'
+    ' device="&lt;&lt;HKDevice: 0x%x&gt;, name:Apple Watch,'
+    ' model:%s&gt;" unit="count" creationDate="2019-01-01 10:00:05 +0000"'
+    ' startDate="2019-01-01 10:%02d:00 +0000"'
+    ' endDate="2019-01-01 10:%02d:30 +0000" value="10"/>\n'
+)
+
+
+class TestColumnStore(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def test_tiny_reference_extraction(self):
+        path = copy_test_data()
+        data = HealthDataExtractor(path, verbose=VERBOSE)
+        data.extract('columns')
+        store = ColumnStore(os.path.join(get_tmp_dir(), 'columns'))
+        self.assertEqual(store.kinds(), ['ActivitySummary',
+                                         'DistanceWalkingRunning',
+                                         'StepCount', 'Workout'])
+        steps = store.table('StepCount')
+        self.assertEqual(len(steps), 10)
+        self.assertEqual(sum(steps.column('value')), 2517)
+        self.assertEqual(set(steps.strings('type')), set(['StepCount']))
+        self.assertEqual(steps.strings('device'), [None] * 10)
+        self.assertEqual(set(steps.column('startDateOffset')), set([3600]))
+        summary = store.table('ActivitySummary')
+        self.assertEqual(summary.column('dateComponents')[0], 1460592000)
+
+    def test_memory_store_matches_files(self):
+        path = copy_test_data()
+        data = HealthDataExtractor(path, verbose=VERBOSE)
+        data.extract('columns')
+        store = ColumnStore(os.path.join(get_tmp_dir(), 'columns'))
+        dataset = HealthDataExtractor(path, verbose=VERBOSE).extract('memory')
+        self.assertEqual(dataset.kinds(), store.kinds())
+        for kind in store.kinds():
+            (expected, actual) = (store.table(kind), dataset.table(kind))
+            self.assertEqual(len(actual), len(expected))
+            self.assertEqual(actual.names(), expected.names())
+            for name in expected.names():
+                if name == 'value':
+                    continue  # NaN != NaN; checked by the sum below
+                self.assertEqual((kind, name, list(actual.column(name))),
+                                 (kind, name, list(expected.column(name))))
+                if 'dictionary' in expected.descriptions[name]:
+                    self.assertEqual(actual.strings(name),
+                                     expected.strings(name))
+        self.assertEqual(sum(dataset.table('StepCount').column('value')),
+                         2517)
+
+    def test_column_types(self):
+        directory = make_tmp_dir()
+        fields = OrderedDict((('name', 's'), ('when', 'd'), ('value', 'n')))
+        writer = ColumnStoreWriter(directory)
+        for attributes in ({'name': 'a', 'when': '2016-04-01 12:34:56 +0100',
+                            'value': '1.5'},
+                           {'name': 'b', 'value': ''},
+                           {'when': '2016-04-01 12:34:56 -0500',
+                            'value': 'HKCategoryValueSleepAnalysisInBed'},
+                           {'name': 'a', 'value': '2'}):
+            writer.write('Test', fields, attributes)
+        writer.close()
+        table = ColumnStore(directory).table('Test')
+        self.assertEqual(table.names(), ['name', 'when', 'whenOffset',
+                                         'value', 'valueText'])
+        self.assertEqual(list(table.column('name')), [0, 1, MISSING_CODE, 0])
+        self.assertEqual(table.strings('name'), ['a', 'b', None, 'a'])
+        self.assertEqual(list(table.column('when')),
+                         [1459510496, MISSING_DATE, 1459532096,
+                          MISSING_DATE])
+        self.assertEqual(list(table.column('whenOffset')),
+                         [3600, 0, -18000, 0])
+        values = list(table.column('value'))
+        self.assertEqual([v for v in values if not math.isnan(v)], [1.5, 2])
+        self.assertEqual(table.strings('valueText'),
+                         [None, None, 'HKCategoryValueSleepAnalysisInBed',
+                          None])
+
+    def test_text_column_keeps_step_with_missing_values(self):
+        directory = make_tmp_dir()
+        writer = ColumnStoreWriter(directory)
+        for value in ('1', 'HKCategoryValueSleepAnalysisInBed', None,
+                      'HKCategoryValueSleepAnalysisAsleep', '', '3'):
+            attributes = {} if value is None else {'value': value}
+            writer.write('Test', {'value': 'n'}, attributes)
+        writer.close()
+        table = ColumnStore(directory).table('Test')
+        self.assertEqual(len(table.column('valueText')), 6)
+        self.assertEqual(table.strings('valueText'),
+                         [None, 'HKCategoryValueSleepAnalysisInBed', None,
+                          'HKCategoryValueSleepAnalysisAsleep', None, None])
+        self.assertEqual([v for v in table.column('value')
+                          if not math.isnan(v)], [1, 3])
+
+
+    def test_device_pointers_are_dropped(self):
+        path = copy_test_data()
+        add_records(path, [DEVICE_STEPS % (0x280000000 + i,
+                                           'Watch' if i % 2 else 'Ultra',
+                                           i, i)
+                           for i in range(40)])
+        dataset = HealthDataExtractor(path, verbose=VERBOSE).extract('memory')
+        steps = dataset.table('StepCount')
+        self.assertEqual(sorted(steps.dictionary('device')),
+                         ['name:Apple Watch, model:Ultra',
+                          'name:Apple Watch, model:Watch'])
+        self.assertEqual(steps.strings('device')[-2:],
+                         ['name:Apple Watch, model:Ultra',
+                          'name:Apple Watch, model:Watch'])
+
+
+if __name__ == '__main__':
+    unittest.main()
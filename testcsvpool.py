@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+testcsvpool.py: tests for csvpool.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from applehealthdataevent import HealthDataExtractorEV
+from csvpool import CSVWriterPool
+from testapplehealthdata import (copy_test_data, get_testdata_dir,
+                                 get_tmp_dir, make_tmp_dir,
+                                 remove_any_tmp_dir, CLEAN_UP, VERBOSE)
+
+
+class TestCSVWriterPool(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def test_open_file_cap(self):
+        directory = make_tmp_dir()
+        paths = [os.path.join(directory, '%d.csv' % i) for i in range(5)]
+        with open(paths[0], 'w') as f:
+            f.write('left over from an earlier run\n')
+        pool = CSVWriterPool(max_open=2, chunk_size=20, max_buffered=50)
+        for (i, path) in enumerate(paths):
+            pool.add(i, path, 'n,square\n')
+        for n in range(200):
+            pool.write(n % 5, '%d,%d\n' % (n, n * n))
+            self.assertTrue(len(pool.handles) <= 2)
+        pool.close()
+        for (i, path) in enumerate(paths):
+            with open(path) as f:
+                self.assertEqual(f.read(),
+                                 'n,square\n' + ''.join('%d,%d\n' % (n, n * n)
+                                                        for n in range(i, 200,
+                                                                       5)))
+
+    def test_ev_extraction_matches_reference(self):
+        path = copy_test_data()
+        data = HealthDataExtractorEV(path, verbose=VERBOSE)
+        data.close_files()
+        for kind in ('StepCount', 'DistanceWalkingRunning',
+                     'Workout', 'ActivitySummary'):
+            with open(os.path.join(get_testdata_dir(), '%s.csv' % kind)) as f:
+                expected = f.read()
+            with open(os.path.join(get_tmp_dir(), '%s.csv' % kind)) as f:
+                self.assertEqual((kind, f.read()), (kind, expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
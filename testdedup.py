@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+testdedup.py: tests for dedup.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import sqlite3
+import unittest
+
+from dedup import covered_seconds, sweep, Deduplicator
+from testapplehealthdata import remove_any_tmp_dir, CLEAN_UP
+from testapplehealthdataeventsqlite import extract_sample
+
+STEPS = (
+    ' <Record type="HKQuantityTypeIdentifierStepCount" sourceName="%s"'
+    ' unit="count" creationDate="2019-01-01 11:00:00 +0000"'
+    ' startDate="2019-01-01 %s +0000" endDate="2019-01-01 %s +0000"'
+    ' value="%d"/>\n'
+)
+OVERLAPPING_STEPS = [
+    STEPS % ('NJR iPhone', '10:00:00', '10:10:00', 100),
+    STEPS % ('NJR Apple Watch', '10:05:00', '10:15:00', 60),
+    STEPS % ('NJR iPhone', '10:20:00', '10:30:00', 40),
+]
+ZONED_STEPS = (
+    ' <Record type="HKQuantityTypeIdentifierStepCount" sourceName="%s"'
+    ' unit="count" creationDate="2019-01-01 11:00:00 +0000"'
+    ' startDate="2019-01-01 %s %s" endDate="2019-01-01 %s %s"'
+    ' value="%d"/>\n'
+)
+# In local time the Watch sample sorts last, but in UTC it starts first
+# and covers half of the first iPhone sample.
+SHIFTED_STEPS = [
+    ZONED_STEPS % ('NJR iPhone', '10:05:00', '+0000', '10:15:00', '+0000',
+                   100),
+    ZONED_STEPS % ('NJR iPhone', '10:30:00', '+0000', '10:40:00', '+0000',
+                   40),
+    ZONED_STEPS % ('NJR Apple Watch', '11:00:00', '+0100', '11:10:00',
+                   '+0100', 60),
+]
+
+
+def brute_force(rows):
+    """
+    The fractions sweep should give, comparing every pair of rows.
+    """
+    fractions = []
+    for (start, end, rank) in rows:
+        if end > start:
+            covers = [(s, e) for (s, e, r) in rows
+                      if r < rank and s < end and e > start]
+            fractions.append(1 - covered_seconds(covers, start, end)
+                             / (end - start))
+        else:
+            fractions.append(0 if any(r < rank and s <= start < e
+                                      for (s, e, r) in rows) else 1)
+    return fractions
+
+
+class TestDedup(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def test_sweep_matches_brute_force(self):
+        rows = [(0, 10, 1), (5, 15, 0), (5, 5, 1), (12, 12, 2), (20, 30, 1)]
+        self.assertEqual([fraction for (row, fraction) in sweep(rows)],
+                         [0.5, 1, 0, 0, 1])
+        rng = random.Random(21)
+        for trial in range(200):
+            rows = []
+            for i in range(rng.randrange(30)):
+                start = rng.randrange(100)
+                rows.append((start, start + rng.choice((0, 1, 5, 20, 60)),
+                             rng.randrange(4)))
+            rows.sort()
+            swept = list(sweep(rows))
+            self.assertEqual([row for (row, fraction) in swept], rows)
+            for (actual, expected) in zip(
+                    [fraction for (row, fraction) in swept],
+                    brute_force(rows)):
+                self.assertAlmostEqual(actual, expected)
+
+    def test_canonical_tables(self):
+        conn = extract_sample(OVERLAPPING_STEPS, canonical=True)
+        raw = conn.execute('SELECT COUNT(*), SUM(value) FROM StepCount '
+                           'WHERE startDateUtc >= 1546300800').fetchone()
+        self.assertEqual(raw, (3, 200))
+        rows = conn.execute(
+            'SELECT s.name, c.value, c.fraction FROM StepCountCanonical c '
+            'JOIN zsourceName s ON c.sourceName = s.value '
+            'WHERE c.startDateUtc >= 1546300800 '
+            'ORDER BY c.startDateUtc').fetchall()
+        self.assertEqual(rows, [('NJR iPhone', 50, 0.5),
+                                ('NJR Apple Watch', 60, 1),
+                                ('NJR iPhone', 40, 1)])
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*), SUM(value) FROM StepCountCanonical '
+            'WHERE startDateUtc < 1546300800').fetchone(), (10, 2517))
+        self.assertIn('ix_StepCountCanonical_startDateUtc', [
+            name for (name,) in conn.execute(
+                'SELECT name FROM sqlite_master WHERE type = \'index\'')])
+        conn.close()
+
+        conn = extract_sample(OVERLAPPING_STEPS, canonical=True,
+                              priority=['iPhone', 'Watch'], dates='text')
+        self.assertEqual(conn.execute(
+            'SELECT value, fraction FROM StepCountCanonical '
+            'WHERE startDate >= \'2019\' ORDER BY startDate').fetchall(),
+            [(100, 1), (30, 0.5), (40, 1)])
+        conn.close()
+
+        for dates in ('epoch', 'text'):
+            conn = extract_sample(SHIFTED_STEPS, canonical=True, dates=dates)
+            self.assertEqual(conn.execute(
+                'SELECT s.name, c.value, c.fraction '
+                'FROM StepCountCanonical c '
+                'JOIN zsourceName s ON c.sourceName = s.value '
+                'WHERE c.startDate{} ORDER BY c.value'.format(
+                    'Utc >= 1546300800' if dates == 'epoch'
+                    else ' >= \'2019\'')).fetchall(),
+                [('NJR iPhone', 40, 1), ('NJR iPhone', 50, 0.5),
+                 ('NJR Apple Watch', 60, 1)], dates)
+            conn.close()
+
+    def test_ranks_order_source_ids_as_numbers(self):
+        dedup = Deduplicator(sqlite3.connect(':memory:'), priority=[])
+        self.assertLess(dedup.rank('9', None), dedup.rank('10', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+testhealthexport.py: tests for healthexport.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import unittest
+import zipfile
+
+from xml.etree import ElementTree
+
+import healthexport
+
+from healthexport import (abbreviate_device, build_index, export_index,
+                          filter_elements, index_path, iter_elements,
+                          iterparse_elements, iter_range, load_index,
+                          open_export_file, parallel_map, record_elements,
+                          route_points, select_elements, split_export,
+                          threaded, PARSERS, WriterThread)
+from testapplehealthdata import copy_test_data, remove_any_tmp_dir, CLEAN_UP
+
+CORRELATION = (
+    ' <Correlation type="HKCorrelationTypeIdentifierBloodPressure"'
+    ' sourceName="Cuff" creationDate="2016-04-03 08:00:00 +0100"'
+    ' startDate="2016-04-03 08:00:00 +0100"'
+    ' endDate="2016-04-03 08:00:00 +0100">\n'
+    '  <Record type="HKQuantityTypeIdentifierBloodPressureSystolic"'
+    ' sourceName="Cuff" unit="mmHg" startDate="2016-04-03 08:00:00 +0100"'
+    ' endDate="2016-04-03 08:00:00 +0100" value="120"/>\n'
+    '  <Record type="HKQuantityTypeIdentifierBloodPressureDiastolic"'
+    ' sourceName="Cuff" unit="mmHg" startDate="2016-04-03 08:00:00 +0100"'
+    ' endDate="2016-04-03 08:00:00 +0100" value="80"/>\n'
+    ' </Correlation>\n'
+)
+
+
+def sample_with_correlation():
+    """
+    Copy the sample export to the tmp directory, with a blood pressure
+    Correlation added after the step counts.
+    """
+    path = copy_test_data()
+    with open(path) as f:
+        xml = f.read()
+    marker = ' <Record type="HKQuantityTypeIdentifierDistanceWalkingRunning"'
+    xml = xml.replace(marker, CORRELATION + marker, 1)
+    with open(path, 'w') as f:
+        f.write(xml)
+    return path
+
+
+def summarize(elements):
+    return [(e.tag, sorted(e.attrib.items()), len(e)) for e in elements]
+
+
+class TestHealthExport(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def test_ranges_start_on_top_level_elements(self):
+        path = sample_with_correlation()
+        with open(path, 'rb') as f:
+            xml = f.read()
+        ranges = split_export(path, 100)
+        self.assertTrue(len(ranges) > 10)
+        for (start, end) in ranges[1:]:
+            self.assertTrue(xml[start:end].startswith((b'<Record',
+                                                       b'<Workout',
+                                                       b'<ActivitySummary',
+                                                       b'<Correlation')))
+            self.assertFalse(xml[start:end].startswith(
+                b'<Record type="HKQuantityTypeIdentifierBloodPressure'))
+
+    def test_ranges_parse_like_whole_file(self):
+        path = sample_with_correlation()
+        with open(path, 'rb') as f:
+            expected = summarize(iterparse_elements(f))
+        for n in (1, 3, 100):
+            actual = []
+            for (start, end) in split_export(path, n):
+                actual.extend(summarize(iter_range(path, start, end)))
+            self.assertEqual((n, actual), (n, expected))
+
+    def test_scan_parses_like_iterparse(self):
+        path = sample_with_correlation()
+        for nested in (True, False):
+            with open(path, 'rb') as f:
+                expected = summarize(iter_elements(f, 'iterparse', nested))
+            with open(path, 'rb') as f:
+                self.assertEqual(summarize(iter_elements(f, 'scan', nested)),
+                                 expected)
+        with open(path, 'rb') as f:
+            expected = summarize(iterparse_elements(f))
+        actual = []
+        for (start, end) in split_export(path, 3):
+            actual.extend(summarize(iter_range(path, start, end, 'scan')))
+        self.assertEqual(actual, expected)
+        with open(path, 'rb') as f:
+            expected = summarize(iter_elements(f, 'iterparse', False))
+        for parser in PARSERS:
+            actual = []
+            for (start, end) in split_export(path, 3):
+                actual.extend(summarize(iter_range(path, start, end, parser,
+                                                   nested=False)))
+            self.assertEqual((parser, actual), (parser, expected))
+
+    def test_record_elements_keep_their_own_empty_attributes(self):
+        records = ['<Record type="HKQuantityTypeIdentifierStepCount"'
+                   ' sourceName="Phone" unit="count"'
+                   ' startDate="2016-04-01 10:00:00 +0100"'
+                   ' endDate="2016-04-01 10:05:00 +0100" value=""/>',
+                   '<Record type="HKCategoryTypeIdentifierMindfulSession"'
+                   ' sourceName="" startDate="2016-04-01 11:00:00 +0100"'
+                   ' endDate="2016-04-01 11:10:00 +0100"/>']
+        run = '\n '.join(records)
+        self.assertEqual([element.attrib for element in record_elements(run)],
+                         [ElementTree.fromstring(record).attrib
+                          for record in records])
+
+    def test_abbreviate_device(self):
+        devices = ['<<HKDevice: 0x%x>, name:iPhone, model:iPhone>'
+                   % (0x280000000 + i) for i in range(1000)]
+        cached = len(healthexport._DEVICES)
+        self.assertEqual(set(abbreviate_device(device) for device in devices),
+                         set(['name:iPhone, model:iPhone']))
+        self.assertEqual(len(healthexport._DEVICES), cached + 1)
+        for device in ('Apple Watch', '<<HKDevice: 0x1', '<<HKDevice>>'):
+            self.assertEqual(abbreviate_device(device), device)
+
+    def test_route_files(self):
+        path = copy_test_data()
+        directory = os.path.dirname(path)
+        os.makedirs(os.path.join(directory, 'workout-routes'))
+        gpx = ('<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>'
+               '<trkpt lon="-0.5" lat="51.25"><ele>12</ele>'
+               '<time>2019-06-01T07:48:01Z</time></trkpt>'
+               '<trkpt lon="-0.5" lat="51.5"></trkpt>'
+               '<trkpt lon="-0.75" lat="51.75">'
+               '<time>2019-06-01T07:48:02.5Z</time><extensions>'
+               '<speed>3.5</speed><course>180</course><hAcc>4</hAcc>'
+               '<vAcc>3</vAcc></extensions></trkpt>'
+               '</trkseg></trk></gpx>')
+        expected = [(1559375281, 51.25, -0.5, 12.0, None, None, None, None),
+                     (1559375282, 51.75, -0.75, None, 3.5, 180.0, 4.0, 3.0)]
+        with open(os.path.join(directory, 'workout-routes', 'a.gpx'),
+                  'w') as f:
+            f.write(gpx)
+        archive = os.path.join(directory, 'export.zip')
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.write(path, 'apple_health_export/export.xml')
+            z.writestr('apple_health_export/workout-routes/a.gpx', gpx)
+        for export in (path, archive):
+            with open_export_file(export, '/workout-routes/a.gpx') as f:
+                self.assertEqual(list(route_points(f)), expected)
+            self.assertRaises(IOError, open_export_file, export,
+                              '/workout-routes/b.gpx')
+        self.assertEqual(sorted(parallel_map(abs, [-2, 1, -3], 2)), [1, 2, 3])
+
+    def test_export_index(self):
+        path = copy_test_data()
+        self.assertIsNone(load_index(path))
+        index = export_index(path)
+        self.assertTrue(os.path.exists(index_path(path)))
+        self.assertEqual(index.n_nodes, 20)
+        self.assertEqual(index.types['HKQuantityTypeIdentifierStepCount'], 10)
+        self.assertEqual(sum(run[3] for run in index.runs), 20)
+        loaded = load_index(path)
+        self.assertEqual((loaded.runs, loaded.tags, loaded.fields),
+                         (index.runs, index.tags, index.fields))
+        for (kind, start, end, count, first, last) in index.runs:
+            kinds = [element.get('type') or element.tag for element
+                     in iter_range(path, start, end, nested=False)]
+            self.assertEqual(kinds.count(kind), count)
+        self.assertEqual(len(index.ranges(['StepCount'])), 1)
+        self.assertEqual(index.ranges(['Nope']), [])
+
+        with open(path, 'rb') as f:
+            elements = list(iter_elements(f, nested=False))
+        for (kinds, start, end) in ((['StepCount'], None, None),
+                                    (['Workout', 'ActivitySummary'],
+                                     None, None),
+                                    (None, '2014-09-13 11:00:00 +0100',
+                                     '2016-04-15'),
+                                    (['DistanceWalkingRunning'],
+                                     '2014-09-14', None)):
+            expected = [(e.tag, sorted(e.items())) for e
+                        in filter_elements(elements, kinds, start, end)]
+            self.assertTrue(expected)
+            for parser in PARSERS:
+                self.assertEqual(
+                    [(e.tag, sorted(e.items())) for e
+                     in select_elements(path, kinds, start, end, parser)],
+                    expected)
+
+        with open(path, 'a') as f:
+            f.write('\n')
+        self.assertIsNone(load_index(path))
+        self.assertEqual(export_index(path).runs[-1][2],
+                         build_index(path).runs[-1][2])
+
+    def test_threaded_stages(self):
+        self.assertEqual(list(threaded(range(2500), batch_size=100,
+                                       depth=2)),
+                         list(range(2500)))
+
+        def fail():
+            yield 1
+            raise ValueError('bad export')
+        self.assertRaises(ValueError, list, threaded(fail()))
+
+        written = []
+        writer = WriterThread(depth=2)
+        for i in range(100):
+            writer.submit(written.append, i)
+        writer.close()
+        self.assertEqual(written, list(range(100)))
+
+        writer = WriterThread()
+        writer.submit(int, 'x')
+        self.assertRaises(ValueError, writer.close)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+testhealthstore.py: tests for healthstore.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from datetime import date, datetime
+
+from healthstore import HealthStore
+from testapplehealthdata import get_tmp_dir, remove_any_tmp_dir, CLEAN_UP
+from testapplehealthdataeventsqlite import (extract_sample,
+                                            extract_with_routes,
+                                            HEART_RATE_WITH_METADATA)
+
+
+class TestHealthStore(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def test_query(self):
+        extract_sample().close()
+        store = HealthStore(os.path.join(get_tmp_dir(), 'export.sqlite'))
+        self.assertEqual(store.kinds(), ['ActivitySummary',
+                                         'DistanceWalkingRunning',
+                                         'StepCount', 'Workout'])
+        self.assertEqual(len(list(store.query('StepCount'))), 10)
+        rows = list(store.query('StepCount', '2014-09-13 10:30:00 +0100',
+                                datetime(2014, 9, 13, 9, 40),
+                                columns=['startDateUtc', 'value',
+                                         'sourceName']))
+        self.assertEqual(rows, [(1410600849, 283, 'Health'),
+                                (1410601169, 426, 'Health')])
+        self.assertEqual([len(rows) for rows in
+                          store.chunks('StepCount', start=1410600600,
+                                       chunk_size=4)], [4, 4, 1])
+        values = store.query('StepCount', end=1410601536,
+                             columns=['value', 'unit'], arrays=True)
+        self.assertEqual(list(values), ['value', 'unit'])
+        self.assertEqual(list(values['value']), [329, 283, 426])
+        self.assertEqual(list(values['unit']), ['count'] * 3)
+        self.assertEqual(list(store.query('ActivitySummary',
+                                          date(2016, 4, 15),
+                                          columns=['dateComponents'])),
+                         [('2016-04-15',)])
+        self.assertRaises(KeyError, list, store.query('StepCount',
+                                                      columns=['nope']))
+        store.close()
+
+    def test_metadata(self):
+        extract_sample([HEART_RATE_WITH_METADATA % (60 + i, i)
+                        for i in range(2)], metadata=True).close()
+        store = HealthStore(os.path.join(get_tmp_dir(), 'export.sqlite'))
+        rows = list(store.query('HeartRate', columns=['rowid', 'value']))
+        self.assertEqual([value for (rowid, value) in rows], [60, 61])
+        metadata = store.metadata('HeartRate', [rowid for (rowid, value)
+                                                in rows])
+        self.assertEqual(metadata[rows[1][0]],
+                         [('HKMetadataKeyHeartRateMotionContext', '1'),
+                          ('HKMetadataKeySyncIdentifier', 'sync1')])
+        self.assertEqual(store.metadata('StepCount', [1]), {1: []})
+        store.close()
+
+    def test_route(self):
+        extract_with_routes(route_jobs=1).close()
+        store = HealthStore(os.path.join(get_tmp_dir(), 'export.sqlite'))
+        self.assertEqual(store.kinds(), ['ActivitySummary',
+                                         'BloodPressureDiastolic',
+                                         'BloodPressureSystolic',
+                                         'Correlation',
+                                         'DistanceWalkingRunning',
+                                         'StepCount', 'Workout'])
+        workouts = list(store.query('Workout', '2019-01-01',
+                                    columns=['rowid', 'startDateUtc']))
+        self.assertEqual(len(workouts), 2)
+        points = store.route(workouts[0][0])
+        self.assertEqual([point[:3] for point in points],
+                         [(1546682400, 51.5, -0.1), (1546682460, 51.51, -0.11),
+                          (1546682520, 51.52, -0.12)])
+        self.assertEqual(len(store.route(workouts[0][0], start=1546682460)),
+                         2)
+        self.assertEqual(store.route(workouts[1][0]), [])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+testmakeexport.py: tests for makeexport.py and benchmark.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import os
+import sqlite3
+import sys
+import unittest
+
+from collections import Counter
+
+from applehealthdataeventsqlite import HealthDataExtractorEV
+from benchmark import measure, run_benchmarks
+from healthexport import top_level_elements
+from makeexport import ExportGenerator, parse_size
+from testapplehealthdata import (get_tmp_dir, make_tmp_dir,
+                                 remove_any_tmp_dir, CLEAN_UP, VERBOSE)
+
+
+class TestMakeExport(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        """Clean up by removing the tmp directory, if it exists."""
+        if CLEAN_UP:
+            remove_any_tmp_dir()
+
+    def generate(self, name='export.xml', **kwargs):
+        path = os.path.join(get_tmp_dir(), name)
+        counts = ExportGenerator(**kwargs).write(path)
+        return (path, counts)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('1500'), 1500)
+        self.assertEqual(parse_size('2K'), 2048)
+        self.assertEqual(parse_size('1.5GB'), 3 << 29)
+
+    def test_deterministic(self):
+        make_tmp_dir()
+        (path1, counts1) = self.generate('a.xml', n_records=3000, seed=7)
+        (path2, counts2) = self.generate('b.xml', n_records=3000, seed=7)
+        (path3, counts3) = self.generate('c.xml', n_records=3000, seed=8)
+        with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        with open(path1, 'rb') as f1, open(path3, 'rb') as f3:
+            self.assertNotEqual(f1.read(), f3.read())
+        self.assertEqual(counts1, counts2)
+
+    def test_counts_and_load(self):
+        make_tmp_dir()
+        (path, counts) = self.generate(n_records=6000, workouts_per_day=2,
+                                       correlations_per_day=1)
+        with open(path, 'rb') as f:
+            tags = Counter(e.tag for e in top_level_elements(f))
+        self.assertEqual(tags['Record'],
+                         sum(n for (kind, n) in counts.items()
+                             if kind.startswith('HK')))
+        for tag in ('Correlation', 'Workout', 'ActivitySummary'):
+            self.assertEqual((tag, tags[tag]), (tag, counts[tag]))
+        self.assertTrue(counts['Workout'] > 0)
+
+        HealthDataExtractorEV(path, verbose=VERBOSE)
+        conn = sqlite3.connect(os.path.join(get_tmp_dir(), 'export.sqlite'))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM HeartRate')
+                         .fetchone()[0],
+                         counts['HKQuantityTypeIdentifierHeartRate'])
+        self.assertEqual(conn.execute('SELECT COUNT(DISTINCT motionContext) '
+                                      'FROM HeartRate').fetchone()[0], 3)
+        # each member of a Correlation is loaded once, from its top-level
+        # copy, and linked to its Correlation
+        n = counts['Correlation']
+        self.assertTrue(n > 0)
+        for kind in ('BloodPressureSystolic', 'BloodPressureDiastolic'):
+            self.assertEqual((kind, conn.execute(
+                'SELECT COUNT(*) FROM {}'.format(kind)).fetchone()[0]),
+                (kind, n))
+        self.assertEqual(conn.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT correlation), '
+            'COUNT(DISTINCT type || \' \' || record) '
+            'FROM CorrelationRecord').fetchone(), (2 * n, n, 2 * n))
+        conn.close()
+
+    def test_size_estimate(self):
+        make_tmp_dir()
+        (path, counts) = self.generate(size=1 << 20)
+        self.assertTrue(0.8 < os.path.getsize(path) / (1 << 20) < 1.2)
+
+    def test_measure(self):
+        make_tmp_dir()
+        (path, counts) = self.generate(n_records=500)
+        for name in ('csv', 'csv-ev', 'sqlite'):
+            result = measure(name, path)
+            self.assertTrue(result['seconds'] > 0)
+        for name in ('csv-ev', 'sqlite'):
+            self.assertTrue(measure(name, path, jobs=2)['seconds'] > 0)
+        self.assertRaises(ValueError, measure, 'csv', path, 2)
+
+    def test_benchmark_jobs(self):
+        data_dir = os.path.join(make_tmp_dir(), 'benchdata')
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            results = run_benchmarks(sizes=['300'],
+                                     extractors=['csv', 'sqlite'],
+                                     data_dir=data_dir, jobs=[1, 2])
+        finally:
+            sys.stdout = stdout
+        self.assertEqual([(r['extractor'], r['jobs'])
+                          for r in results['results']],
+                         [('csv', 1), ('sqlite', 1), ('sqlite', 2)])
+        self.assertEqual(results['results'][1]['speedup'], 1)
+        self.assertTrue(results['results'][2]['speedup'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+testrowcodec.py: tests for rowcodec.py
+
+Copyright (c) 2016 Nicholas J. Radcliffe
+Licence: MIT
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+import applehealthdata
+import applehealthdataeventsqlite as sqlite
+
+from rowcodec import codec_fields, compile_codec
+
+SAMPLES = (
+    {},
+    {'sourceName': '', 'value': ''},
+    {'sourceName': 'Nick\'s "Watch" \\', 'value': '72.5',
+     'startDate': '2016-04-01 12:34:56 +0100'},
+    {'type': 'SleepAnalysis', 'value': 'HKCategoryValueSleepAnalysisInBed',
+     'creationDate': '2016-04-01 23:00:00 -0500'},
+)
+
+
+class TestRowCodec(unittest.TestCase):
+    def test_compile_codec(self):
+        encode = compile_codec([('a', None), ('b', int), ('it\'s', None)],
+                               default='?')
+        self.assertEqual(encode({'a': 'x', 'b': '2'}), ['x', 2, '?'])
+        encode = compile_codec([('a', None), ('b', None)], default='',
+                               separator='|', terminator='\n')
+        self.assertEqual(encode({'b': 'y'}), '|y\n')
+        self.assertRaises(KeyError, codec_fields, [('a', 'a', 'z')], {})
+
+    def test_codecs_match_field_at_a_time(self):
+        for (tag, fields) in applehealthdata.FIELDS.items():
+            for attributes in SAMPLES:
+                expected = ','.join(
+                    applehealthdata.format_value(attributes.get(field),
+                                                 datatype)
+                    for (field, datatype) in fields.items()) + '\n'
+                self.assertEqual(
+                    applehealthdata.ROW_CODECS[tag](attributes), expected)
+
+        for dates in sqlite.DATE_FORMATS:
+            columns = sqlite.date_columns(sqlite.RECORD_FIELDS_HR, dates)
+            units = sqlite.LookupDimension('unit')
+            encode = compile_codec(codec_fields(columns,
+                                                sqlite.SQL_CONVERTERS,
+                                                {'unit': units.intern}),
+                                   default='')
+            for attributes in SAMPLES:
+                expected = [sqlite.sql_value(attributes.get(field, ''),
+                                             datatype)
+                            for (column, field, datatype) in columns]
+                expected[columns.index(('unit', 'unit', 's'))] = (
+                    units.intern(''))
+                self.assertEqual(encode(attributes), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()